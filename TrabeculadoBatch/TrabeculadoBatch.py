@@ -3,6 +3,9 @@ import unittest
 import vtk, qt, ctk, slicer, numpy
 from slicer.ScriptedLoadableModule import *
 import logging
+import time
+import TrabeculadoOsseoLib
+from TrabeculadoOsseoLib import SceneNodes
 
 # TrabeculadoBatch
 class TrabeculadoBatch(ScriptedLoadableModule):
@@ -10,7 +13,7 @@ class TrabeculadoBatch(ScriptedLoadableModule):
         ScriptedLoadableModule.__init__(self, parent)
         self.parent.title = "TrabeculadoBatch"
         self.parent.categories = ["HCFMRP"]
-        self.parent.dependencies = []
+        self.parent.dependencies = ["TrabeculadoOsseo"]
         self.parent.contributors = ["Julio C Ferranti (CCIFM-FMRP-USP)"]
         self.parent.helpText = """Executa o Trabeculado Osseo em lote, com varios exames."""
         self.parent.helpText += self.getDefaultModuleDocumentationLink()
@@ -18,6 +21,9 @@ class TrabeculadoBatch(ScriptedLoadableModule):
 
 # TrabeculadoBatchWidget
 class TrabeculadoBatchWidget(ScriptedLoadableModuleWidget):
+    # Nos criados na cena para cada exame (nome do volume + sufixo)
+    examNodeSuffixes = (' N4ITK', ' Cast Volume', ' Inverted Volume', ' Result Volume', ' ROI')
+
     def setup(self):
         ScriptedLoadableModuleWidget.setup(self)
 
@@ -43,6 +49,161 @@ class TrabeculadoBatchWidget(ScriptedLoadableModuleWidget):
         self.labelCortSpin.setToolTip("valor do Label (cor) para o Osso Cortical")
         mainFormLayout.addRow("Osso Cortical Label Value", self.labelCortSpin)
 
+        # Pareamento dos volumes com os labels
+        self.labelPatternEdit = qt.QLineEdit(TrabeculadoOsseoLib.LABEL_PATTERN_DEFAULT)
+        self.labelPatternEdit.setToolTip("Nome do label de cada volume, com * no lugar do nome do volume.")
+        mainFormLayout.addRow("Nome do label", self.labelPatternEdit)
+
+        self.examManifestPathEdit = ctk.ctkPathLineEdit()
+        self.examManifestPathEdit.filters = ctk.ctkPathLineEdit.Files
+        self.examManifestPathEdit.nameFilters = ["Manifesto CSV (*.csv)"]
+        self.examManifestPathEdit.setToolTip("CSV com as colunas volume e label (nomes dos nos) de cada exame. Vazio: pareia pelo nome do label.")
+        mainFormLayout.addRow("Manifesto de exames", self.examManifestPathEdit)
+
+        # Parametros do N4ITK
+        self.n4PresetCombo = qt.QComboBox()
+        self.n4PresetCombo.addItems(list(TrabeculadoOsseoLib.N4_PRESET_NAMES))
+        self.n4PresetCombo.setToolTip("fast: reducao 8 e menos iteracoes; default: valores do modulo N4ITK; accurate: reducao 2 e mais iteracoes.")
+        mainFormLayout.addRow("Preset do N4ITK", self.n4PresetCombo)
+
+        self.n4ShrinkSpin = qt.QSpinBox()
+        self.n4ShrinkSpin.setMinimum(1)
+        self.n4ShrinkSpin.setMaximum(16)
+        self.n4ShrinkSpin.setToolTip("Fator de reducao da imagem na estimativa do bias field.")
+        mainFormLayout.addRow("Fator de reducao", self.n4ShrinkSpin)
+
+        self.n4IterationsEdit = qt.QLineEdit()
+        self.n4IterationsEdit.setToolTip("Iteracoes por nivel de resolucao, separadas por virgula (ex.: 50,40,30).")
+        mainFormLayout.addRow("Iteracoes", self.n4IterationsEdit)
+
+        self.n4ConvergenceSpin = qt.QDoubleSpinBox()
+        self.n4ConvergenceSpin.setDecimals(6)
+        self.n4ConvergenceSpin.setMinimum(0.0)
+        self.n4ConvergenceSpin.setMaximum(1.0)
+        self.n4ConvergenceSpin.setSingleStep(0.0001)
+        self.n4ConvergenceSpin.setToolTip("Limiar de convergencia do N4ITK.")
+        mainFormLayout.addRow("Limiar de convergencia", self.n4ConvergenceSpin)
+
+        self.n4ThreadsSpin = qt.QSpinBox()
+        self.n4ThreadsSpin.setMinimum(0)
+        self.n4ThreadsSpin.setMaximum(256)
+        self.n4ThreadsSpin.setSpecialValueText("Automatico")
+        self.n4ThreadsSpin.setToolTip("Threads de cada processo do N4ITK (Automatico: nucleos divididos entre os processos em paralelo).")
+        mainFormLayout.addRow("Threads do N4ITK", self.n4ThreadsSpin)
+
+        self.n4PresetCombo.connect('currentIndexChanged(int)', self.onN4PresetChanged)
+        self.n4PresetCombo.currentIndex = TrabeculadoOsseoLib.N4_PRESET_NAMES.index(TrabeculadoOsseoLib.N4_PRESET_DEFAULT)
+        self.onN4PresetChanged()
+
+        # Processos em paralelo
+        self.workersSpin = qt.QSpinBox()
+        self.workersSpin.setMinimum(1)
+        self.workersSpin.setMaximum(256)
+        self.workersSpin.value = TrabeculadoOsseoLib.defaultWorkerCount()
+        self.workersSpin.setToolTip("Numero de exames processados ao mesmo tempo (cada N4ITK roda em um processo).")
+        mainFormLayout.addRow("Processos em paralelo", self.workersSpin)
+
+        # Limite de memoria para os exames em andamento
+        self.memoryBudgetSpin = qt.QSpinBox()
+        self.memoryBudgetSpin.setMinimum(0)
+        self.memoryBudgetSpin.setMaximum(1048576)
+        self.memoryBudgetSpin.setSuffix(" MB")
+        self.memoryBudgetSpin.setToolTip("Memoria maxima para os exames em andamento (0 = sem limite).")
+        mainFormLayout.addRow("Limite de memoria", self.memoryBudgetSpin)
+
+        # Cache de resultados
+        self.cacheCheckBox = qt.QCheckBox()
+        self.cacheCheckBox.setToolTip("Reaproveita o N4ITK e os resultados dos exames que nao mudaram.")
+        mainFormLayout.addRow("Usar cache", self.cacheCheckBox)
+
+        self.cacheDirectoryButton = ctk.ctkDirectoryButton()
+        self.cacheDirectoryButton.directory = os.path.join(slicer.app.temporaryPath, 'TrabeculadoCache')
+        self.cacheDirectoryButton.setToolTip("Diretorio onde o cache e gravado.")
+        mainFormLayout.addRow("Diretorio do cache", self.cacheDirectoryButton)
+
+        self.cacheSizeSpin = qt.QSpinBox()
+        self.cacheSizeSpin.setMinimum(1)
+        self.cacheSizeSpin.setMaximum(10000)
+        self.cacheSizeSpin.value = 20
+        self.cacheSizeSpin.setSuffix(" GB")
+        self.cacheSizeSpin.setToolTip("Tamanho maximo do cache; os exames usados ha mais tempo sao removidos.")
+        mainFormLayout.addRow("Tamanho do cache", self.cacheSizeSpin)
+
+        # Cast pelo modulo CLI em vez do NumPy
+        self.castWithCLICheckBox = qt.QCheckBox()
+        self.castWithCLICheckBox.setToolTip("Usa o modulo Cast Scalar Volume (arquivos temporarios e outro processo) em vez do Cast e da inversao em NumPy. O resultado e o mesmo.")
+        mainFormLayout.addRow("Cast pelo modulo CLI", self.castWithCLICheckBox)
+
+        # Corte do resultado nos limites do label da ROI
+        self.roiPaddingSpin = qt.QSpinBox()
+        self.roiPaddingSpin.setMinimum(0)
+        self.roiPaddingSpin.setMaximum(1000)
+        self.roiPaddingSpin.setSuffix(" voxels")
+        self.roiPaddingSpin.setToolTip("Margem em volta do label da ROI mantida no Result Volume.")
+        mainFormLayout.addRow("Margem da ROI", self.roiPaddingSpin)
+
+        self.showROICheckBox = qt.QCheckBox()
+        self.showROICheckBox.setToolTip("Cria uma ROI com os limites do Result Volume de cada exame para exibicao.")
+        mainFormLayout.addRow("Mostrar ROI", self.showROICheckBox)
+
+        # Modo de pouca memoria
+        self.lowMemoryCheckBox = qt.QCheckBox()
+        self.lowMemoryCheckBox.setToolTip("Inverte e binariza no proprio volume do Cast, gera o resultado em uint8 (0/1) e remove os volumes intermediarios.")
+        mainFormLayout.addRow("Pouca memoria", self.lowMemoryCheckBox)
+
+        # Nucleos de calculo
+        self.kernelBackendCombo = qt.QComboBox()
+        self.kernelBackendCombo.addItems(list(TrabeculadoOsseoLib.KERNEL_BACKENDS))
+        self.kernelBackendCombo.setCurrentIndex(TrabeculadoOsseoLib.KERNEL_BACKENDS.index(TrabeculadoOsseoLib.KERNEL_BACKEND_NUMPY))
+        self.kernelBackendCombo.setToolTip("numpy: operacoes do NumPy; numba: Cast, inversao e estatisticas em uma passada compilada e em paralelo, e binarizacao compilada (requer o pacote numba); auto: numba se instalado. O resultado e o mesmo.")
+        mainFormLayout.addRow("Nucleos de calculo", self.kernelBackendCombo)
+
+        # Profundidade de bits
+        self.bitDepthCombo = qt.QComboBox()
+        self.bitDepthCombo.addItem("Automatica")
+        self.bitDepthCombo.addItems([str(bits) for bits in TrabeculadoOsseoLib.BIT_DEPTHS])
+        self.bitDepthCombo.setToolTip("Bits usados na inversao (Max = 2^bits - 1), os mesmos para todos os exames. Automatica: detecta pelo maior voxel de cada exame.")
+        mainFormLayout.addRow("Profundidade de bits", self.bitDepthCombo)
+
+        # Nos mantidos na cena
+        self.keepIntermediatesCheckBox = qt.QCheckBox()
+        self.keepIntermediatesCheckBox.checked = True
+        self.keepIntermediatesCheckBox.setToolTip("Mantem na cena os volumes N4ITK, Cast e Inverted e os nos dos modulos CLI de cada exame.")
+        mainFormLayout.addRow("Manter intermediarios", self.keepIntermediatesCheckBox)
+
+        self.saveResultsCheckBox = qt.QCheckBox()
+        self.saveResultsCheckBox.setToolTip("Grava o Result Volume de cada exame no diretorio abaixo e o remove da cena, mantendo apenas a tabela.")
+        mainFormLayout.addRow("Salvar resultados em disco", self.saveResultsCheckBox)
+
+        self.resultDirectoryButton = ctk.ctkDirectoryButton()
+        self.resultDirectoryButton.setToolTip("Diretorio dos Result Volumes gravados durante o processamento.")
+        mainFormLayout.addRow("Diretorio dos resultados", self.resultDirectoryButton)
+
+        # Formato dos resultados gravados (aqui e em Salvar imagens)
+        self.exportFormats = list(TrabeculadoOsseoLib.MASK_FORMATS) + ["nii"]
+        self.exportFormatCombo = qt.QComboBox()
+        self.exportFormatCombo.addItems(["NRRD uint8 (gzip)", "Bits compactados (.npz)", "NIfTI int32 sem compressao"])
+        self.exportFormatCombo.setToolTip("NRRD e bits compactados gravam a mascara 0/1 em threads, com um manifesto (manifest.csv) ligando cada arquivo a sua linha da tabela. NIfTI grava o volume 0/Max como antes.")
+        mainFormLayout.addRow("Formato dos resultados", self.exportFormatCombo)
+
+        # Tabela gravada em disco conforme os exames terminam
+        self.resultTablePathEdit = ctk.ctkPathLineEdit()
+        self.resultTablePathEdit.filters = ctk.ctkPathLineEdit.Files
+        self.resultTablePathEdit.nameFilters = ["Tabelas (*.csv *.sqlite *.db)"]
+        self.resultTablePathEdit.setToolTip("Arquivo CSV ou SQLite onde cada exame e gravado assim que termina. Vazio: so a tabela da cena.")
+        mainFormLayout.addRow("Tabela em disco", self.resultTablePathEdit)
+
+        self.resumeCheckBox = qt.QCheckBox()
+        self.resumeCheckBox.setToolTip("Mantem a tabela em disco, recoloca as linhas dela na tabela da cena e pula os exames ja gravados.")
+        mainFormLayout.addRow("Retomar", self.resumeCheckBox)
+
+        # Registro das etapas
+        self.profilePathEdit = ctk.ctkPathLineEdit()
+        self.profilePathEdit.filters = ctk.ctkPathLineEdit.Files
+        self.profilePathEdit.nameFilters = ["JSON lines (*.jsonl)"]
+        self.profilePathEdit.setToolTip("Arquivo onde o tempo, a CPU, o pico de memoria e os voxels de cada etapa sao acrescentados (uma linha JSON por etapa). Vazio: nao grava.")
+        mainFormLayout.addRow("Registro das etapas", self.profilePathEdit)
+
         # Apply Button
         self.applyButton = qt.QPushButton("Iniciar")
         self.applyButton.toolTip = "Inicie o processamento."
@@ -56,6 +217,10 @@ class TrabeculadoBatchWidget(ScriptedLoadableModuleWidget):
         self.progressBar.setVisible(False)
         mainFormLayout.addRow(self.progressBar)
 
+        # Pico de memoria da ultima execucao
+        self.peakMemoryLabel = qt.QLabel()
+        mainFormLayout.addRow("Pico de memoria (RSS)", self.peakMemoryLabel)
+
         self.resultButton = qt.QPushButton("Salvar imagens")
         #self.resultButton.enabled = False
         mainFormLayout.addRow(self.resultButton)
@@ -67,6 +232,11 @@ class TrabeculadoBatchWidget(ScriptedLoadableModuleWidget):
         self.applyButton.connect('clicked(bool)', self.onApplyButton)
         self.resultButton.connect('clicked(bool)', self.onResultButton)
 
+        self.cache = None
+        self.table = None
+        self.resultStore = None
+        self.currentN4Settings = TrabeculadoOsseoLib.N4Settings()
+
         # Refresh Apply button state
         self.onSelect()
 
@@ -76,15 +246,71 @@ class TrabeculadoBatchWidget(ScriptedLoadableModuleWidget):
     def onSelect(self):
         pass
 
+    def onN4PresetChanged(self):
+        settings = TrabeculadoOsseoLib.N4_PRESETS[self.n4PresetCombo.currentText]
+        self.n4ShrinkSpin.value = settings.shrinkFactor
+        self.n4IterationsEdit.text = settings.iterationsText()
+        self.n4ConvergenceSpin.value = settings.convergenceThreshold
+
+    def n4Settings(self):
+        iterations = TrabeculadoOsseoLib.N4Settings.parseIterations(self.n4IterationsEdit.text)
+        return TrabeculadoOsseoLib.N4Settings(self.n4ShrinkSpin.value, iterations, self.n4ConvergenceSpin.value, self.n4ThreadsSpin.value)
+
+    def bitDepth(self):
+        # None (Automatica) detecta o Max pelos dados de cada exame
+        if self.bitDepthCombo.currentIndex == 0:
+            return None
+        return int(self.bitDepthCombo.currentText)
+
     def onResultButton(self):
         directory = qt.QFileDialog.getExistingDirectory()
-
-        for node in slicer.util.getNodesByClass('vtkMRMLScalarVolumeNode'):
-            if 'Result' in node.GetName():
-                filename = node.GetName() + ".nii"
+        if not directory:
+            return
+        nodes = [node for node in slicer.util.getNodesByClass('vtkMRMLScalarVolumeNode') if 'Result' in node.GetName()]
+        self.exportResultVolumes(nodes, directory)
+
+    def resultFilePath(self, directory, name):
+        # Caminho em que exportResultVolumes grava o Result Volume de nome name
+        fileFormat = self.exportFormats[self.exportFormatCombo.currentIndex]
+        if fileFormat == "nii":
+            return os.path.join(directory, name + ".nii")
+        return os.path.join(directory, TrabeculadoOsseoLib.maskFileName(name, fileFormat))
+
+    def exportResultVolumes(self, nodes, directory):
+        # Grava os Result Volumes no formato escolhido; retorna os caminhos gravados
+        fileFormat = self.exportFormats[self.exportFormatCombo.currentIndex]
+        if fileFormat == "nii":
+            filePaths = []
+            for node in nodes:
+                filePath = self.resultFilePath(directory, node.GetName())
                 properties = {'useCompression': 0} #do not compress
-                filePath = os.path.join(directory, filename)
                 slicer.util.saveNode(node, filePath, properties)
+                filePaths.append(filePath)
+            return filePaths
+
+        # Os arrays e a geometria sao lidos aqui; a conversao e a compressao rodam nas threads
+        items = []
+        for node in nodes:
+            IJKtoRASMatrix = vtk.vtkMatrix4x4()
+            node.GetIJKToRASMatrix(IJKtoRASMatrix)
+            matrix = [[IJKtoRASMatrix.GetElement(row, column) for column in range(4)] for row in range(4)]
+            geometry = TrabeculadoOsseoLib.geometryFromIJKToRAS(matrix)
+            name = node.GetName()
+            items.append(TrabeculadoOsseoLib.MaskExportItem(name, slicer.util.arrayFromVolume(node), geometry, self.tableResultRow(name)))
+        startTime = time.time()
+        TrabeculadoOsseoLib.exportMasks(items, directory, fileFormat)
+        logging.info('%d resultados gravados em %.2f s (%s)' % (len(items), time.time() - startTime, fileFormat))
+        return [self.resultFilePath(directory, item.name) for item in items]
+
+    def tableResultRow(self, resultName):
+        # [ICort, ITrab, Ilow, FVTO] do exame na tabela, pelo nome do Result Volume, ou None
+        if self.table is None or not resultName.endswith(' Result Volume'):
+            return None
+        examName = resultName[:-len(' Result Volume')]
+        for rowIndex in range(self.table.GetNumberOfRows()):
+            if self.table.GetCellText(rowIndex, 0) == examName:
+                return [self.table.GetCellText(rowIndex, column) for column in range(1, 1 + len(TrabeculadoOsseoLib.FVTOResult.columnNames))]
+        return None
 
     def onApplyButton(self):
         self.applyButton.setText("Aguarde...")
@@ -92,42 +318,136 @@ class TrabeculadoBatchWidget(ScriptedLoadableModuleWidget):
         self.progressBar.setVisible(True)
         slicer.app.processEvents()
 
+        try:
+            TrabeculadoOsseoLib.resolveKernelBackend(self.kernelBackendCombo.currentText)
+        except ImportError as error:
+            slicer.util.errorDisplay(str(error))
+            self.applyButton.setText("Iniciar")
+            self.applyButton.setEnabled(True)
+            return
+
+        # Parametros do N4ITK e cache validados antes de abrir a tabela em disco
+        try:
+            self.currentN4Settings = self.n4Settings()
+        except ValueError as error:
+            slicer.util.errorDisplay(str(error))
+            self.applyButton.setText("Iniciar")
+            self.applyButton.setEnabled(True)
+            return
+        if self.currentN4Settings.numberOfThreads == 0 and self.workersSpin.value > 1:
+            # Divide os nucleos entre os N4ITK que rodam ao mesmo tempo
+            self.currentN4Settings.numberOfThreads = max(1, TrabeculadoOsseoLib.defaultWorkerCount() // self.workersSpin.value)
+        logging.info('N4ITK: ' + self.currentN4Settings.describe())
+
+        self.cache = None
+        if self.cacheCheckBox.checked:
+            try:
+                self.cache = TrabeculadoOsseoLib.ResultCache(self.cacheDirectoryButton.directory, self.cacheSizeSpin.value * 1024 ** 3)
+            except OSError as error:
+                slicer.util.errorDisplay('Falha ao abrir o cache: ' + str(error))
+                self.applyButton.setText("Iniciar")
+                self.applyButton.setEnabled(True)
+                return
+
+        # Parear volumes e labels antes de processar
+        try:
+            examIndex = self.buildExamIndex()
+        except (ValueError, KeyError, IOError) as error:
+            slicer.util.errorDisplay('Falha no pareamento dos exames: ' + str(error))
+            self.applyButton.setText("Iniciar")
+            self.applyButton.setEnabled(True)
+            return
+        logging.info(examIndex.report())
+        if not examIndex.isComplete() and not slicer.util.confirmOkCancelDisplay(examIndex.report() + "\n\nProcessar apenas os exames pareados?"):
+            self.applyButton.setText("Iniciar")
+            self.applyButton.setEnabled(True)
+            return
+        exams = [(volume, label) for name, volume, label in examIndex.exams]
+
         # Criar tabela para os dados
         logging.info('Criando a tabela')
         self.table = slicer.vtkMRMLTableNode()
         tableWasModified = self.table.StartModify()
         self.table.SetName("Export Table")
         self.table.SetUseColumnNameAsColumnHeader(True)
-        col = self.table.AddColumn(); col.SetName("Volume")
-        col = self.table.AddColumn(); col.SetName("ICort")
-        col = self.table.AddColumn(); col.SetName("ITrab")
-        col = self.table.AddColumn(); col.SetName("Ilow")
-        col = self.table.AddColumn(); col.SetName("FVTO")
-
-        for node in slicer.util.getNodesByClass('vtkMRMLScalarVolumeNode'):
-            if node.GetClassName() == "vtkMRMLLabelMapVolumeNode":
-                logging.info('Ignorando label: ' + node.GetName())
-                continue
-            else:
-                logging.info('Processando ' + node.GetName())
-                input = node
-                label = slicer.util.getNode(node.GetName() + '-label')
-                ROILabelValue = self.labelROISpin.value
-                cortLabelValue = self.labelCortSpin.value
-                self.run(input, label, ROILabelValue, cortLabelValue)
-
-        # Adiciona a tabela a cena e exibe
+        columnNames = ["Volume", "ICort", "ITrab", "Ilow", "FVTO", "N4"] + TrabeculadoOsseoLib.StageProfile.columnNames()
+        for columnName in columnNames:
+            col = self.table.AddColumn(); col.SetName(columnName)
+
+        # Tabela em disco; ao retomar, os exames ja gravados voltam para a tabela e sao pulados
+        self.resultStore = None
+        resultTablePath = self.resultTablePathEdit.currentPath
+        if resultTablePath:
+            try:
+                self.resultStore = TrabeculadoOsseoLib.ResultStore(resultTablePath, columnNames, self.resumeCheckBox.checked)
+            except ValueError as error:
+                slicer.util.errorDisplay(str(error))
+                self.table.EndModify(tableWasModified)
+                self.applyButton.setText("Iniciar")
+                self.applyButton.setEnabled(True)
+                return
+            for row in self.resultStore.rows():
+                self.insertTableRow(row)
+            remaining = [(node, label) for node, label in exams if not self.resultStore.isCompleted(node.GetName())]
+            logging.info('%d exames ja gravados em %s' % (len(exams) - len(remaining), resultTablePath))
+            exams = remaining
+
+        # Adiciona a tabela a cena e exibe; as linhas entram conforme os exames terminam
         logging.info('Adicionar tabela e exibir')
+        self.table.EndModify(tableWasModified)
         slicer.mrmlScene.AddNode(self.table)
         slicer.app.layoutManager().setLayout(slicer.vtkMRMLLayoutNode.SlicerLayoutFourUpTableView)
         slicer.app.applicationLogic().GetSelectionNode().SetReferenceActiveTableID(self.table.GetID())
         slicer.app.applicationLogic().PropagateTableSelection()
-        self.table.EndModify(tableWasModified)
 
-        self.applyButton.setText("Iniciar")
-        self.applyButton.setEnabled(True)
+        TrabeculadoOsseoLib.resetPeakRSS()
+        self.runPeakRSS = 0
+        ROILabelValue = self.labelROISpin.value
+        cortLabelValue = self.labelCortSpin.value
+        try:
+            # Os processos do N4ITK sao iniciados depois pelo agendador do Slicer, entao o numero
+            # de threads do ITK fica definido ate o ultimo exame terminar, e nao so em slicer.cli.run
+            with TrabeculadoOsseoLib.itkThreadsEnvironment(self.currentN4Settings.numberOfThreads):
+                if self.workersSpin.value > 1:
+                    self.runParallel(exams, ROILabelValue, cortLabelValue)
+                else:
+                    for input, label in exams:
+                        logging.info('Processando ' + input.GetName())
+                        sceneNodeIDs = self.sceneNodeIDs()
+                        try:
+                            self.run(input, label, ROILabelValue, cortLabelValue)
+                        except Exception:
+                            # Um exame com problema nao interrompe o lote
+                            self.failExam(input, sceneNodeIDs)
+        finally:
+            if self.resultStore is not None:
+                self.resultStore.close()
+                self.resultStore = None
+            self.applyButton.setText("Iniciar")
+            self.applyButton.setEnabled(True)
+
+        # As etapas zeram o pico do processo; o pico da execucao e o maior entre elas
+        peakRSS = TrabeculadoOsseoLib.peakRSSBytes()
+        if peakRSS is not None:
+            peakRSS = max(peakRSS, self.runPeakRSS)
+            self.peakMemoryLabel.setText("%.0f MB" % (peakRSS / 1024.0 ** 2))
+            logging.info('Pico de memoria (RSS): %.0f MB' % (peakRSS / 1024.0 ** 2))
         return
 
+    def buildExamIndex(self):
+        # Pares volume/label da cena, por nome (uma passada pelos nos) ou pelo manifesto
+        volumes = []
+        labels = []
+        for node in slicer.util.getNodesByClass('vtkMRMLScalarVolumeNode'):
+            if node.GetClassName() == "vtkMRMLLabelMapVolumeNode":
+                labels.append((node.GetName(), node))
+            else:
+                volumes.append((node.GetName(), node))
+        manifest = None
+        if self.examManifestPathEdit.currentPath:
+            manifest = TrabeculadoOsseoLib.readExamManifest(self.examManifestPathEdit.currentPath)
+        return TrabeculadoOsseoLib.buildExamIndex(volumes, labels, self.labelPatternEdit.text, manifest)
+
     def hasImageData(self, volumeNode):
         if not volumeNode:
             logging.debug('Falha em hasImageData: Sem volume')
@@ -156,199 +476,337 @@ class TrabeculadoBatchWidget(ScriptedLoadableModuleWidget):
             slicer.util.errorDisplay('Volumes de entrada e saida sao so mesmos. Escolha outros volumes')
             return False
 
-        volumeLogic = slicer.modules.volumes.logic()
         slicer.app.processEvents()
 
+        cacheKeys = self.cacheKeys(inputVolume, labelMap, ROIValue, cortValue)
+        if self.restoreCachedRow(inputVolume, cacheKeys):
+            return True
+
         # Executar correcao N4ITK
         self.progressBar.value = 10
         slicer.app.processEvents()
+        profile = TrabeculadoOsseoLib.StageProfile(inputVolume.GetName())
+        n4itkVolume = self.restoreCachedN4ITKVolume(inputVolume, cacheKeys)
+        if n4itkVolume is None:
+            with profile.stage(TrabeculadoOsseoLib.STAGE_N4ITK, inputVolume.GetImageData().GetNumberOfPoints()):
+                n4itkVolume, cliNode = self.startN4ITK(inputVolume, True)
+            self.discardNodes(cliNode)
+            self.storeCache(cacheKeys, n4itkVolume=n4itkVolume)
+        logging.info('N4ITK finished')
+
+        result = self.processN4ITKVolume(inputVolume, labelMap, n4itkVolume, ROIValue, cortValue, profile)
+        self.storeCache(cacheKeys, result=result)
+        return result
+
+    def runParallel(self, exams, ROIValue, cortValue):
+        # O N4ITK de cada exame roda em um processo proprio; o restante do pipeline
+        # e concluido aqui conforme cada processo termina
+        examBytes = 0
+        for inputVolume, labelMap in exams:
+            examBytes = max(examBytes, TrabeculadoOsseoLib.estimateExamBytes(inputVolume.GetImageData().GetNumberOfPoints()))
+        workerCount = TrabeculadoOsseoLib.workerCountForBudget(self.workersSpin.value, self.memoryBudgetSpin.value * 1024 * 1024, examBytes)
+        logging.info('Processando %d exames com %d processos' % (len(exams), workerCount))
+
+        sceneNodeIDs = self.sceneNodeIDs()
+        pending = []
+        for inputVolume, labelMap in exams:
+            if not self.isValidInputOutputData(inputVolume, labelMap):
+                logging.error('Ignorando ' + inputVolume.GetName() + ': volume e label invalidos')
+                continue
+            cacheKeys = self.cacheKeys(inputVolume, labelMap, ROIValue, cortValue)
+            if self.restoreCachedRow(inputVolume, cacheKeys):
+                continue
+            pending.append((inputVolume, labelMap, cacheKeys))
+
+        running = []
+        try:
+            while pending or running:
+                # Dispara o N4ITK dos proximos exames enquanto houver processos livres
+                while pending and len(running) < workerCount:
+                    inputVolume, labelMap, cacheKeys = pending.pop(0)
+                    logging.info('Processando ' + inputVolume.GetName())
+                    profile = TrabeculadoOsseoLib.StageProfile(inputVolume.GetName())
+                    n4itkVolume = self.restoreCachedN4ITKVolume(inputVolume, cacheKeys)
+                    if n4itkVolume is not None:
+                        self.finishExam(inputVolume, labelMap, n4itkVolume, ROIValue, cortValue, profile, cacheKeys, sceneNodeIDs)
+                        continue
+                    n4itkVolume, cliNode = self.startN4ITK(inputVolume, False)
+                    running.append((inputVolume, labelMap, cacheKeys, n4itkVolume, cliNode, profile, time.time()))
+
+                # Conclui os exames cujo N4ITK terminou
+                for exam in list(running):
+                    inputVolume, labelMap, cacheKeys, n4itkVolume, cliNode, profile, startTime = exam
+                    if cliNode.IsBusy():
+                        continue
+                    running.remove(exam)
+                    # O N4ITK roda em outro processo: so o tempo de parede e medido
+                    profile.addStage(TrabeculadoOsseoLib.STAGE_N4ITK, time.time() - startTime, voxels=inputVolume.GetImageData().GetNumberOfPoints())
+                    if cliNode.GetStatus() != cliNode.Completed:
+                        logging.error('N4ITK falhou para ' + inputVolume.GetName() + ': ' + cliNode.GetStatusString())
+                        self.discardNodes(cliNode, n4itkVolume)
+                        continue
+                    self.discardNodes(cliNode)
+                    logging.info('N4ITK finished: ' + inputVolume.GetName())
+                    self.storeCache(cacheKeys, n4itkVolume=n4itkVolume)
+                    self.finishExam(inputVolume, labelMap, n4itkVolume, ROIValue, cortValue, profile, cacheKeys, sceneNodeIDs)
+
+                slicer.app.processEvents()
+                time.sleep(0.1)
+        finally:
+            # Interrompido por um erro fora dos exames: nenhum N4ITK fica rodando sem dono
+            for inputVolume, labelMap, cacheKeys, n4itkVolume, cliNode, profile, startTime in running:
+                logging.error('N4ITK cancelado para ' + inputVolume.GetName())
+                cliNode.Cancel()
+                self.discardNodes(cliNode, n4itkVolume)
+
+    def finishExam(self, inputVolume, labelMap, n4itkVolume, ROIValue, cortValue, profile, cacheKeys, sceneNodeIDs):
+        # Etapas depois do N4ITK; uma falha descarta so os nos deste exame
+        try:
+            result = self.processN4ITKVolume(inputVolume, labelMap, n4itkVolume, ROIValue, cortValue, profile)
+        except Exception:
+            self.failExam(inputVolume, sceneNodeIDs)
+            return
+        self.storeCache(cacheKeys, result=result)
+
+    def sceneNodes(self):
+        nodes = slicer.mrmlScene.GetNodes()
+        return [nodes.GetItemAsObject(index) for index in range(nodes.GetNumberOfItems())]
+
+    def sceneNodeIDs(self):
+        return set(node.GetID() for node in self.sceneNodes())
+
+    def failExam(self, inputVolume, sceneNodeIDs):
+        # Registra a falha e descarta os nos do exame criados depois de sceneNodeIDs
+        logging.exception('Falha ao processar ' + inputVolume.GetName())
+        names = [inputVolume.GetName() + suffix for suffix in self.examNodeSuffixes]
+        self.discardNodes(*[node for node in self.sceneNodes() if node.GetID() not in sceneNodeIDs and node.GetName() in names])
+
+    def cacheKeys(self, inputVolume, labelMap, ROIValue, cortValue):
+        # Chaves do N4ITK e da linha de resultados, ou None sem cache
+        if self.cache is None:
+            return None
+        n4Key = TrabeculadoOsseoLib.n4CacheKey(slicer.util.arrayFromVolume(inputVolume), inputVolume.GetSpacing(), self.currentN4Settings.asDict())
+        # A profundidade de bits muda o Max; a automatica mantem as chaves anteriores
+        rowParameters = None
+        if self.bitDepth() is not None:
+            rowParameters = {"bitDepth": self.bitDepth()}
+        rowKey = TrabeculadoOsseoLib.resultCacheKey(n4Key, slicer.util.arrayFromVolume(labelMap), ROIValue, cortValue, rowParameters)
+        return n4Key, rowKey
+
+    def restoreCachedRow(self, inputVolume, cacheKeys):
+        # Retorna False se o exame ainda nao esta no cache ou se o Result Volume precisa
+        # ser refeito (exibido na cena, ou ainda nao gravado no diretorio dos resultados);
+        # nesse caso o exame segue pelo pipeline e so o N4ITK vem do cache
+        if cacheKeys is None:
+            return False
+        if not self.saveResultsCheckBox.checked:
+            return False
+        resultPath = self.resultFilePath(self.resultDirectoryButton.directory, inputVolume.GetName() + ' Result Volume')
+        if not os.path.exists(resultPath):
+            return False
+        row = self.cache.getRow(cacheKeys[1])
+        if row is None:
+            return False
+        logging.info('Resultado em cache: ' + inputVolume.GetName())
+        self.addTableRow(inputVolume.GetName(), row)
+        return True
+
+    def restoreCachedN4ITKVolume(self, inputVolume, cacheKeys):
+        if cacheKeys is None:
+            return None
+        n4Array = self.cache.getArray(cacheKeys[0])
+        if n4Array is None:
+            return None
+        logging.info('N4ITK em cache: ' + inputVolume.GetName())
+        volumeLogic = slicer.modules.volumes.logic()
+        n4itkVolume = volumeLogic.CloneVolumeWithoutImageData(slicer.mrmlScene, inputVolume, inputVolume.GetName() + ' N4ITK')
+        slicer.util.updateVolumeFromArray(n4itkVolume, n4Array)
+        return n4itkVolume
+
+    def storeCache(self, cacheKeys, n4itkVolume=None, result=None):
+        if cacheKeys is None:
+            return
+        if n4itkVolume is not None:
+            self.cache.putArray(cacheKeys[0], slicer.util.arrayFromVolume(n4itkVolume))
+        if result is not None:
+            self.cache.putRow(cacheKeys[1], result.asRow())
+
+    def discardNodes(self, *nodes):
+        # Remove da cena os nos intermediarios ja consumidos, a menos que devam ser mantidos
+        if self.keepIntermediatesCheckBox.checked:
+            return
+        for node in nodes:
+            slicer.mrmlScene.RemoveNode(node)
+
+    def addTableRow(self, name, row, profile=None):
+        # Sem profile (resultado em cache) as colunas das etapas ficam vazias
+        row = [name] + row + [self.currentN4Settings.describe()]
+        if profile is not None:
+            row = row + profile.asRow()
+        self.insertTableRow(row)
+        if self.resultStore is not None:
+            # Completa as colunas vazias para a linha ter todas as colunas da tabela
+            self.resultStore.append(row + [""] * (len(self.resultStore.columns) - len(row)))
+
+    def insertTableRow(self, row):
+        rowIndex = self.table.AddEmptyRow()
+        for column, value in enumerate(row):
+            self.table.SetCellText(rowIndex, column, str(value))
+
+    def recordProfile(self, profile):
+        # Grava as etapas do exame e acompanha o pico de memoria da execucao
+        profilePath = self.profilePathEdit.currentPath
+        if profilePath:
+            profile.writeJSONLines(profilePath)
+        logging.info(profile.asJSONLines().rstrip())
+        peakRSS = profile.peakRSSBytes()
+        if peakRSS is not None:
+            self.runPeakRSS = max(self.runPeakRSS, peakRSS)
+
+    def startN4ITK(self, inputVolume, waitForCompletion):
         n4itkVolume = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode", inputVolume.GetName() + ' N4ITK')
         parameters = {}
         parameters["inputImageName"] = inputVolume.GetID()
         parameters["outputImageName"] = n4itkVolume.GetID()
+        parameters.update(self.currentN4Settings.cliParameters())
         n4itkModule = slicer.modules.n4itkbiasfieldcorrection
-        slicer.cli.run(n4itkModule, None, parameters, wait_for_completion=True)
-        logging.info('N4ITK finished')
+        # O numero de threads do ITK e definido em onApplyButton para o lote inteiro
+        cliNode = slicer.cli.run(n4itkModule, None, parameters, wait_for_completion=waitForCompletion)
+        return n4itkVolume, cliNode
 
-        # Executar CastScalarVolume
-        self.progressBar.value = 20
-        slicer.app.processEvents()
-        castVolume = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode", inputVolume.GetName() + ' Cast Volume')
-        parameters.clear()
-        parameters["InputVolume"] = n4itkVolume.GetID()
-        parameters["OutputVolume"] = castVolume.GetID()
-        parameters["Type"] = "Int"
-        csv = slicer.modules.castscalarvolume
-        slicer.cli.run(csv, None, parameters, wait_for_completion=True)
-        logging.info('Cast Scalar Volume finished')
-
-        # Inverter voxels do Volume
+    def processCastVolumeLowMemory(self, inputVolume, labelMap, castVolume, ROIValue, cortValue, profile):
+        # Inverte e calcula no proprio Cast, binariza direto em uint8 e remove o Cast
         self.progressBar.value = 30
         slicer.app.processEvents()
-        invertVolume = volumeLogic.CloneVolume(slicer.mrmlScene, castVolume, inputVolume.GetName() + ' Inverted Volume')
-        invertVolume.SetName(inputVolume.GetName() + ' Inverted Volume')
-        a = slicer.util.array(invertVolume.GetName())
-        Max=0
-        if (a.max() < 256):                              # 8 bits
-            Max=255
-        if (a.max() >= 256) and (a.max() < 4096):        # 12 bits
-            Max=4095
-        if (a.max() >= 4096) and (a.max() < 16384):      # 14 bits
-                Max=16383
-        if (a.max() >= 16384) and (a.max() < 65536):     # 16 bits
-            Max=65535
-
-        a[:] = Max -a                                    #inverte os valores dos voxels
-        logging.info('Inverted Volume finished')
-        #invertVolume.GetImageData().Modified()
-
-        # Calcular osso cortical
-        self.progressBar.value = 40
-        slicer.app.processEvents()
-        volumeArray = slicer.util.array(invertVolume.GetName())
-        labelArray = slicer.util.array(labelMap.GetName())
-        points = numpy.where(labelArray == cortValue)
-        values = volumeArray[points]
-        ICort = values.mean()
-        logging.info('Calculo do Osso Cortical (ICort) finished')
-
-        # Calculo da media da ROI (ITrab)
-        self.progressBar.value = 50
+        volumeArray = slicer.util.arrayFromVolume(castVolume)
+        labelArray = slicer.util.arrayFromVolume(labelMap)
+        result = TrabeculadoOsseoLib.run(volumeArray, labelArray, ROIValue, cortValue, castVolume.GetSpacing(), copy=False, profile=profile, backend=self.kernelBackendCombo.currentText, bitDepth=self.bitDepth())
+        logging.info('Calculo do FVTO finished')
+
+        self.progressBar.value = 90
         slicer.app.processEvents()
-        ROIArray = slicer.util.array(invertVolume.GetName())
-        labelArray = slicer.util.array(labelMap.GetName())
-        points = numpy.where(labelArray == ROIValue)
-        values = volumeArray[points]
-        ocorrencias = numpy.bincount(values)                   #contar ocorrencias. Posicao e o valor!
-        ocorrenciasList = list(ocorrencias)                    #converter array numpy em lista
-        ocurrenciasListSorted = numpy.sort(ocorrenciasList)    #ordenar array
-        ITrab = values.mean()                                  #media dos pontos
-        logging.info('Calculo da ROI (ITrab) finished')
-
-        # capturar o valor do pixel (posicao) no vetor do pico do histograma
-        picoPixelValue=ocorrenciasList.index(ocorrencias.max())
-
-        # Encontrar ILow
-        if (ocorrencias.max()/2) in ocorrencias:
-            ILow=ocorrenciasList.index(ocorrencias.max()/2)
+        roiPadding = self.roiPaddingSpin.value
+        with profile.stage(TrabeculadoOsseoLib.STAGE_BINARIZE) as record:
+            maskArray = TrabeculadoOsseoLib.binarizedROIMask(volumeArray, labelArray, ROIValue, result, padding=roiPadding, backend=self.kernelBackendCombo.currentText)
+            if maskArray is None:
+                raise ValueError('Label da ROI nao encontrado na mascara de ' + inputVolume.GetName())
+            roiExtent = TrabeculadoOsseoLib.roiCropExtent(result, volumeArray.shape, roiPadding)
+            resultVolume = SceneNodes.createVolumeFromArray(maskArray, castVolume, roiExtent, inputVolume.GetName() + ' Result Volume')
+            record["voxels"] = maskArray.size
+        if self.showROICheckBox.checked:
+            with profile.stage(TrabeculadoOsseoLib.STAGE_ROI):
+                SceneNodes.createROINode(castVolume, roiExtent, inputVolume.GetName() + ' ROI')
+        slicer.mrmlScene.RemoveNode(castVolume)
+        logging.info('Volume ROI Binario finished')
+
+        logging.info('Popular tabela')
+        self.addTableRow(inputVolume.GetName(), result.asRow(), profile)
+        self.recordProfile(profile)
+
+        self.showResultVolume(resultVolume)
+        return result
+
+    def showResultVolume(self, resultVolume):
+        if self.saveResultsCheckBox.checked:
+            # Grava o resultado e o retira da cena, mantendo apenas a tabela
+            filePath, = self.exportResultVolumes([resultVolume], self.resultDirectoryButton.directory)
+            slicer.mrmlScene.RemoveNode(resultVolume)
+            logging.info('Resultado salvo em ' + filePath)
         else:
-            for x in ocurrenciasListSorted:
-                if x > (ocorrencias.max()/2):
-                    posterior=ocorrenciasList.index(x)
-                    break
-                else:
-                    anterior=ocorrenciasList.index(x)
-        try:
-            ILow
-            #print 'ilow existe'
-        except NameError:
-            #print 'ilow nao existe'
-            if (posterior-(ocorrencias.max()/2)) <= ((ocorrencias.max()/2)-anterior):
-                ILow = posterior
-            else:
-                ILow = anterior
+            # Exibir o resultado
+            logging.info('Exibir resultado')
+            for color in ['Red', 'Yellow', 'Green']:
+                slicer.app.layoutManager().sliceWidget(color).sliceLogic().GetSliceCompositeNode().SetBackgroundVolumeID(resultVolume.GetID())
+            self.resultButton.enabled = True
 
-        logging.info('Procura ILow finished')
+        self.progressBar.value = 100
+        slicer.app.processEvents()
 
-        FVTO = (ITrab - ILow) / (ICort - ILow)
-        logging.info('Calculo do FVTO finished')
+        logging.info('Processing finished')
 
-        # Executa Mask Scalar Volume no ROI
-        self.progressBar.value = 60
-        slicer.app.processEvents()
-        ROIVolume = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode", inputVolume.GetName() + ' ROI Volume')
-        parameters.clear()
-        parameters["InputVolume"] = invertVolume.GetID()
-        parameters["MaskVolume"] = labelMap.GetID()
-        parameters["OutputVolume"] = ROIVolume.GetID()
-        parameters["Label"] = ROIValue
-        maskScalarVolume = slicer.modules.maskscalarvolume
-        slicer.cli.run(maskScalarVolume, None, parameters, wait_for_completion=True)
-        logging.info('Mask Scalar Volume finished')
-
-        # Posicionando a ROI para cortar a imagem
-        self.progressBar.value = 70
-        slicer.app.processEvents()
+    def processN4ITKVolume(self, inputVolume, labelMap, n4itkVolume, ROIValue, cortValue, profile):
+        volumeLogic = slicer.modules.volumes.logic()
+        parameters = {}
+        voxelCount = n4itkVolume.GetImageData().GetNumberOfPoints()
+        backend = self.kernelBackendCombo.currentText
+        labelArray = slicer.util.arrayFromVolume(labelMap)
+
+        result = None
+        if not self.castWithCLICheckBox.checked and not self.lowMemoryCheckBox.checked:
+            # Cast (Int) e inversao sobre o N4ITK, sem o modulo CLI nem o Cast Volume; no
+            # backend numba, o calculo do FVTO e feito na mesma passada
+            self.progressBar.value = 20
+            slicer.app.processEvents()
+            volumeArray, result = TrabeculadoOsseoLib.castInvertAndRun(slicer.util.arrayFromVolume(n4itkVolume), labelArray, ROIValue, cortValue,
+                                                                      n4itkVolume.GetSpacing(), profile=profile, backend=backend, bitDepth=self.bitDepth())
+            invertVolume = SceneNodes.createVolumeFromArray(volumeArray, n4itkVolume, None, inputVolume.GetName() + ' Inverted Volume')
+            logging.info('Cast e inversao finished')
+            self.discardNodes(n4itkVolume)
+        else:
+            # Executar CastScalarVolume
+            self.progressBar.value = 20
+            slicer.app.processEvents()
+            if self.castWithCLICheckBox.checked:
+                castVolume = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode", inputVolume.GetName() + ' Cast Volume')
+                parameters["InputVolume"] = n4itkVolume.GetID()
+                parameters["OutputVolume"] = castVolume.GetID()
+                parameters["Type"] = "Int"
+                csv = slicer.modules.castscalarvolume
+                with profile.stage(TrabeculadoOsseoLib.STAGE_CAST, voxelCount):
+                    cliNode = slicer.cli.run(csv, None, parameters, wait_for_completion=True)
+                logging.info('Cast Scalar Volume finished')
+                self.discardNodes(cliNode)
+            else:
+                with profile.stage(TrabeculadoOsseoLib.STAGE_CAST, voxelCount):
+                    castArray = TrabeculadoOsseoLib.castArray(slicer.util.arrayFromVolume(n4itkVolume))
+                    castVolume = SceneNodes.createVolumeFromArray(castArray, n4itkVolume, None, inputVolume.GetName() + ' Cast Volume')
+                logging.info('Cast finished')
+
+            if self.lowMemoryCheckBox.checked:
+                slicer.mrmlScene.RemoveNode(n4itkVolume)
+                return self.processCastVolumeLowMemory(inputVolume, labelMap, castVolume, ROIValue, cortValue, profile)
+
+            # Inverter voxels do Volume
+            self.progressBar.value = 30
+            slicer.app.processEvents()
+            with profile.stage(TrabeculadoOsseoLib.STAGE_INVERT, voxelCount):
+                invertVolume = volumeLogic.CloneVolume(slicer.mrmlScene, castVolume, inputVolume.GetName() + ' Inverted Volume')
+                invertVolume.SetName(inputVolume.GetName() + ' Inverted Volume')
+                volumeArray = slicer.util.arrayFromVolume(invertVolume)
+                Max = TrabeculadoOsseoLib.invertVolumeArray(volumeArray, bitDepth=self.bitDepth())
+                invertVolume.GetImageData().Modified()
+            self.discardNodes(n4itkVolume, castVolume)
+
+        # Calcular ICort, ITrab, ILow e FVTO
+        if result is None:
+            result = TrabeculadoOsseoLib.runInverted(volumeArray, labelArray, ROIValue, cortValue, Max, invertVolume.GetSpacing(), profile=profile, backend=backend)
+        logging.info('Calculo do FVTO finished')
 
-        # Achar o centro da imagem segmentada
-        array = slicer.util.array(ROIVolume.GetName())
-        points = numpy.where(array > 0)
-
-        # Calculo da posicao
-        pos = [0.0, 0.0, 0.0]
-        IJKtoRASMatrix = vtk.vtkMatrix4x4()
-        ROIVolume.GetIJKToRASMatrix(IJKtoRASMatrix)
-        i = points[2].max() - (points[2].max() - points[2].min())/2
-        j = points[1].max() - (points[1].max() - points[1].min())/2
-        k = points[0].max() - (points[0].max() - points[0].min())/2
-        IJK = [i, j, k, 1]
-        RAS = IJKtoRASMatrix.MultiplyPoint(IJK)
-        pos[0] = RAS[0]
-        pos[1] = RAS[1]
-        pos[2] = RAS[2]
-
-        # Calculo das dimensoes
-        spacing = [0.0, 0.0, 0.0]
-        spacing = ROIVolume.GetSpacing()
-        L = ((points[0].max() - points[0].min())/2*spacing[0])+spacing[0]
-        P = ((points[2].max() - points[2].min())/2*spacing[2])+spacing[1]
-        A = ((points[1].max() - points[1].min())/2*spacing[1])+spacing[1]
-        print L, P, A
-
-        # Criar a ROI
-        ROI = slicer.vtkMRMLAnnotationROINode()
-        ROI.SetName(inputVolume.GetName() + ' ROI')
-        slicer.mrmlScene.AddNode(ROI)
-        ROI.SetXYZ(pos)
-        ROI.SetRadiusXYZ(L, P, A)
-        ROI.SetDisplayVisibility(True)
-
-        # Realiza o Crop da imagem
-        #Crop Voxel Based
+        # Recortar o volume invertido nos limites do label da ROI (no espaco de
+        # indices, sem Mask Scalar Volume nem Crop Volume) e binarizar
         self.progressBar.value = 80
         slicer.app.processEvents()
-        cropLogic = slicer.modules.cropvolume.logic()
-        cropVolume = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode", inputVolume.GetName() + ' Cropped Volume')
-        parametersNode = slicer.vtkMRMLCropVolumeParametersNode()
-        parametersNode.SetInputVolumeNodeID(ROIVolume.GetID())
-        parametersNode.SetOutputVolumeNodeID(cropVolume.GetID())
-        parametersNode.SetROINodeID(ROI.GetID())
-        parametersNode.SetVoxelBased(True)
-        slicer.mrmlScene.AddNode(parametersNode)
-        cropLogic.SnapROIToVoxelGrid(parametersNode)
-        cropLogic.Apply(parametersNode)
-
-        # Binarizar volume
-        self.progressBar.value = 90
-        slicer.app.processEvents()
-        resultVolume = volumeLogic.CloneVolume(slicer.mrmlScene, cropVolume, inputVolume.GetName() + ' Result Volume')
-        resultVolume.SetName(inputVolume.GetName() + ' Result Volume')
-        arrayResult = slicer.util.array(resultVolume.GetName())
-        arrayResult[arrayResult < ITrab] = 0
-        arrayResult[arrayResult >= ITrab] = Max
+        roiPadding = self.roiPaddingSpin.value
+        with profile.stage(TrabeculadoOsseoLib.STAGE_BINARIZE) as record:
+            arrayResult = TrabeculadoOsseoLib.binarizedROI(volumeArray, labelArray, ROIValue, result, roiPadding, backend)
+            if arrayResult is None:
+                raise ValueError('Label da ROI nao encontrado na mascara de ' + inputVolume.GetName())
+            roiExtent = TrabeculadoOsseoLib.roiCropExtent(result, volumeArray.shape, roiPadding)
+            resultVolume = SceneNodes.createVolumeFromArray(arrayResult, invertVolume, roiExtent, inputVolume.GetName() + ' Result Volume')
+            record["voxels"] = arrayResult.size
+        if self.showROICheckBox.checked:
+            with profile.stage(TrabeculadoOsseoLib.STAGE_ROI):
+                SceneNodes.createROINode(invertVolume, roiExtent, inputVolume.GetName() + ' ROI')
+        self.discardNodes(invertVolume)
         logging.info('Volume ROI Binario finished')
 
         # Popular tabela
         logging.info('Popular tabela')
-        rowIndex = self.table.AddEmptyRow()
-        self.table.SetCellText(rowIndex, 0, inputVolume.GetName())
-        self.table.SetCellText(rowIndex, 1, str(ICort))
-        self.table.SetCellText(rowIndex, 2, str(ITrab))
-        self.table.SetCellText(rowIndex, 3, str(ILow))
-        self.table.SetCellText(rowIndex, 4, str(FVTO))
-
-        # Exibir o resultado
-        logging.info('Exibir resultado')
-        for color in ['Red', 'Yellow', 'Green']:
-            slicer.app.layoutManager().sliceWidget(color).sliceLogic().GetSliceCompositeNode().SetBackgroundVolumeID(resultVolume.GetID())
-
-        self.resultButton.enabled = True
-        self.progressBar.value = 100
-        slicer.app.processEvents()
+        self.addTableRow(inputVolume.GetName(), result.asRow(), profile)
+        self.recordProfile(profile)
 
-        logging.info('Processing finished')
-
-        return True
+        self.showResultVolume(resultVolume)
+        return result
 
 class TrabeculadoBatchTest(ScriptedLoadableModuleTest):
     def setUp(self):
@@ -359,4 +817,19 @@ class TrabeculadoBatchTest(ScriptedLoadableModuleTest):
         self.test_TrabeculadoOsseo1()
 
     def test_TrabeculadoOsseo1(self):
-        pass
+        # Um exame sintetico (volume e label) processado pelo lote completo, com N4ITK
+        phantom = TrabeculadoOsseoLib.makePhantom((48, 48, 48), 12, boneFraction=0.3, biasAmplitude=0.2, noiseSigma=0.02, seed=1)
+        slicer.util.addVolumeFromArray(phantom.volumeArray, name="phantom")
+        slicer.util.addVolumeFromArray(phantom.labelArray, name="phantom-label", nodeClassName="vtkMRMLLabelMapVolumeNode")
+
+        widget = slicer.modules.trabeculadobatch.widgetRepresentation().self()
+        widget.labelROISpin.value = phantom.ROIValue
+        widget.labelCortSpin.value = phantom.cortValue
+        widget.workersSpin.value = 1
+        widget.cacheCheckBox.checked = False
+        widget.onApplyButton()
+
+        self.assertEqual(widget.table.GetNumberOfRows(), 1)
+        self.assertEqual(widget.table.GetCellText(0, 0), "phantom")
+        FVTO = float(widget.table.GetCellText(0, 4))
+        self.assertLess(abs(FVTO - phantom.truth["FVTO"]), 0.15)
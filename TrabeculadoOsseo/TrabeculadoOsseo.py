@@ -3,6 +3,10 @@ import unittest
 import vtk, qt, ctk, slicer, numpy
 from slicer.ScriptedLoadableModule import *
 import logging
+import time
+import threading
+import TrabeculadoOsseoLib
+from TrabeculadoOsseoLib import SceneNodes
 
 # TrabeculadoOsseo
 class TrabeculadoOsseo(ScriptedLoadableModule):
@@ -16,6 +20,27 @@ class TrabeculadoOsseo(ScriptedLoadableModule):
         self.parent.helpText += self.getDefaultModuleDocumentationLink()
         self.parent.acknowledgementText = """ """
 
+# Etapa do pipeline executada por um modulo CLI
+class CLIStep(object):
+    def __init__(self, cliNode, progressStart, progressEnd):
+        self.cliNode = cliNode
+        self.progressStart = progressStart
+        self.progressEnd = progressEnd
+
+    def isDone(self):
+        return not self.cliNode.IsBusy()
+
+    def progress(self):
+        return self.cliNode.GetProgress() / 100.0
+
+    def cancel(self):
+        self.cliNode.Cancel()
+
+    def result(self):
+        if self.cliNode.GetStatus() != self.cliNode.Completed:
+            raise RuntimeError(self.cliNode.GetModuleTitle() + ': ' + self.cliNode.GetStatusString())
+        return self.cliNode
+
 # TrabeculadoOsseoWidget
 
 class TrabeculadoOsseoWidget(ScriptedLoadableModuleWidget):
@@ -68,12 +93,106 @@ class TrabeculadoOsseoWidget(ScriptedLoadableModuleWidget):
         self.labelCortSpin.setToolTip("valor do Label (cor) para o Osso Cortical")
         mainFormLayout.addRow("Osso Cortical Label Value", self.labelCortSpin)
 
+        # Parametros do N4ITK
+        self.n4PresetCombo = qt.QComboBox()
+        self.n4PresetCombo.addItems(list(TrabeculadoOsseoLib.N4_PRESET_NAMES))
+        self.n4PresetCombo.setToolTip("fast: reducao 8 e menos iteracoes; default: valores do modulo N4ITK; accurate: reducao 2 e mais iteracoes.")
+        mainFormLayout.addRow("Preset do N4ITK", self.n4PresetCombo)
+
+        self.n4ShrinkSpin = qt.QSpinBox()
+        self.n4ShrinkSpin.setMinimum(1)
+        self.n4ShrinkSpin.setMaximum(16)
+        self.n4ShrinkSpin.setToolTip("Fator de reducao da imagem na estimativa do bias field.")
+        mainFormLayout.addRow("Fator de reducao", self.n4ShrinkSpin)
+
+        self.n4IterationsEdit = qt.QLineEdit()
+        self.n4IterationsEdit.setToolTip("Iteracoes por nivel de resolucao, separadas por virgula (ex.: 50,40,30).")
+        mainFormLayout.addRow("Iteracoes", self.n4IterationsEdit)
+
+        self.n4ConvergenceSpin = qt.QDoubleSpinBox()
+        self.n4ConvergenceSpin.setDecimals(6)
+        self.n4ConvergenceSpin.setMinimum(0.0)
+        self.n4ConvergenceSpin.setMaximum(1.0)
+        self.n4ConvergenceSpin.setSingleStep(0.0001)
+        self.n4ConvergenceSpin.setToolTip("Limiar de convergencia do N4ITK.")
+        mainFormLayout.addRow("Limiar de convergencia", self.n4ConvergenceSpin)
+
+        self.n4ThreadsSpin = qt.QSpinBox()
+        self.n4ThreadsSpin.setMinimum(0)
+        self.n4ThreadsSpin.setMaximum(256)
+        self.n4ThreadsSpin.setSpecialValueText("Automatico")
+        self.n4ThreadsSpin.setToolTip("Threads usadas pelo N4ITK (Automatico: todos os nucleos).")
+        mainFormLayout.addRow("Threads do N4ITK", self.n4ThreadsSpin)
+
+        self.n4PresetCombo.connect('currentIndexChanged(int)', self.onN4PresetChanged)
+        self.n4PresetCombo.currentIndex = TrabeculadoOsseoLib.N4_PRESET_NAMES.index(TrabeculadoOsseoLib.N4_PRESET_DEFAULT)
+        self.onN4PresetChanged()
+
+        # Recorte antes do N4ITK
+        self.cropBeforeN4CheckBox = qt.QCheckBox()
+        self.cropBeforeN4CheckBox.setToolTip("Recorta o volume nos limites dos labels da ROI e do osso cortical antes do N4ITK.")
+        mainFormLayout.addRow("Recortar antes do N4ITK", self.cropBeforeN4CheckBox)
+
+        self.cropMarginSpin = qt.QSpinBox()
+        self.cropMarginSpin.setMinimum(0)
+        self.cropMarginSpin.setMaximum(1000)
+        self.cropMarginSpin.value = 10
+        self.cropMarginSpin.setSuffix(" voxels")
+        self.cropMarginSpin.setToolTip("Margem em volta dos labels mantida no recorte.")
+        mainFormLayout.addRow("Margem do recorte", self.cropMarginSpin)
+
+        self.compareFullVolumeCheckBox = qt.QCheckBox()
+        self.compareFullVolumeCheckBox.setToolTip("Executa tambem no volume inteiro e mostra a aceleracao e a diferenca nos resultados.")
+        mainFormLayout.addRow("Comparar com volume inteiro", self.compareFullVolumeCheckBox)
+
+        # Cast pelo modulo CLI em vez do NumPy
+        self.castWithCLICheckBox = qt.QCheckBox()
+        self.castWithCLICheckBox.setToolTip("Usa o modulo Cast Scalar Volume (arquivos temporarios e outro processo) em vez do Cast e da inversao em NumPy. O resultado e o mesmo.")
+        mainFormLayout.addRow("Cast pelo modulo CLI", self.castWithCLICheckBox)
+
+        # Corte do resultado nos limites do label da ROI
+        self.roiPaddingSpin = qt.QSpinBox()
+        self.roiPaddingSpin.setMinimum(0)
+        self.roiPaddingSpin.setMaximum(1000)
+        self.roiPaddingSpin.setSuffix(" voxels")
+        self.roiPaddingSpin.setToolTip("Margem em volta do label da ROI mantida no Result Volume.")
+        mainFormLayout.addRow("Margem da ROI", self.roiPaddingSpin)
+
+        self.showROICheckBox = qt.QCheckBox()
+        self.showROICheckBox.setToolTip("Cria uma ROI com os limites do Result Volume para exibicao.")
+        mainFormLayout.addRow("Mostrar ROI", self.showROICheckBox)
+
+        # Modo de pouca memoria
+        self.lowMemoryCheckBox = qt.QCheckBox()
+        self.lowMemoryCheckBox.setToolTip("Inverte e binariza no proprio volume do Cast, gera o resultado em uint8 (0/1) e remove os volumes intermediarios.")
+        mainFormLayout.addRow("Pouca memoria", self.lowMemoryCheckBox)
+
+        # Nucleos de calculo
+        self.kernelBackendCombo = qt.QComboBox()
+        self.kernelBackendCombo.addItems(list(TrabeculadoOsseoLib.KERNEL_BACKENDS))
+        self.kernelBackendCombo.setCurrentIndex(TrabeculadoOsseoLib.KERNEL_BACKENDS.index(TrabeculadoOsseoLib.KERNEL_BACKEND_NUMPY))
+        self.kernelBackendCombo.setToolTip("numpy: operacoes do NumPy; numba: inversao, estatisticas e binarizacao compiladas e em paralelo (requer o pacote numba); auto: numba se instalado. O resultado e o mesmo.")
+        mainFormLayout.addRow("Nucleos de calculo", self.kernelBackendCombo)
+
+        # Profundidade de bits
+        self.bitDepthCombo = qt.QComboBox()
+        self.bitDepthCombo.addItem("Automatica")
+        self.bitDepthCombo.addItems([str(bits) for bits in TrabeculadoOsseoLib.BIT_DEPTHS])
+        self.bitDepthCombo.setToolTip("Bits usados na inversao (Max = 2^bits - 1). Automatica: detecta pelo maior voxel em uma passada pelo volume.")
+        mainFormLayout.addRow("Profundidade de bits", self.bitDepthCombo)
+
         # Apply Button
         self.applyButton = qt.QPushButton("Iniciar")
         self.applyButton.toolTip = "Inicie o processamento."
         self.applyButton.enabled = False
         mainFormLayout.addRow(self.applyButton)
 
+        # Cancel Button
+        self.cancelButton = qt.QPushButton("Cancelar")
+        self.cancelButton.toolTip = "Interrompe o processamento e remove os volumes criados por ele."
+        self.cancelButton.enabled = False
+        mainFormLayout.addRow(self.cancelButton)
+
         # Progress Bar
         self.progressBar = qt.QProgressBar()
         self.progressBar.setMinimum(0)
@@ -109,6 +228,13 @@ class TrabeculadoOsseoWidget(ScriptedLoadableModuleWidget):
         self.resultButton.enabled = False
         histogramFormLayout.addRow(self.resultButton)
 
+        # Tabela gravada em disco a cada execucao
+        self.resultTablePathEdit = ctk.ctkPathLineEdit()
+        self.resultTablePathEdit.filters = ctk.ctkPathLineEdit.Files
+        self.resultTablePathEdit.nameFilters = ["Tabelas (*.csv *.sqlite *.db)"]
+        self.resultTablePathEdit.setToolTip("Arquivo CSV ou SQLite ao qual cada resultado e acrescentado assim que o processamento termina. Vazio: nao grava.")
+        histogramFormLayout.addRow("Tabela em disco", self.resultTablePathEdit)
+
         #export board
         self.exportBoard = qt.QPlainTextEdit()
         #self.exportBoard.visible = False
@@ -124,16 +250,41 @@ class TrabeculadoOsseoWidget(ScriptedLoadableModuleWidget):
         self.inputSelector.connect("currentNodeChanged(vtkMRMLNode*)", self.onSelect)
         self.maskSelector.connect("currentNodeChanged(vtkMRMLNode*)", self.onSelect)
         self.exportButton.connect('clicked(bool)', self.onExportButton)
+        self.cancelButton.connect('clicked(bool)', self.onCancelButton)
+
+        # Processamento em segundo plano: o timer acompanha a etapa em andamento
+        self.pipelineTimer = qt.QTimer()
+        self.pipelineTimer.setInterval(100)
+        self.pipelineTimer.connect('timeout()', self.onPipelineTimer)
+        self.pipelineSteps = None
+        self.pipelineStep = None
+        self.pipelineBusy = False
+        self.pipelineNodes = []
+        self.cancelEvent = threading.Event()
+        self.resultVolume = None
+
+        # Etapas da ultima execucao, reaproveitadas quando so os labels mudam
+        self.pipelineState = TrabeculadoOsseoLib.PipelineState()
 
         # Refresh Apply button state
         self.onSelect()
 
     def cleanup(self):
-        pass
+        self.pipelineTimer.stop()
 
     def onSelect(self):
         self.applyButton.enabled = self.inputSelector.currentNode() and self.maskSelector.currentNode()
 
+    def onN4PresetChanged(self):
+        settings = TrabeculadoOsseoLib.N4_PRESETS[self.n4PresetCombo.currentText]
+        self.n4ShrinkSpin.value = settings.shrinkFactor
+        self.n4IterationsEdit.text = settings.iterationsText()
+        self.n4ConvergenceSpin.value = settings.convergenceThreshold
+
+    def n4Settings(self):
+        iterations = TrabeculadoOsseoLib.N4Settings.parseIterations(self.n4IterationsEdit.text)
+        return TrabeculadoOsseoLib.N4Settings(self.n4ShrinkSpin.value, iterations, self.n4ConvergenceSpin.value, self.n4ThreadsSpin.value)
+
     def onExportButton(self):
         self.exportBoard.visible = True
         filename = "result.csv"
@@ -143,7 +294,7 @@ class TrabeculadoOsseoWidget(ScriptedLoadableModuleWidget):
             yourfile.write(str(self.exportBoard.toPlainText()))
 
     def onResultButton(self):
-        node = slicer.util.getNode('Result Volume')
+        node = self.resultVolume
         filename = "ResultVolume.nii"
         properties = {'useCompression': 0} #do not compress
 
@@ -153,16 +304,157 @@ class TrabeculadoOsseoWidget(ScriptedLoadableModuleWidget):
         slicer.util.saveNode(node, filePath, properties)
 
     def onApplyButton(self):
+        inputVolume = self.inputSelector.currentNode()
+        labelMap = self.maskSelector.currentNode()
+        ROIValue = self.labelROISpin.value
+        cortValue = self.labelCortSpin.value
+        try:
+            n4Settings = self.n4Settings()
+        except ValueError as error:
+            slicer.util.errorDisplay(str(error))
+            return
+        backend = self.kernelBackendCombo.currentText
+        try:
+            TrabeculadoOsseoLib.resolveKernelBackend(backend)
+        except ImportError as error:
+            slicer.util.errorDisplay(str(error))
+            return
+        bitDepth = None
+        if self.bitDepthCombo.currentIndex > 0:
+            bitDepth = int(self.bitDepthCombo.currentText)
+        cropMargin = None
+        if self.cropBeforeN4CheckBox.checked:
+            cropMargin = self.cropMarginSpin.value
+        compareFullVolume = cropMargin is not None and self.compareFullVolumeCheckBox.checked
+
         self.applyButton.setText("Aguarde...")
         self.applyButton.setEnabled(False)
+        self.cancelButton.setEnabled(True)
+        self.progressBar.value = 0
         self.progressBar.setVisible(True)
-        slicer.app.processEvents()
+        self.startPipeline(self.applySteps(inputVolume, labelMap, ROIValue, cortValue, cropMargin, self.lowMemoryCheckBox.checked, n4Settings, compareFullVolume,
+                                           self.roiPaddingSpin.value, self.showROICheckBox.checked, self.castWithCLICheckBox.checked, backend, bitDepth))
+
+    def onCancelButton(self):
+        # O cancelamento termina quando a etapa atual para; so entao os nos sao removidos
+        logging.info('Cancelando o processamento')
+        self.cancelButton.setEnabled(False)
+        self.cancelEvent.set()
+        if self.pipelineStep is not None:
+            self.pipelineStep.cancel()
+
+    def applySteps(self, inputVolume, labelMap, ROIValue, cortValue, cropMargin, lowMemory, n4Settings, compareFullVolume, roiPadding=0, showROI=False, castWithCLI=False, backend=TrabeculadoOsseoLib.KERNEL_BACKEND_NUMPY, bitDepth=None):
+        # Referencia no volume inteiro para medir a aceleracao e a diferenca do recorte
+        fullState = {"nodes": self.pipelineNodes}
+        if compareFullVolume:
+            startTime = time.time()
+            for step in self.runSteps(fullState, inputVolume, labelMap, ROIValue, cortValue, lowMemory=lowMemory, n4Settings=n4Settings, roiPadding=roiPadding, castWithCLI=castWithCLI, backend=backend, bitDepth=bitDepth):
+                yield step
+            fullTime = time.time() - startTime
+
+        # A comparacao mede o tempo de todas as etapas e o modo de pouca memoria
+        # remove os intermediarios, entao nenhum dos dois reaproveita etapas
+        pipelineState = None
+        if not compareFullVolume and not lowMemory:
+            pipelineState = self.pipelineState
+
+        state = {"nodes": self.pipelineNodes}
+        startTime = time.time()
+        for step in self.runSteps(state, inputVolume, labelMap, ROIValue, cortValue, cropMargin, lowMemory, n4Settings, pipelineState, roiPadding, showROI, castWithCLI, backend, bitDepth):
+            yield step
+        elapsedTime = time.time() - startTime
+
+        fullResult = fullState.get("result")
+        result = state.get("result")
+        if result and self.resultTablePathEdit.currentPath:
+            self.appendResultRow(self.resultTablePathEdit.currentPath, inputVolume.GetName(), result, n4Settings)
+        if fullResult and result:
+            self.exportBoard.insertPlainText("Tempo volume inteiro; %.2f s\n" % fullTime)
+            self.exportBoard.insertPlainText("Tempo recorte; %.2f s\n" % elapsedTime)
+            self.exportBoard.insertPlainText("Aceleracao; %.2f\n" % (fullTime / elapsedTime))
+            differences = TrabeculadoOsseoLib.compareResults(fullResult, result)
+            for name in TrabeculadoOsseoLib.FVTOResult.columnNames:
+                self.exportBoard.insertPlainText("Diferenca " + name + "; " + str(differences[name]) + "\n")
+            logging.info('Recorte antes do N4ITK: aceleracao %.2f, diferenca no FVTO %g' % (fullTime / elapsedTime, differences["FVTO"]))
+
+    def appendResultRow(self, path, name, result, n4Settings):
+        # Acrescenta o resultado a tabela em disco, mantendo as linhas ja gravadas
+        columns = ["Volume"] + TrabeculadoOsseoLib.FVTOResult.columnNames + ["N4"]
+        store = TrabeculadoOsseoLib.ResultStore(path, columns, resume=True)
+        try:
+            store.append([name] + result.asRow() + [n4Settings.describe()])
+        finally:
+            store.close()
+        logging.info('Resultado gravado em ' + path)
+
+    def startPipeline(self, steps):
+        # Executa o gerador de etapas sem bloquear a interface: cada etapa devolve um
+        # modulo CLI ou um BackgroundCall, consultado pelo timer ate terminar
+        self.pipelineSteps = steps
+        self.pipelineStep = None
+        self.pipelineNodes[:] = []
+        self.cancelEvent.clear()
+        self.advancePipeline()
 
-        self.run(self.inputSelector.currentNode(), self.maskSelector.currentNode(), self.labelROISpin.value, self.labelCortSpin.value)
+    def onPipelineTimer(self):
+        if self.pipelineBusy or self.pipelineStep is None:
+            return
+        step = self.pipelineStep
+        if not step.isDone():
+            if step.progress() is not None:
+                self.progressBar.value = int(step.progressStart + (step.progressEnd - step.progressStart) * step.progress())
+            return
+        if self.cancelEvent.is_set():
+            self.finishPipeline(cancelled=True)
+            return
+        try:
+            step.result()
+        except Exception as error:
+            self.failPipeline(error)
+            return
+        self.advancePipeline()
+
+    def advancePipeline(self):
+        self.pipelineBusy = True
+        try:
+            self.pipelineStep = next(self.pipelineSteps)
+        except StopIteration:
+            self.finishPipeline()
+            return
+        except TrabeculadoOsseoLib.PipelineCancelled:
+            self.finishPipeline(cancelled=True)
+            return
+        except Exception as error:
+            self.failPipeline(error)
+            return
+        finally:
+            self.pipelineBusy = False
+        if not self.pipelineTimer.isActive():
+            self.pipelineTimer.start()
 
+    def failPipeline(self, error):
+        if isinstance(error, TrabeculadoOsseoLib.PipelineCancelled):
+            self.finishPipeline(cancelled=True)
+            return
+        logging.error('Falha no processamento: ' + str(error))
+        self.finishPipeline()
+        slicer.util.errorDisplay('Falha no processamento: ' + str(error))
+
+    def finishPipeline(self, cancelled=False):
+        self.pipelineTimer.stop()
+        self.pipelineSteps.close()
+        self.pipelineStep = None
+        if cancelled:
+            # Remove os nos criados pela execucao interrompida
+            for node in reversed(self.pipelineNodes):
+                if slicer.mrmlScene.IsNodePresent(node):
+                    slicer.mrmlScene.RemoveNode(node)
+            self.progressBar.value = 0
+            logging.info('Processamento cancelado')
+        self.pipelineNodes[:] = []
+        self.cancelButton.setEnabled(False)
         self.applyButton.setText("Iniciar")
         self.applyButton.setEnabled(True)
-        return
 
     def hasImageData(self, volumeNode):
         if not volumeNode:
@@ -185,206 +477,287 @@ class TrabeculadoOsseoWidget(ScriptedLoadableModuleWidget):
             return False
         return True
 
-    def run(self, inputVolume, labelMap, ROIValue, cortValue):
+    def cropVolume(self, volumeNode, extent, name):
+        # Copia o trecho (K, J, I) do volume para um novo no, mantendo a posicao no espaco
+        array = slicer.util.arrayFromVolume(volumeNode)[TrabeculadoOsseoLib.extentSlices(extent)]
+        return SceneNodes.createVolumeFromArray(numpy.ascontiguousarray(array), volumeNode, extent, name)
+
+    def nodeKey(self, node):
+        # Identifica o no e a versao dos seus dados: editar o volume muda a chave
+        imageData = node.GetImageData()
+        return (node.GetID(), imageData.GetMTime() if imageData is not None else None)
+
+    def nodesPresent(self, outputs):
+        return all(slicer.mrmlScene.IsNodePresent(output) for output in outputs if isinstance(output, slicer.vtkMRMLNode))
+
+    def lookupStage(self, pipelineState, stageName, key):
+        # Saidas da execucao anterior da etapa, se os parametros nao mudaram e os nos ainda existem
+        if pipelineState is None:
+            return None
+        outputs = pipelineState.lookup(stageName, key, self.nodesPresent)
+        if outputs is not None:
+            logging.info(stageName + ' reaproveitado da execucao anterior')
+        return outputs
+
+    def storeStage(self, pipelineState, stageName, key, outputs):
+        if pipelineState is not None:
+            pipelineState.store(stageName, key, outputs)
+
+    def startCLI(self, module, parameters, progressStart, progressEnd):
+        # Inicia o modulo CLI sem aguardar; a etapa termina quando o no deixa de estar ocupado
+        cliNode = slicer.cli.run(module, None, parameters, wait_for_completion=False)
+        return CLIStep(cliNode, progressStart, progressEnd)
+
+    def startBackground(self, function, *args, **kwargs):
+        call = TrabeculadoOsseoLib.BackgroundCall(function, args, kwargs, self.cancelEvent)
+        call.progressStart = call.progressEnd = self.progressBar.value
+        return call
+
+    def showResult(self, result):
+        self.labelICort.setText(result.ICort)
+        self.exportBoard.insertPlainText("ICort; " + str(result.ICort) + "\n")
+        self.labelITrab.setText(result.ITrab)
+        self.exportBoard.insertPlainText("Itrab; " + str(result.ITrab) + "\n")
+        self.labelILow.setText(result.ILow)
+        self.exportBoard.insertPlainText("ILow; " + str(result.ILow) + "\n")
+        self.labelFVTO.setText(result.FVTO)
+        self.exportBoard.insertPlainText("FVTO; " + str(result.FVTO) + "\n")
+
+    def showResultVolume(self, resultVolume):
+        # Exibir o resultado
+        logging.info('Exibir resultado')
+        for color in ['Red', 'Yellow', 'Green']:
+            slicer.app.layoutManager().sliceWidget(color).sliceLogic().GetSliceCompositeNode().SetBackgroundVolumeID(resultVolume.GetID())
+
+        self.resultVolume = resultVolume
+        self.exportButton.enabled = True
+        self.resultButton.enabled = True
+        self.progressBar.value = 100
+
+        logging.info('Processing finished')
+
+    def runLowMemorySteps(self, state, castVolume, labelMap, ROIValue, cortValue, roiPadding=0, showROI=False, backend=TrabeculadoOsseoLib.KERNEL_BACKEND_NUMPY, bitDepth=None):
+        # Inverte e calcula no proprio Cast, binariza direto em uint8 e remove o Cast
+        self.progressBar.value = 30
+        volumeArray = slicer.util.arrayFromVolume(castVolume)
+        labelArray = slicer.util.arrayFromVolume(labelMap)
+        call = self.startBackground(TrabeculadoOsseoLib.run, volumeArray, labelArray, ROIValue, cortValue, castVolume.GetSpacing(), copy=False, cancelEvent=self.cancelEvent, backend=backend, bitDepth=bitDepth)
+        yield call
+        result = call.result()
+        logging.info('Calculo do FVTO finished')
+
+        self.progressBar.value = 50
+        self.showResult(result)
+
+        self.progressBar.value = 90
+        call = self.startBackground(TrabeculadoOsseoLib.binarizedROIMask, volumeArray, labelArray, ROIValue, result, cancelEvent=self.cancelEvent, padding=roiPadding, backend=backend)
+        yield call
+        maskArray = call.result()
+        if maskArray is None:
+            raise ValueError('Label da ROI nao encontrado na mascara')
+        roiExtent = TrabeculadoOsseoLib.roiCropExtent(result, volumeArray.shape, roiPadding)
+        resultVolume = SceneNodes.createVolumeFromArray(maskArray, castVolume, roiExtent, 'Result Volume')
+        state["nodes"].append(resultVolume)
+        if showROI:
+            state["nodes"].append(SceneNodes.createROINode(castVolume, roiExtent, 'ROI'))
+        slicer.mrmlScene.RemoveNode(castVolume)
+        logging.info('Volume ROI Binario finished')
+
+        self.showResultVolume(resultVolume)
+        state["result"] = result
+
+    def run(self, inputVolume, labelMap, ROIValue, cortValue, cropMargin=None, lowMemory=False, n4Settings=None, pipelineState=None, roiPadding=0, showROI=False, castWithCLI=False, backend=TrabeculadoOsseoLib.KERNEL_BACKEND_NUMPY, bitDepth=None):
+        """
+        Executa o processamento aguardando cada etapa (uso em scripts). Retorna o FVTOResult.
+        Com pipelineState (PipelineState), reaproveita as etapas cujos parametros nao mudaram.
+        O Result Volume cobre os limites do label da ROI mais roiPadding voxels; com
+        showROI, uma ROI com esses limites e criada para exibicao. Com castWithCLI, o
+        Cast usa o modulo Cast Scalar Volume em vez do NumPy. backend escolhe os
+        nucleos de calculo (numpy, numba ou auto), com o mesmo resultado. bitDepth
+        (bits) fixa o Max da inversao; None detecta pelo maior voxel.
+        """
+        state = {"nodes": []}
+        for step in self.runSteps(state, inputVolume, labelMap, ROIValue, cortValue, cropMargin, lowMemory, n4Settings, pipelineState, roiPadding, showROI, castWithCLI, backend, bitDepth):
+            while not step.isDone():
+                slicer.app.processEvents()
+                time.sleep(0.1)
+            step.result()
+        return state.get("result", False)
+
+    def runSteps(self, state, inputVolume, labelMap, ROIValue, cortValue, cropMargin=None, lowMemory=False, n4Settings=None, pipelineState=None, roiPadding=0, showROI=False, castWithCLI=False, backend=TrabeculadoOsseoLib.KERNEL_BACKEND_NUMPY, bitDepth=None):
+        # Gerador das etapas; o resultado fica em state["result"] e os nos criados em state["nodes"].
+        # Com pipelineState, Recorte, N4ITK, Cast e Inversao sao reaproveitados se a chave
+        # da etapa (que inclui a da etapa anterior) nao mudou; os labels so entram no
+        # recorte pelos seus limites, entao trocar os labels refaz apenas o calculo e o corte.
+        # O Cast e feito em NumPy (junto com a inversao); com castWithCLI, pelo Cast Scalar Volume.
+        # Os backends dao o mesmo volume invertido, entao o backend nao entra nas chaves;
+        # a profundidade de bits muda o Max e entra na chave da Inversao.
         logging.info('Processing started')
 
         if not self.isValidInputOutputData(inputVolume, labelMap):
             slicer.util.errorDisplay('Volumes de entrada e saida sao so mesmos. Escolha outros volumes')
-            return False
+            state["result"] = False
+            return
 
         volumeLogic = slicer.modules.volumes.logic()
+        nodes = state["nodes"]
         self.exportBoard.clear()
-        slicer.app.processEvents()
+
+        # Recortar volume e label nos limites da ROI e do osso cortical
+        volumeKey = (self.nodeKey(inputVolume), None)
+        if cropMargin is not None:
+            labelArray = slicer.util.arrayFromVolume(labelMap)
+            extent = TrabeculadoOsseoLib.labelExtent(labelArray, [ROIValue, cortValue])
+            if extent is None:
+                slicer.util.errorDisplay('Labels da ROI e do osso cortical nao encontrados na mascara')
+                state["result"] = False
+                return
+            extent = TrabeculadoOsseoLib.padExtent(extent, cropMargin, labelArray.shape)
+            # O N4ITK depende so do trecho recortado, nao dos valores dos labels
+            volumeKey = (self.nodeKey(inputVolume), extent)
+            cropKey = (volumeKey, self.nodeKey(labelMap))
+            cropped = self.lookupStage(pipelineState, 'Recorte', cropKey)
+            if cropped is not None:
+                inputVolume, labelMap = cropped
+            else:
+                inputVolume = self.cropVolume(inputVolume, extent, 'Cropped Input Volume')
+                labelMap = self.cropVolume(labelMap, extent, 'Cropped Label Map')
+                nodes.extend([inputVolume, labelMap])
+                self.storeStage(pipelineState, 'Recorte', cropKey, (inputVolume, labelMap))
+                logging.info('Recorte antes do N4ITK finished')
 
         # Executar correcao N4ITK
         self.progressBar.value = 10
-        slicer.app.processEvents()
-        n4itkVolume = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode", 'N4ITK Volume')
-        parameters = {}
-        parameters["inputImageName"] = inputVolume.GetID()
-        parameters["outputImageName"] = n4itkVolume.GetID()
-        n4itkModule = slicer.modules.n4itkbiasfieldcorrection
-        slicer.cli.run(n4itkModule, None, parameters, wait_for_completion=True)
-        logging.info('N4ITK finished')
+        if n4Settings is None:
+            n4Settings = TrabeculadoOsseoLib.N4Settings()
+        n4Key = ('N4ITK', volumeKey, n4Settings.asDict())
+        cached = self.lookupStage(pipelineState, 'N4ITK', n4Key)
+        if cached is not None:
+            n4itkVolume, = cached
+        else:
+            n4itkVolume = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode", 'N4ITK Volume')
+            nodes.append(n4itkVolume)
+            parameters = {}
+            parameters["inputImageName"] = inputVolume.GetID()
+            parameters["outputImageName"] = n4itkVolume.GetID()
+            parameters.update(n4Settings.cliParameters())
+            n4itkModule = slicer.modules.n4itkbiasfieldcorrection
+            # O processo do CLI e iniciado depois pelo agendador do Slicer: a variavel de
+            # threads fica definida ate a etapa terminar (o no deixar de estar ocupado)
+            with TrabeculadoOsseoLib.itkThreadsEnvironment(n4Settings.numberOfThreads):
+                step = self.startCLI(n4itkModule, parameters, 10, 20)
+                nodes.append(step.cliNode)
+                yield step
+            self.storeStage(pipelineState, 'N4ITK', n4Key, (n4itkVolume,))
+            logging.info('N4ITK finished: ' + n4Settings.describe())
+        self.exportBoard.insertPlainText("N4; " + n4Settings.describe() + "\n")
+
+        if not lowMemory and not castWithCLI:
+            # Cast (Int) e inversao em uma passada NumPy sobre o N4ITK, sem o modulo CLI nem o Cast Volume
+            self.progressBar.value = 20
+            invertKey = ('Inversao', ('CastNumPy', n4Key), bitDepth)
+            cached = self.lookupStage(pipelineState, 'Inversao', invertKey)
+            if cached is not None:
+                invertVolume, Max = cached
+            else:
+                call = self.startBackground(TrabeculadoOsseoLib.castAndInvertArray, slicer.util.arrayFromVolume(n4itkVolume), cancelEvent=self.cancelEvent, backend=backend, bitDepth=bitDepth)
+                yield call
+                invertedArray, Max = call.result()
+                invertVolume = SceneNodes.createVolumeFromArray(invertedArray, n4itkVolume, None, 'Inverted Volume')
+                nodes.append(invertVolume)
+                self.storeStage(pipelineState, 'Inversao', invertKey, (invertVolume, Max))
+                logging.info('Cast e inversao finished')
+            for step in self.runInvertedSteps(state, invertVolume, labelMap, ROIValue, cortValue, Max, roiPadding, showROI, backend):
+                yield step
+            return
 
         # Executar CastScalarVolume
         self.progressBar.value = 20
-        slicer.app.processEvents()
-        castVolume = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode", 'Cast Volume')
-        parameters.clear()
-        parameters["InputVolume"] = n4itkVolume.GetID()
-        parameters["OutputVolume"] = castVolume.GetID()
-        parameters["Type"] = "Int"
-        csv = slicer.modules.castscalarvolume
-        slicer.cli.run(csv, None, parameters, wait_for_completion=True)
-        logging.info('Cast Scalar Volume finished')
+        castKey = ('Cast', n4Key)
+        cached = self.lookupStage(pipelineState, 'Cast', castKey)
+        if cached is not None:
+            castVolume, = cached
+        elif castWithCLI:
+            castVolume = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode", 'Cast Volume')
+            nodes.append(castVolume)
+            parameters = {}
+            parameters["InputVolume"] = n4itkVolume.GetID()
+            parameters["OutputVolume"] = castVolume.GetID()
+            parameters["Type"] = "Int"
+            csv = slicer.modules.castscalarvolume
+            step = self.startCLI(csv, parameters, 20, 30)
+            nodes.append(step.cliNode)
+            yield step
+            self.storeStage(pipelineState, 'Cast', castKey, (castVolume,))
+            logging.info('Cast Scalar Volume finished')
+        else:
+            # Pouca memoria: so o Cast em NumPy, a inversao e feita no proprio Cast Volume
+            call = self.startBackground(TrabeculadoOsseoLib.castArray, slicer.util.arrayFromVolume(n4itkVolume))
+            yield call
+            castVolume = SceneNodes.createVolumeFromArray(call.result(), n4itkVolume, None, 'Cast Volume')
+            nodes.append(castVolume)
+            logging.info('Cast finished')
+
+        if lowMemory:
+            slicer.mrmlScene.RemoveNode(n4itkVolume)
+            if cropMargin is not None:
+                slicer.mrmlScene.RemoveNode(inputVolume)
+            for step in self.runLowMemorySteps(state, castVolume, labelMap, ROIValue, cortValue, roiPadding, showROI, backend, bitDepth):
+                yield step
+            if cropMargin is not None:
+                slicer.mrmlScene.RemoveNode(labelMap)
+            return
 
         # Inverter voxels do Volume
         self.progressBar.value = 30
-        slicer.app.processEvents()
-        invertVolume = volumeLogic.CloneVolume(slicer.mrmlScene, castVolume, 'Inverted Volume')
-        invertVolume.SetName('Inverted Volume')
-        a = slicer.util.array(invertVolume.GetName())
-        Max=0
-        if (a.max() < 256):                              # 8 bits
-            Max=255
-        if (a.max() >= 256) and (a.max() < 4096):        # 12 bits
-            Max=4095
-        if (a.max() >= 4096) and (a.max() < 16384):      # 14 bits
-                Max=16383
-        if (a.max() >= 16384) and (a.max() < 65536):     # 16 bits
-            Max=65535
-
-        a[:] = Max -a                                    #inverte os valores dos voxels
-        logging.info('Inverted Volume finished')
-        #invertVolume.GetImageData().Modified()
-
-        # Calcular osso cortical
-        self.progressBar.value = 40
-        slicer.app.processEvents()
-        volumeArray = slicer.util.array(invertVolume.GetName())
-        labelArray = slicer.util.array(labelMap.GetName())
-        points = numpy.where(labelArray == cortValue)
-        values = volumeArray[points]
-        ICort = values.mean()
-        self.labelICort.setText(ICort)
-        self.exportBoard.insertPlainText("ICort; " + str(ICort) + "\n")
-        logging.info('Calculo do Osso Cortical (ICort) finished')
-
-        # Calculo da media da ROI (ITrab)
-        self.progressBar.value = 50
-        slicer.app.processEvents()
-        ROIArray = slicer.util.array(invertVolume.GetName())
-        labelArray = slicer.util.array(labelMap.GetName())
-        points = numpy.where(labelArray == ROIValue)
-        values = volumeArray[points]
-        ocorrencias = numpy.bincount(values)                   #contar ocorrencias. Posicao e o valor!
-        ocorrenciasList = list(ocorrencias)                    #converter array numpy em lista
-        ocurrenciasListSorted = numpy.sort(ocorrenciasList)    #ordenar array
-        ITrab = values.mean()                                  #media dos pontos
-        self.labelITrab.setText(ITrab)
-        self.exportBoard.insertPlainText("Itrab; " + str(ITrab) + "\n")
-        logging.info('Calculo da ROI (ITrab) finished')
-
-        # capturar o valor do pixel (posicao) no vetor do pico do histograma
-        picoPixelValue=ocorrenciasList.index(ocorrencias.max())
-
-        # Encontrar ILow
-        if (ocorrencias.max()/2) in ocorrencias:
-            ILow=ocorrenciasList.index(ocorrencias.max()/2)
+        invertKey = ('Inversao', castKey, bitDepth)
+        cached = self.lookupStage(pipelineState, 'Inversao', invertKey)
+        if cached is not None:
+            invertVolume, Max = cached
         else:
-            for x in ocurrenciasListSorted:
-                if x > (ocorrencias.max()/2):
-                    posterior=ocorrenciasList.index(x)
-                    break
-                else:
-                    anterior=ocorrenciasList.index(x)
-        try:
-            ILow
-            #print 'ilow existe'
-        except NameError:
-            #print 'ilow nao existe'
-            if (posterior-(ocorrencias.max()/2)) <= ((ocorrencias.max()/2)-anterior):
-                ILow = posterior
-            else:
-                ILow = anterior
+            invertVolume = volumeLogic.CloneVolume(slicer.mrmlScene, castVolume, 'Inverted Volume')
+            invertVolume.SetName('Inverted Volume')
+            nodes.append(invertVolume)
+            call = self.startBackground(TrabeculadoOsseoLib.invertVolumeArray, slicer.util.arrayFromVolume(invertVolume), cancelEvent=self.cancelEvent, bitDepth=bitDepth)
+            yield call
+            Max = call.result()
+            invertVolume.GetImageData().Modified()
+            self.storeStage(pipelineState, 'Inversao', invertKey, (invertVolume, Max))
+        for step in self.runInvertedSteps(state, invertVolume, labelMap, ROIValue, cortValue, Max, roiPadding, showROI, backend):
+            yield step
 
-        self.labelILow.setText(ILow)
-        self.exportBoard.insertPlainText("ILow; " + str(ILow) + "\n")
-        logging.info('Procura ILow finished')
+    def runInvertedSteps(self, state, invertVolume, labelMap, ROIValue, cortValue, Max, roiPadding=0, showROI=False, backend=TrabeculadoOsseoLib.KERNEL_BACKEND_NUMPY):
+        # Etapas a partir do volume invertido: calculo com os labels atuais, corte e binarizacao
+        nodes = state["nodes"]
 
-        FVTO = (ITrab - ILow) / (ICort - ILow)
-        self.labelFVTO.setText(FVTO)
-        self.exportBoard.insertPlainText("FVTO; " + str(FVTO) + "\n")
+        # Calcular ICort, ITrab, ILow e FVTO com os labels atuais
+        volumeArray = slicer.util.arrayFromVolume(invertVolume)
+        labelArray = slicer.util.arrayFromVolume(labelMap)
+        call = self.startBackground(TrabeculadoOsseoLib.runInverted, volumeArray, labelArray, ROIValue, cortValue, Max, invertVolume.GetSpacing(), cancelEvent=self.cancelEvent, backend=backend)
+        yield call
+        result = call.result()
         logging.info('Calculo do FVTO finished')
 
-        # Executa Mask Scalar Volume no ROI
-        self.progressBar.value = 60
-        slicer.app.processEvents()
-        ROIVolume = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode", 'ROI Volume')
-        parameters.clear()
-        parameters["InputVolume"] = invertVolume.GetID()
-        parameters["MaskVolume"] = labelMap.GetID()
-        parameters["OutputVolume"] = ROIVolume.GetID()
-        parameters["Label"] = ROIValue
-        maskScalarVolume = slicer.modules.maskscalarvolume
-        slicer.cli.run(maskScalarVolume, None, parameters, wait_for_completion=True)
-        logging.info('Mask Scalar Volume finished')
-
-        # Posicionando a ROI para cortar a imagem
-        self.progressBar.value = 70
-        slicer.app.processEvents()
-
-        # Achar o centro da imagem segmentada
-        array = slicer.util.array(ROIVolume.GetName())
-        points = numpy.where(array > 0)
-
-        # Calculo da posicao
-        pos = [0.0, 0.0, 0.0]
-        IJKtoRASMatrix = vtk.vtkMatrix4x4()
-        ROIVolume.GetIJKToRASMatrix(IJKtoRASMatrix)
-        i = points[2].max() - (points[2].max() - points[2].min())/2
-        j = points[1].max() - (points[1].max() - points[1].min())/2
-        k = points[0].max() - (points[0].max() - points[0].min())/2
-        IJK = [i, j, k, 1]
-        RAS = IJKtoRASMatrix.MultiplyPoint(IJK)
-        pos[0] = RAS[0]
-        pos[1] = RAS[1]
-        pos[2] = RAS[2]
-
-        # Calculo das dimensoes
-        spacing = [0.0, 0.0, 0.0]
-        spacing = ROIVolume.GetSpacing()
-        L = ((points[0].max() - points[0].min())/2*spacing[0])+spacing[0]
-        P = ((points[2].max() - points[2].min())/2*spacing[2])+spacing[1]
-        A = ((points[1].max() - points[1].min())/2*spacing[1])+spacing[1]
-
-        # Criar a ROI
-        ROI = slicer.vtkMRMLAnnotationROINode()
-        ROI.SetName('ROI')
-        slicer.mrmlScene.AddNode(ROI)
-        ROI.SetXYZ(pos)
-        ROI.SetRadiusXYZ(L, P, A)
-        ROI.SetDisplayVisibility(True)
-
-        # Realiza o Crop da imagem
-        #Crop Voxel Based
+        self.progressBar.value = 50
+        self.showResult(result)
+
+        # Recortar o volume invertido nos limites do label da ROI (no espaco de
+        # indices, sem Mask Scalar Volume nem Crop Volume) e binarizar
         self.progressBar.value = 80
-        slicer.app.processEvents()
-        cropLogic = slicer.modules.cropvolume.logic()
-        cropVolume = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode", 'Cropped Volume')
-        parametersNode = slicer.vtkMRMLCropVolumeParametersNode()
-        parametersNode.SetInputVolumeNodeID(ROIVolume.GetID())
-        parametersNode.SetOutputVolumeNodeID(cropVolume.GetID())
-        parametersNode.SetROINodeID(ROI.GetID())
-        parametersNode.SetVoxelBased(True)
-        slicer.mrmlScene.AddNode(parametersNode)
-        cropLogic.SnapROIToVoxelGrid(parametersNode)
-        cropLogic.Apply(parametersNode)
-
-        # Binarizar volume
-        self.progressBar.value = 90
-        slicer.app.processEvents()
-        resultVolume = volumeLogic.CloneVolume(slicer.mrmlScene, cropVolume, 'Result Volume')
-        resultVolume.SetName('Result Volume')
-        arrayResult = slicer.util.array(resultVolume.GetName())
-        arrayResult[arrayResult < ITrab] = 0
-        arrayResult[arrayResult >= ITrab] = Max
+        call = self.startBackground(TrabeculadoOsseoLib.binarizedROI, volumeArray, labelArray, ROIValue, result, roiPadding, backend)
+        yield call
+        arrayResult = call.result()
+        if arrayResult is None:
+            raise ValueError('Label da ROI nao encontrado na mascara')
+        roiExtent = TrabeculadoOsseoLib.roiCropExtent(result, volumeArray.shape, roiPadding)
+        resultVolume = SceneNodes.createVolumeFromArray(arrayResult, invertVolume, roiExtent, 'Result Volume')
+        nodes.append(resultVolume)
+        if showROI:
+            nodes.append(SceneNodes.createROINode(invertVolume, roiExtent, 'ROI'))
         logging.info('Volume ROI Binario finished')
 
-        # Exibir o resultado
-        logging.info('Exibir resultado')
-        for color in ['Red', 'Yellow', 'Green']:
-            slicer.app.layoutManager().sliceWidget(color).sliceLogic().GetSliceCompositeNode().SetBackgroundVolumeID(resultVolume.GetID())
-
-        self.exportButton.enabled = True
-        self.resultButton.enabled = True
-        self.progressBar.value = 100
-        slicer.app.processEvents()
-
-        logging.info('Processing finished')
-
-        return True
+        self.showResultVolume(resultVolume)
+        state["result"] = result
 
 class TrabeculadoOsseoTest(ScriptedLoadableModuleTest):
     def setUp(self):
@@ -393,6 +766,433 @@ class TrabeculadoOsseoTest(ScriptedLoadableModuleTest):
     def runTest(self):
         self.setUp()
         self.test_TrabeculadoOsseo1()
+        self.test_TrabeculadoOsseoILow()
+        self.test_TrabeculadoOsseoHistogram()
+        self.test_TrabeculadoOsseoIncremental()
+        self.test_TrabeculadoOsseoROICrop()
+        self.test_TrabeculadoOsseoCast()
+        self.test_TrabeculadoOsseoBitDepth()
+        self.test_TrabeculadoOsseoKernels()
+        self.test_TrabeculadoOsseoRegions()
+        self.test_TrabeculadoOsseoMaskExport()
+        self.test_TrabeculadoOsseoResultStore()
+        self.test_TrabeculadoOsseoWorkQueue()
+        self.test_TrabeculadoOsseoExamPairing()
 
     def test_TrabeculadoOsseo1(self):
-        pass
+        # Sem bias e sem ruido o FVTO coincide com a fracao de osso do fantoma
+        for bitDepth in TrabeculadoOsseoLib.PHANTOM_BIT_DEPTHS:
+            phantom = TrabeculadoOsseoLib.makePhantom((80, 80, 80), bitDepth, boneFraction=0.3, seed=1)
+            result = TrabeculadoOsseoLib.run(phantom.volumeArray.astype(numpy.int32), phantom.labelArray, phantom.ROIValue, phantom.cortValue)
+            self.assertEqual(result.Max, phantom.truth["Max"])
+            self.assertAlmostEqual(result.FVTO, phantom.truth["FVTO"], places=6)
+
+        # A regra legacy compara a posicao do bin com a metade da contagem do pico: em 16 bits
+        # e com uma ROI pequena (48^3), o histograma de dois niveis leva o ILow ao bin do osso
+        phantom = TrabeculadoOsseoLib.makePhantom((48, 48, 48), 16, boneFraction=0.3, seed=1)
+        volumeArray = phantom.volumeArray.astype(numpy.int32)
+        with numpy.errstate(divide='ignore'):
+            result = TrabeculadoOsseoLib.run(volumeArray, phantom.labelArray, phantom.ROIValue, phantom.cortValue)
+        self.assertEqual(result.ILow, result.Max - phantom.truth["boneValue"])
+        self.assertFalse(numpy.isfinite(result.FVTO))
+        # A regra falling nao depende do tamanho: ILow no bin seguinte ao pico da medula
+        result = TrabeculadoOsseoLib.run(volumeArray, phantom.labelArray, phantom.ROIValue, phantom.cortValue, ILowRule=TrabeculadoOsseoLib.ILOW_RULE_FALLING)
+        self.assertAlmostEqual(result.FVTO, phantom.truth["FVTO"], places=3)
+
+        # Com bias e ruido o erro continua limitado
+        phantom = TrabeculadoOsseoLib.makePhantom((48, 48, 48), 12, boneFraction=0.3, biasAmplitude=0.2, noiseSigma=0.02, seed=1)
+        from TrabeculadoOsseoLib import Benchmark
+        result, profile, summary = Benchmark.benchmarkPhantom(phantom)
+        self.assertLess(abs(summary["FVTOError"]), 0.1)
+        self.assertEqual(summary["voxels"], 48 ** 3)
+        self.assertTrue(summary["stageSeconds"])
+
+    def test_TrabeculadoOsseoILow(self):
+        # Histogramas gravados e o ILow obtido com a busca original (lista ordenada + index)
+        recorded = [
+            ([3, 2, 16, 17, 23, 19, 29, 34, 25, 27, 28, 24, 20, 13, 26, 11, 15, 7, 12, 8, 7, 10, 2, 4, 2, 3, 3, 2, 2, 1, 1, 1, 1, 0, 0, 0, 1, 0, 1], 3),
+            ([0, 0, 0, 0, 1, 3, 4, 6, 16, 17, 14, 14, 27, 23, 31, 22, 20, 23, 24, 12, 19, 12, 15, 21, 7, 12, 9, 5, 4, 5, 9, 6, 6, 2, 4, 1, 2, 2, 0, 0, 1, 0, 1], 8),
+            ([0, 2, 4, 8, 4, 2, 0], 2),
+            ([1, 3, 5, 10, 7, 5, 1], 2),
+            ([5, 9, 10, 9, 5], 0),
+        ]
+        for ocorrencias, ILow in recorded:
+            self.assertEqual(TrabeculadoOsseoLib.findILow(numpy.array(ocorrencias)), ILow)
+
+        # Bin mais proximo da metade do pico antes e depois do pico
+        ocorrencias = numpy.array([0, 2, 4, 8, 4, 2, 0])
+        self.assertEqual(TrabeculadoOsseoLib.findILow(ocorrencias, TrabeculadoOsseoLib.ILOW_RULE_RISING), 2)
+        self.assertEqual(TrabeculadoOsseoLib.findILow(ocorrencias, TrabeculadoOsseoLib.ILOW_RULE_FALLING), 4)
+
+    def test_TrabeculadoOsseoHistogram(self):
+        # Com offset 0 e largura 1 o histograma e o mesmo do bincount original
+        values = numpy.array([0, 3, 3, 5, 255], dtype=numpy.int32)
+        histogram = TrabeculadoOsseoLib.IntegerHistogram(maxValue=255)
+        histogram.add(values)
+        self.assertTrue(numpy.array_equal(histogram.counts, numpy.bincount(values)))
+
+        # Valores negativos deslocam o offset e valores acima do maximo vao para overflow
+        histogram.add(numpy.array([-2, 300]))
+        self.assertEqual(histogram.offset, -2)
+        self.assertEqual(histogram.overflow, 1)
+        self.assertEqual(histogram.total(), 7)
+
+        # Histogramas parciais somados dao o mesmo resultado de uma unica passada
+        values = numpy.arange(-10, 50) % 23 - 5
+        whole = TrabeculadoOsseoLib.IntegerHistogram(binWidth=4)
+        whole.add(values)
+        merged = TrabeculadoOsseoLib.IntegerHistogram(binWidth=4)
+        merged.add(values[30:])
+        partial = TrabeculadoOsseoLib.IntegerHistogram(binWidth=4)
+        partial.add(values[:30])
+        merged.merge(partial)
+        self.assertEqual(merged.offset, whole.offset)
+        self.assertTrue(numpy.array_equal(merged.counts, whole.counts))
+
+        # Com offset None os bins comecam no menor valor; o ILow e o mesmo do histograma a partir de 0
+        fitted = TrabeculadoOsseoLib.IntegerHistogram(binWidth=4, offset=None)
+        fitted.add(numpy.array([2 ** 20 + 9, 2 ** 20 + 3]))
+        fitted.add(numpy.array([2 ** 20 - 6]))
+        self.assertEqual((fitted.offset, fitted.counts.size), (2 ** 20 - 8, 5))
+        random = numpy.random.RandomState(7)
+        for trial in range(200):
+            ocorrencias = random.randint(0, 6, size=random.randint(1, 12))
+            ocorrencias[random.randint(ocorrencias.size)] += 1
+            leadingBins = random.randint(0, 4)
+            padded = numpy.concatenate([numpy.zeros(leadingBins, dtype=ocorrencias.dtype), ocorrencias])
+            for rule in TrabeculadoOsseoLib.ILOW_RULES:
+                self.assertEqual(TrabeculadoOsseoLib.findILow(ocorrencias, rule, leadingBins), TrabeculadoOsseoLib.findILow(padded, rule))
+
+    def test_TrabeculadoOsseoIncremental(self):
+        # Recalcular sobre o volume ja invertido da o mesmo resultado do calculo completo
+        phantom = TrabeculadoOsseoLib.makePhantom((32, 32, 32), 12, boneFraction=0.3, biasAmplitude=0.1, noiseSigma=0.02, seed=2)
+        volumeArray = phantom.volumeArray.astype(numpy.int32)
+        expected = TrabeculadoOsseoLib.run(volumeArray, phantom.labelArray, phantom.ROIValue, phantom.cortValue)
+        Max = TrabeculadoOsseoLib.invertVolumeArray(volumeArray)
+        result = TrabeculadoOsseoLib.runInverted(volumeArray, phantom.labelArray, phantom.ROIValue, phantom.cortValue, Max)
+        self.assertEqual(result.asRow(), expected.asRow())
+        self.assertEqual(result.roiExtent, expected.roiExtent)
+
+        # A chave de cada etapa inclui a anterior: mudar o N4 invalida o Cast, mudar os labels nao
+        pipelineState = TrabeculadoOsseoLib.PipelineState()
+        n4Key = ('N4ITK', 'volume', {"shrinkFactor": 4})
+        castKey = ('Cast', n4Key)
+        pipelineState.store('N4ITK', n4Key, ('n4',))
+        pipelineState.store('Cast', castKey, ('cast',))
+        self.assertEqual(pipelineState.lookup('Cast', ('Cast', ('N4ITK', 'volume', {"shrinkFactor": 4}))), ('cast',))
+        self.assertIsNone(pipelineState.lookup('Cast', ('Cast', ('N4ITK', 'volume', {"shrinkFactor": 2}))))
+        self.assertIsNone(pipelineState.lookup('N4ITK', n4Key, lambda outputs: False))
+        self.assertIsNone(pipelineState.lookup('N4ITK', n4Key))
+
+    def test_TrabeculadoOsseoROICrop(self):
+        # O corte e feito nos limites do label da ROI, com a margem limitada ao volume
+        phantom = TrabeculadoOsseoLib.makePhantom((32, 32, 32), 12, boneFraction=0.3, seed=3)
+        volumeArray = phantom.volumeArray.astype(numpy.int32)
+        Max = TrabeculadoOsseoLib.invertVolumeArray(volumeArray)
+        result = TrabeculadoOsseoLib.runInverted(volumeArray, phantom.labelArray, phantom.ROIValue, phantom.cortValue, Max)
+        self.assertEqual(result.roiExtent, TrabeculadoOsseoLib.labelExtent(phantom.labelArray, [phantom.ROIValue]))
+        for padding in (0, 2, 100):
+            extent = TrabeculadoOsseoLib.roiCropExtent(result, volumeArray.shape, padding)
+            self.assertEqual(extent, TrabeculadoOsseoLib.padExtent(result.roiExtent, padding, volumeArray.shape))
+            box = TrabeculadoOsseoLib.extentSlices(extent)
+            expected = numpy.where((phantom.labelArray[box] == phantom.ROIValue) & (volumeArray[box] >= result.ITrab), Max, 0)
+            resultArray = TrabeculadoOsseoLib.binarizedROI(volumeArray, phantom.labelArray, phantom.ROIValue, result, padding)
+            numpy.testing.assert_array_equal(resultArray, expected)
+            maskArray = TrabeculadoOsseoLib.binarizedROIMask(volumeArray, phantom.labelArray, phantom.ROIValue, result, padding=padding)
+            numpy.testing.assert_array_equal(maskArray, expected != 0)
+
+        # O corte nao altera o volume invertido
+        self.assertEqual(TrabeculadoOsseoLib.runInverted(volumeArray, phantom.labelArray, phantom.ROIValue, phantom.cortValue, Max).asRow(), result.asRow())
+
+    def test_TrabeculadoOsseoCast(self):
+        # Cast e inversao em NumPy iguais ao Cast (Int) seguido da inversao, inclusive com valores reais e negativos
+        phantom = TrabeculadoOsseoLib.makePhantom((24, 24, 24), 12, boneFraction=0.3, biasAmplitude=0.1, noiseSigma=0.02, seed=4)
+        n4Array = phantom.volumeArray.astype(numpy.float32) * 1.37 - 2.5
+        expected = TrabeculadoOsseoLib.castArray(n4Array)
+        Max = TrabeculadoOsseoLib.invertVolumeArray(expected)
+        volumeArray, castMax = TrabeculadoOsseoLib.castAndInvertArray(n4Array, slabSize=5)
+        self.assertEqual(castMax, Max)
+        self.assertEqual(volumeArray.dtype, numpy.int32)
+        numpy.testing.assert_array_equal(volumeArray, expected)
+
+        from TrabeculadoOsseoLib import Benchmark
+        self.assertTrue(Benchmark.benchmarkCast(n4Array)["castEqual"])
+
+    def test_TrabeculadoOsseoBitDepth(self):
+        # Faixas pelos dados iguais as do modulo original; acima de 16 bits, o menor numero de bits
+        for maxValue, bits in ((0, 8), (255, 8), (256, 12), (4095, 12), (4096, 14), (16383, 14), (16384, 16), (65535, 16), (70000, 17)):
+            self.assertEqual(TrabeculadoOsseoLib.bitsForValue(maxValue), bits)
+            self.assertEqual(TrabeculadoOsseoLib.detectMaxValue(numpy.array([maxValue])), 2 ** bits - 1)
+
+        # Ordem: override, BitsStored dos metadados, tipo escalar e dados
+        volumeArray = numpy.array([[[3, 1000], [7, 2]]], dtype=numpy.int16)
+        metadata = {"0028|0101": "12"}
+        bitDepth = TrabeculadoOsseoLib.resolveBitDepth(volumeArray, override=16, metadata=metadata)
+        self.assertEqual((bitDepth.bits, bitDepth.source), (16, TrabeculadoOsseoLib.BIT_DEPTH_SOURCE_OVERRIDE))
+        bitDepth = TrabeculadoOsseoLib.resolveBitDepth(volumeArray, metadata=metadata)
+        self.assertEqual((bitDepth.Max, bitDepth.source), (4095, TrabeculadoOsseoLib.BIT_DEPTH_SOURCE_METADATA))
+        bitDepth = TrabeculadoOsseoLib.resolveBitDepth(volumeArray.astype(numpy.uint8))
+        self.assertEqual((bitDepth.Max, bitDepth.source), (255, TrabeculadoOsseoLib.BIT_DEPTH_SOURCE_SCALAR_TYPE))
+        bitDepth = TrabeculadoOsseoLib.resolveBitDepth(volumeArray)
+        self.assertEqual((bitDepth.Max, bitDepth.source, bitDepth.minValue, bitDepth.maxValue), (4095, TrabeculadoOsseoLib.BIT_DEPTH_SOURCE_DATA, 2, 1000))
+
+        # BitsStored que nao cobre o maior voxel e ignorado; override que nao cobre e um erro
+        bitDepth = TrabeculadoOsseoLib.resolveBitDepth(metadata={"BitsStored": "8"}, valueRange=(0, 1000))
+        self.assertEqual((bitDepth.Max, bitDepth.source), (4095, TrabeculadoOsseoLib.BIT_DEPTH_SOURCE_DATA))
+        self.assertRaises(ValueError, TrabeculadoOsseoLib.resolveBitDepth, override=8, valueRange=(0, 1000))
+
+        # A faixa lida fica no cache e nao e lida de novo
+        cache = TrabeculadoOsseoLib.ValueRangeCache()
+        self.assertEqual(TrabeculadoOsseoLib.scanValueRange(volumeArray, slabSize=1, cache=cache, cacheKey="exame"), (2, 1000))
+        self.assertEqual(TrabeculadoOsseoLib.scanValueRange(numpy.zeros((1, 1, 1)), cache=cache, cacheKey="exame"), (2, 1000))
+
+        # Acima de 16 bits o Max cobre o volume (antes ficava 0)
+        n4Array = numpy.array([[[0.5, 70000.0], [12.0, 65536.0]]], dtype=numpy.float32)
+        invertedArray, Max = TrabeculadoOsseoLib.castAndInvertArray(n4Array)
+        self.assertEqual(Max, 2 ** 17 - 1)
+        numpy.testing.assert_array_equal(invertedArray, Max - TrabeculadoOsseoLib.castArray(n4Array))
+        invertedArray, Max = TrabeculadoOsseoLib.castAndInvertArray(n4Array, bitDepth=18)
+        self.assertEqual(Max, 2 ** 18 - 1)
+
+        # Profundidade informada menor que a dos dados: ValueError em vez de voxels invertidos negativos
+        phantom = TrabeculadoOsseoLib.makePhantom((16, 16, 16), 12, boneFraction=0.3, seed=5)
+        self.assertRaises(ValueError, TrabeculadoOsseoLib.castAndInvertArray, phantom.volumeArray, slabSize=4, bitDepth=8)
+        self.assertRaises(ValueError, TrabeculadoOsseoLib.invertVolumeArray, phantom.volumeArray.copy(), bitDepth=8)
+        self.assertRaises(ValueError, TrabeculadoOsseoLib.run, phantom.volumeArray, phantom.labelArray, phantom.ROIValue, phantom.cortValue, bitDepth=8)
+        self.assertRaises(ValueError, TrabeculadoOsseoLib.castInvertAndRun, phantom.volumeArray, phantom.labelArray, phantom.ROIValue, phantom.cortValue, bitDepth=8)
+        expected = TrabeculadoOsseoLib.run(phantom.volumeArray, phantom.labelArray, phantom.ROIValue, phantom.cortValue)
+        self.assertEqual(TrabeculadoOsseoLib.run(phantom.volumeArray, phantom.labelArray, phantom.ROIValue, phantom.cortValue, bitDepth=12).asRow(), expected.asRow())
+
+    def test_TrabeculadoOsseoKernels(self):
+        # Nucleos compilados iguais ao NumPy: Cast, inversao, estatisticas e binarizacao
+        if not TrabeculadoOsseoLib.numbaAvailable():
+            self.assertEqual(TrabeculadoOsseoLib.resolveKernelBackend(TrabeculadoOsseoLib.KERNEL_BACKEND_AUTO), TrabeculadoOsseoLib.KERNEL_BACKEND_NUMPY)
+            self.assertRaises(ImportError, TrabeculadoOsseoLib.resolveKernelBackend, TrabeculadoOsseoLib.KERNEL_BACKEND_NUMBA)
+            self.delayDisplay('Numba nao instalado: so o backend numpy foi testado')
+            return
+        numba = TrabeculadoOsseoLib.KERNEL_BACKEND_NUMBA
+        phantom = TrabeculadoOsseoLib.makePhantom((30, 32, 34), 12, boneFraction=0.3, biasAmplitude=0.1, noiseSigma=0.02, seed=6)
+        for n4Array in (phantom.volumeArray.astype(numpy.float32) * 1.37 - 2.5, phantom.volumeArray.astype(numpy.int32) * 20):
+            for cortValue, binWidth in ((phantom.cortValue, 1), (phantom.ROIValue, 3)):
+                expectedArray, expected = TrabeculadoOsseoLib.castInvertAndRun(n4Array, phantom.labelArray, phantom.ROIValue, cortValue, slabSize=7, histogramBinWidth=binWidth)
+                volumeArray, result = TrabeculadoOsseoLib.castInvertAndRun(n4Array, phantom.labelArray, phantom.ROIValue, cortValue, slabSize=7, histogramBinWidth=binWidth, backend=numba)
+                numpy.testing.assert_array_equal(volumeArray, expectedArray)
+                self.assertEqual(result.asRow(), expected.asRow())
+                self.assertEqual((result.Max, result.roiExtent), (expected.Max, expected.roiExtent))
+                numpy.testing.assert_array_equal(result.histogram, expected.histogram)
+
+                castArray = TrabeculadoOsseoLib.castArray(n4Array)
+                self.assertEqual(TrabeculadoOsseoLib.run(castArray, phantom.labelArray, phantom.ROIValue, cortValue, histogramBinWidth=binWidth, backend=numba).asRow(), expected.asRow())
+                numpy.testing.assert_array_equal(TrabeculadoOsseoLib.castAndInvertArray(n4Array, backend=numba)[0], expectedArray)
+                for padding in (0, 3):
+                    numpy.testing.assert_array_equal(TrabeculadoOsseoLib.binarizedROI(expectedArray, phantom.labelArray, phantom.ROIValue, expected, padding, numba),
+                                                     TrabeculadoOsseoLib.binarizedROI(expectedArray, phantom.labelArray, phantom.ROIValue, expected, padding))
+                    numpy.testing.assert_array_equal(TrabeculadoOsseoLib.binarizedROIMask(expectedArray, phantom.labelArray, phantom.ROIValue, expected, padding=padding, backend=numba),
+                                                     TrabeculadoOsseoLib.binarizedROIMask(expectedArray, phantom.labelArray, phantom.ROIValue, expected, padding=padding))
+
+        # Voxels negativos na ROI apos a inversao: as estatisticas voltam ao NumPy
+        volumeArray = phantom.volumeArray.astype(numpy.int32)
+        volumeArray[::3] += 5000
+        expected = TrabeculadoOsseoLib.runInverted(volumeArray, phantom.labelArray, phantom.ROIValue, phantom.cortValue, 4095)
+        result = TrabeculadoOsseoLib.runInverted(volumeArray, phantom.labelArray, phantom.ROIValue, phantom.cortValue, 4095, backend=numba)
+        self.assertEqual(result.asRow(), expected.asRow())
+        numpy.testing.assert_array_equal(result.histogram, expected.histogram)
+
+        # Acima de 16 bits o histograma cobre so a faixa da ROI, mesmo com um voxel de 2**26 fora dela
+        n4Array = phantom.volumeArray.astype(numpy.int32) + 2 ** 20
+        n4Array[phantom.labelArray == 0] = 7
+        n4Array[0, 0, 0] = 2 ** 26
+        for ILowRule in TrabeculadoOsseoLib.ILOW_RULES:
+            expectedArray, expected = TrabeculadoOsseoLib.castInvertAndRun(n4Array, phantom.labelArray, phantom.ROIValue, phantom.cortValue, slabSize=7, ILowRule=ILowRule)
+            volumeArray, result = TrabeculadoOsseoLib.castInvertAndRun(n4Array, phantom.labelArray, phantom.ROIValue, phantom.cortValue, slabSize=7, ILowRule=ILowRule, backend=numba)
+            self.assertEqual(expected.Max, 2 ** 27 - 1)
+            self.assertEqual(result.asRow(), expected.asRow())
+            numpy.testing.assert_array_equal(result.histogram, expected.histogram)
+            self.assertLessEqual(expected.histogram.size, 4096)
+        volumeArray = phantom.volumeArray.astype(numpy.int32) + 2 ** 20
+        volumeArray[::3] += 2 ** 21
+        expected = TrabeculadoOsseoLib.runInverted(volumeArray, phantom.labelArray, phantom.ROIValue, phantom.cortValue, 2 ** 21 - 1)
+        result = TrabeculadoOsseoLib.runInverted(volumeArray, phantom.labelArray, phantom.ROIValue, phantom.cortValue, 2 ** 21 - 1, backend=numba)
+        self.assertEqual(result.asRow(), expected.asRow())
+        numpy.testing.assert_array_equal(result.histogram, expected.histogram)
+
+    def test_TrabeculadoOsseoRegions(self):
+        # Duas ROIs no mesmo mapa: cada uma igual ao calculo com um unico label
+        phantom = TrabeculadoOsseoLib.makePhantom((40, 40, 40), 12, boneFraction=0.3, biasAmplitude=0.1, noiseSigma=0.02, seed=3)
+        labelArray = phantom.labelArray.copy()
+        upper = labelArray[20:]
+        upper[upper == phantom.ROIValue] = 5
+        volumeArray = phantom.volumeArray.astype(numpy.int32)
+        expected = dict((value, TrabeculadoOsseoLib.run(volumeArray, labelArray, value, phantom.cortValue)) for value in (phantom.ROIValue, 5))
+
+        Max = TrabeculadoOsseoLib.invertVolumeArray(volumeArray)
+        regions = TrabeculadoOsseoLib.runRegions(volumeArray, labelArray, phantom.cortValue, Max, axis=0)
+        self.assertEqual(sorted(regions.results), [phantom.ROIValue, 5])
+        for value in (phantom.ROIValue, 5):
+            self.assertEqual(regions.results[value].asRow(), expected[value].asRow())
+
+        # O ITrab do label e a media dos ITrab das fatias ponderada pelos voxels
+        sliceRows = [row for row in regions.rows() if row[0] == 5 and row[1] == "K"]
+        self.assertEqual(min(row[2] for row in sliceRows), 20)
+        ITrab = sum(row[3] * row[5] for row in sliceRows) / float(sum(row[3] for row in sliceRows))
+        self.assertAlmostEqual(ITrab, expected[5].ITrab, places=6)
+
+    def test_TrabeculadoOsseoMaskExport(self):
+        # A mascara 0/Max volta como 0/1 com a mesma geometria nos dois formatos
+        import shutil, tempfile
+        resultArray = (numpy.arange(6 * 7 * 9).reshape(6, 7, 9) % 3 == 0).astype(numpy.int32) * 4095
+        matrix = [[-0.5, 0, 0, 10], [0, -0.5, 0, 20], [0, 0, 0.8, 30], [0, 0, 0, 1]]
+        geometry = TrabeculadoOsseoLib.geometryFromIJKToRAS(matrix)
+        directory = tempfile.mkdtemp()
+        try:
+            for fileFormat in TrabeculadoOsseoLib.MASK_FORMATS:
+                item = TrabeculadoOsseoLib.MaskExportItem('Exame Result Volume', resultArray, geometry, [1, 2, 3, 0.5])
+                row, = TrabeculadoOsseoLib.exportMasks([item], directory, fileFormat)
+                self.assertEqual(row[5], int(numpy.count_nonzero(resultArray)))
+                mask = TrabeculadoOsseoLib.readMask(os.path.join(directory, row[1]))
+                self.assertTrue(numpy.array_equal(mask.array, resultArray != 0))
+                self.assertEqual(list(mask.origin), [-10.0, -20.0, 30.0])
+                self.assertEqual(list(mask.spacing), [0.5, 0.5, 0.8])
+            with open(os.path.join(directory, TrabeculadoOsseoLib.MANIFEST_NAME)) as manifestFile:
+                self.assertEqual(len(manifestFile.readlines()), 1 + len(TrabeculadoOsseoLib.MASK_FORMATS))
+        finally:
+            shutil.rmtree(directory)
+
+    def test_TrabeculadoOsseoResultStore(self):
+        # Linhas gravadas antes de uma falha sao lidas de volta e os exames sao pulados ao retomar
+        import shutil, tempfile
+        columns = ["Volume"] + TrabeculadoOsseoLib.FVTOResult.columnNames + ["N4"]
+        directory = tempfile.mkdtemp()
+        try:
+            for fileName in ("result.csv", "result.sqlite"):
+                path = os.path.join(directory, fileName)
+                store = TrabeculadoOsseoLib.ResultStore(path, columns)
+                store.append(["exame1", 3000.5, 2900.25, 2800, numpy.float64(0.5), "none"])
+                store.close()
+                if fileName.endswith(".csv"):
+                    # Linha interrompida no meio da gravacao
+                    with open(path, "a") as tableFile:
+                        tableFile.write("exame2;30")
+
+                store = TrabeculadoOsseoLib.ResultStore(path, columns, resume=True)
+                self.assertTrue(store.isCompleted("exame1"))
+                self.assertFalse(store.isCompleted("exame2"))
+                store.append(["exame2", 3001.5, 2901.25, 2801, 0.25, "none"])
+                self.assertEqual(store.rows(), [["exame1", 3000.5, 2900.25, 2800, 0.5, "none"], ["exame2", 3001.5, 2901.25, 2801, 0.25, "none"]])
+                store.close()
+
+                # Sem retomar, a tabela comeca vazia
+                store = TrabeculadoOsseoLib.ResultStore(path, columns)
+                self.assertEqual(store.rows(), [])
+                store.close()
+        finally:
+            shutil.rmtree(directory)
+
+    def test_TrabeculadoOsseoWorkQueue(self):
+        # Cada tarefa e entregue a um so worker, falhas voltam ate maxAttempts e reservas expiram
+        import shutil, tempfile
+        from TrabeculadoOsseoLib import WorkQueue
+        directory = tempfile.mkdtemp()
+        try:
+            queues = [WorkQueue.FileWorkQueue(os.path.join(directory, "fila"), maxAttempts=2),
+                      WorkQueue.RedisWorkQueue(WorkQueue.LocalRedis(), maxAttempts=2)]
+            for queue in queues:
+                self.assertTrue(queue.submit("exame 1", {"name": "exame 1"}))
+                self.assertTrue(queue.submit("exame/2", {"name": "exame/2"}))
+                self.assertFalse(queue.submit("exame 1", {"name": "exame 1"}))
+
+                first = queue.claim("worker1")
+                second = queue.claim("worker2")
+                self.assertEqual(sorted([first.taskId, second.taskId]), ["exame 1", "exame/2"])
+                self.assertIsNone(queue.claim("worker3"))
+
+                # A primeira falha volta para a fila; a segunda esgota as tentativas
+                queue.complete(first, {"row": [first.taskId, 1.5]})
+                queue.fail(second, "erro")
+                retry = queue.claim("worker1")
+                self.assertEqual((retry.taskId, retry.attempts), (second.taskId, 2))
+                queue.fail(retry, "erro")
+                self.assertIsNone(queue.claim("worker1"))
+                self.assertEqual(queue.counts(), {"pending": 0, "claimed": 0, "done": 1, "failed": 1})
+                self.assertEqual(queue.results(), [(first.taskId, {"row": [first.taskId, 1.5]})])
+                self.assertEqual(queue.failures(), [(second.taskId, "erro")])
+
+                # Reserva de um worker interrompido volta para a fila; a falha tardia dele e ignorada
+                queue.submit("exame 3", {"name": "exame 3"})
+                lost = queue.claim("worker1")
+                queue.leaseSeconds = 0
+                taken = queue.claim("worker2")
+                queue.leaseSeconds = WorkQueue.DEFAULT_LEASE_SECONDS
+                self.assertEqual((taken.taskId, taken.attempts), ("exame 3", 2))
+                queue.fail(lost, "worker interrompido")
+                self.assertEqual(queue.counts()["claimed"], 1)
+                queue.complete(taken, {"row": ["exame 3", 2.5]})
+                self.assertEqual(len(queue.results()), 2)
+
+                # Tarefa submetida ha mais tempo que a reserva: recem reservada, nao expira
+                queue.submit("exame 4", {"name": "exame 4"})
+                if isinstance(queue, WorkQueue.FileWorkQueue):
+                    pendingPath = queue._path("pending", "exame 4")
+                    os.utime(pendingPath, (time.time() - 7200, time.time() - 7200))
+                queue.leaseSeconds = 60
+                claimed = queue.claim("worker1")
+                queue.requeueExpired()
+                self.assertEqual(queue.counts()["claimed"], 1)
+                queue.complete(claimed, {"row": ["exame 4", 3.5]})
+                queue.leaseSeconds = WorkQueue.DEFAULT_LEASE_SECONDS
+
+                # Reserva renovada durante um exame demorado nao expira
+                queue.submit("exame 6", {"name": "exame 6"})
+                slow = queue.claim("worker1")
+                queue.leaseSeconds = 0.5
+                with WorkQueue.renewingLease(queue, slow, interval=0.05):
+                    time.sleep(0.8)
+                    queue.requeueExpired()
+                    self.assertIsNone(queue.claim("worker2"))
+
+                # Reserva que expirou ate esgotar as tentativas: a conclusao tardia retira a falha
+                queue.leaseSeconds = 0
+                queue.requeueExpired()
+                queue.claim("worker2")
+                queue.requeueExpired()
+                self.assertIn("exame 6", dict(queue.failures()))
+                self.assertFalse(queue.renew(slow))
+                queue.complete(slow, {"row": ["exame 6", 4.5]})
+                self.assertNotIn("exame 6", dict(queue.failures()))
+                self.assertIn("exame 6", dict(queue.results()))
+                queue.leaseSeconds = WorkQueue.DEFAULT_LEASE_SECONDS
+
+            # Worker interrompido entre retirar a tarefa da fila e registrar a reserva: volta para a fila
+            queue = queues[1]
+            queue.submit("exame 5", {"name": "exame 5"})
+            queue.client.rpoplpush(queue._key("pending"), queue._key("processing"))
+            self.assertEqual(queue.counts()["claimed"], 1)
+            queue.requeueExpired()
+            self.assertEqual(queue.counts()["claimed"], 1)
+            queue.leaseSeconds = 0
+            self.assertEqual(queue.claim("worker2").taskId, "exame 5")
+        finally:
+            shutil.rmtree(directory)
+
+    def test_TrabeculadoOsseoExamPairing(self):
+        # Volumes gerados em execucoes anteriores nao viram exames e os problemas vao para o relatorio
+        volumes = [("exame1", 1), ("exame2", 2), ("exame1 N4ITK", 3), ("exame1 Result Volume", 4), ("Inverted Volume", 5),
+                   ("exame3", 6), ("exame2", 7), ("exame4-label", 8)]
+        labels = [("exame1-label", 11), ("exame2-label", 12), ("outro-label", 13)]
+        index = TrabeculadoOsseoLib.buildExamIndex(volumes, labels)
+        self.assertEqual(index.exams, [("exame1", 1, 11), ("exame2", 2, 12)])
+        self.assertEqual(index.missingLabels, ["exame3"])
+        self.assertEqual(index.duplicates, ["exame2"])
+        self.assertEqual(index.derived, ["exame1 N4ITK", "exame1 Result Volume", "Inverted Volume"])
+        self.assertEqual(index.unusedLabels, ["exame4-label", "outro-label"])
+        self.assertFalse(index.isComplete())
+        self.assertIn("Volumes sem label (1): exame3", index.report())
+
+        # Outro padrao de nome e manifesto
+        index = TrabeculadoOsseoLib.buildExamIndex([("a", 1), ("mask_a", 2), ("b", 3)], pattern="mask_*")
+        self.assertEqual(index.exams, [("a", 1, 2)])
+        self.assertEqual(index.missingLabels, ["b"])
+        index = TrabeculadoOsseoLib.buildExamIndex([("a", 1), ("b", 3)], [("L1", 11)], manifest=[("a", "L1"), ("a", "L1"), ("c", "L1")])
+        self.assertEqual(index.exams, [("a", 1, 11)])
+        self.assertEqual(index.missingVolumes, ["c"])
+        self.assertRaises(ValueError, TrabeculadoOsseoLib.labelNameFor, "a", "label")
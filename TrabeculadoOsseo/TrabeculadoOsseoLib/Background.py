@@ -0,0 +1,52 @@
+import threading
+
+#
+# Execucao de etapas NumPy fora da thread da interface.
+#
+# BackgroundCall roda uma funcao em uma thread e pode ser consultado sem
+# bloquear (isDone) ate o resultado ficar pronto. A funcao nao deve acessar
+# a cena MRML nem Qt: recebe apenas arrays. O cancelamento e cooperativo:
+# funcoes que aceitam cancelEvent verificam o evento entre os slabs e
+# levantam PipelineCancelled.
+#
+
+class PipelineCancelled(Exception):
+    """Processamento interrompido pelo usuario."""
+
+def checkCancelled(cancelEvent):
+    if cancelEvent is not None and cancelEvent.is_set():
+        raise PipelineCancelled()
+
+class BackgroundCall(object):
+    """Chamada de function(*args, **kwargs) em uma thread separada."""
+
+    def __init__(self, function, args=(), kwargs=None, cancelEvent=None):
+        self.cancelEvent = cancelEvent
+        self.value = None
+        self.error = None
+        self.thread = threading.Thread(target=self._run, args=(function, args, kwargs or {}))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self, function, args, kwargs):
+        try:
+            self.value = function(*args, **kwargs)
+        except Exception as error:
+            self.error = error
+
+    def isDone(self):
+        return not self.thread.is_alive()
+
+    def progress(self):
+        return None
+
+    def cancel(self):
+        if self.cancelEvent is not None:
+            self.cancelEvent.set()
+
+    def result(self):
+        """Aguarda o fim da chamada e retorna o valor ou levanta o erro da funcao."""
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+        return self.value
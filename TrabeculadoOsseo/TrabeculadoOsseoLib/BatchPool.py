@@ -0,0 +1,31 @@
+import multiprocessing
+
+#
+# Dimensionamento do conjunto de processos usado no processamento em lote.
+#
+
+# Copias do volume (int32) que um exame mantem vivas durante o pipeline:
+# N4ITK, Cast, Inverted, ROI, Cropped e Result
+EXAM_VOLUME_COPIES = 6
+EXAM_BYTES_PER_VOXEL = 4
+
+def defaultWorkerCount():
+    """Um processo por nucleo."""
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+def estimateExamBytes(voxelCount, bytesPerVoxel=EXAM_BYTES_PER_VOXEL, copies=EXAM_VOLUME_COPIES):
+    """Memoria aproximada que um exame ocupa durante o processamento."""
+    return int(voxelCount) * bytesPerVoxel * copies
+
+def workerCountForBudget(workerCount, memoryBudgetBytes, examBytes):
+    """
+    Limita o numero de processos simultaneos ao orcamento de memoria.
+    memoryBudgetBytes igual a 0 (ou None) desativa o limite. Sempre retorna pelo menos 1.
+    """
+    workerCount = max(1, int(workerCount))
+    if memoryBudgetBytes and examBytes > 0:
+        workerCount = min(workerCount, int(memoryBudgetBytes // examBytes))
+    return max(1, workerCount)
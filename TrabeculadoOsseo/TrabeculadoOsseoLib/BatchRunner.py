@@ -0,0 +1,454 @@
+#
+# Execucao em lote pela linha de comando, sem a cena do Slicer.
+#
+# Le um diretorio (pares <nome>.nrrd / <nome>-label.nrrd, ou .nii/.nii.gz)
+# ou um manifesto CSV (colunas volume,label e opcionalmente name), carrega
+# um exame por vez, calcula o FVTO e grava a tabela de resultados e os
+# volumes binarizados. Com --regions, grava tambem uma tabela em formato
+# longo com o FVTO de cada label (e de cada fatia com --slice-axis).
+# Cada exame e gravado na tabela assim que termina; com --resume os exames
+# ja presentes na tabela sao pulados.
+#
+# Com --queue, os exames passam por uma fila de trabalho (diretorio
+# compartilhado ou Redis) e podem ser processados por varias maquinas: cada
+# maquina roda o mesmo comando (com --queue-role work nas que so processam),
+# os exames que falham sao tentados de novo e, no fim, os resultados de
+# todas sao reunidos em uma unica tabela (--queue-role collect). Os caminhos
+# dos exames e o diretorio de saida devem ser acessiveis por todas as maquinas.
+#
+# Uso:
+#   python TrabeculadoOsseoLib/BatchRunner.py exames/ -o saida/ --roi-label 1 --cort-label 2
+#   python TrabeculadoOsseoLib/BatchRunner.py exames/ -o saida/ --roi-label 1 --cort-label 2 --regions --slice-axis K
+#   Slicer --no-main-window --python-script TrabeculadoOsseoLib/BatchRunner.py exames/ -o saida/ ...
+#   python TrabeculadoOsseoLib/BatchRunner.py exames/ -o saida/ --roi-label 1 --cort-label 2 --queue /compartilhado/fila
+#   python TrabeculadoOsseoLib/BatchRunner.py -o saida/ --roi-label 1 --cort-label 2 --queue redis://servidor:6379/0 --queue-role work
+#
+
+import argparse
+import csv
+import logging
+import os
+import sys
+import time
+
+if __name__ == "__main__" and not __package__:
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from TrabeculadoOsseoLib import FVTOCore, VolumeIO, BiasCorrection, Cache, Profiling, OutOfCore, Regions, Persistence, WorkQueue, ExamPairing, Kernels, BitDepthDetection
+
+RESULT_COLUMNS = ["Volume"] + FVTOCore.FVTOResult.columnNames + ["N4"]
+REGION_COLUMNS = ["Volume"] + Regions.RegionResults.columnNames
+
+QUEUE_ROLES = ("all", "submit", "work", "collect")
+
+class Exam(object):
+    """Par volume / label map de um exame, ainda nao carregado."""
+
+    def __init__(self, name, volumePath, labelPath):
+        self.name = name
+        self.volumePath = volumePath
+        self.labelPath = labelPath
+
+    def __repr__(self):
+        return "Exam(%r)" % self.name
+
+def findExams(directory, labelSuffix="-label"):
+    """
+    Pares <nome>.<ext> e <nome><labelSuffix>.<ext> do diretorio, em ordem
+    alfabetica. Volumes gerados pelo processamento (Result Volume...) sao ignorados.
+    """
+    volumes = []
+    for fileName in sorted(os.listdir(directory)):
+        path = os.path.join(directory, fileName)
+        if VolumeIO.isVolumeFile(path):
+            volumes.append((VolumeIO.splitVolumeExtension(path)[0], path))
+    index = ExamPairing.buildExamIndex(volumes, pattern="*" + labelSuffix)
+    if not index.isComplete():
+        logging.warning(index.report())
+    return [Exam(name, volumePath, labelPath) for name, volumePath, labelPath in index.exams]
+
+def readManifest(manifestPath):
+    """Exames de um CSV com as colunas volume, label e (opcional) name."""
+    baseDirectory = os.path.dirname(os.path.abspath(manifestPath))
+    exams = []
+    with open(manifestPath) as manifestFile:
+        for row in csv.DictReader(manifestFile):
+            volumePath = os.path.join(baseDirectory, row["volume"])
+            labelPath = os.path.join(baseDirectory, row["label"])
+            name = row.get("name") or VolumeIO.splitVolumeExtension(volumePath)[0]
+            exams.append(Exam(name, volumePath, labelPath))
+    return exams
+
+def cropImage(image, labelArray, labelValues, margin):
+    """Recorta a imagem e o label nos limites dos labels (com margem) antes do N4."""
+    extent = FVTOCore.labelExtent(labelArray, labelValues)
+    if extent is None:
+        raise ValueError("Labels %r nao encontrados" % (list(labelValues),))
+    extent = FVTOCore.padExtent(extent, margin, labelArray.shape)
+    (kMin, kMax), (jMin, jMax), (iMin, iMax) = extent
+    return image[iMin:iMax + 1, jMin:jMax + 1, kMin:kMax + 1], labelArray[FVTOCore.extentSlices(extent)]
+
+def resultPath(outputDirectory, exam):
+    """Caminho do volume binarizado do exame."""
+    return os.path.join(outputDirectory, exam.name + " Result Volume.nrrd")
+
+def processExam(exam, ROIValue, cortValue, outputDirectory=None, skipN4=False, ILowRule=FVTOCore.ILOW_RULE_LEGACY, cache=None, cropMargin=None, profile=None, n4Settings=None, regionRows=None, sliceAxis=None, backend=Kernels.KERNEL_BACKEND_NUMPY, bitDepth=None):
+    """
+    Carrega, processa e descarta um exame. Retorna o FVTOResult.
+    Com cache, exames inalterados nao sao recalculados e o N4 e reaproveitado.
+    Com cropMargin, o N4 e o restante rodam apenas no recorte dos labels.
+    Com profile (StageProfile), registra o tempo e a memoria de cada etapa.
+    n4Settings (N4Settings) define os parametros do N4; None usa o preset default.
+    Com regionRows (lista), acrescenta as linhas de Regions.runRegions (todos os
+    labels e, com sliceAxis 0/1/2, o perfil por fatia), precedidas do nome do exame;
+    nao pode ser combinado com cropMargin.
+    backend escolhe os nucleos de calculo (Kernels); o resultado e o mesmo.
+    bitDepth (bits) define o Max da inversao; sem ele, vale o BitsStored do
+    arquivo (so com skipN4, ja que o N4 muda a faixa) ou a faixa dos dados.
+    """
+    if cropMargin is not None and regionRows is not None:
+        raise ValueError("O recorte (cropMargin) cobre so a ROI e o cortical e nao pode ser usado com regionRows")
+    if n4Settings is None:
+        n4Settings = BiasCorrection.N4Settings()
+    image = VolumeIO.readImage(exam.volumePath)
+    metadata = BitDepthDetection.imageMetadata(image) if skipN4 else None
+    labelArray = VolumeIO.imageToArray(VolumeIO.readImage(exam.labelPath))
+    if cropMargin is not None:
+        with Profiling.profileStage(profile, Profiling.STAGE_CROP) as record:
+            image, labelArray = cropImage(image, labelArray, [ROIValue, cortValue], cropMargin)
+            record["voxels"] = labelArray.size
+
+    n4Array = None
+    if cache is not None:
+        n4Parameters = {"skipN4": skipN4}
+        if not skipN4:
+            n4Parameters.update(n4Settings.asDict())
+        n4Key = Cache.n4CacheKey(VolumeIO.imageToArray(image), image.GetSpacing(), n4Parameters)
+        rowParameters = {"ILowRule": ILowRule}
+        bitsStored = BitDepthDetection.bitsStoredFromMetadata(metadata)
+        if bitDepth is not None or bitsStored is not None:
+            rowParameters.update({"bitDepth": bitDepth, "bitsStored": bitsStored})
+        rowKey = Cache.resultCacheKey(n4Key, labelArray, ROIValue, cortValue, rowParameters)
+        row = cache.getRow(rowKey)
+        # A linha em cache basta se o volume binarizado nao for pedido ou ja estiver gravado
+        if row is not None and regionRows is None and (not outputDirectory or os.path.exists(resultPath(outputDirectory, exam))):
+            logging.info('Resultado em cache: ' + exam.name)
+            return FVTOCore.FVTOResult.fromRow(row)
+        if not skipN4:
+            n4Array = cache.getArray(n4Key)
+
+    if n4Array is None:
+        if not skipN4:
+            with Profiling.profileStage(profile, Profiling.STAGE_N4ITK, labelArray.size):
+                image = BiasCorrection.n4WithSettings(image, n4Settings)
+        n4Array = VolumeIO.imageToArray(image)
+        if cache is not None and not skipN4:
+            cache.putArray(n4Key, n4Array)
+
+    # Profundidade de bits; a faixa de valores do volume do N4 fica no cache junto com ele
+    valueRange = None
+    if bitDepth is None:
+        valueRange = BitDepthDetection.scanValueRange(n4Array, cache=cache, cacheKey=None if cache is None else n4Key + "-range")
+    resolvedBitDepth = BitDepthDetection.resolveBitDepth(n4Array, bitDepth, metadata, valueRange)
+
+    # Mesmo Cast (Int) do modulo, junto com a inversao (e com as estatisticas no backend numba)
+    volumeArray, result = FVTOCore.castInvertAndRun(n4Array, labelArray, ROIValue, cortValue, image.GetSpacing(), ILowRule=ILowRule, profile=profile,
+                                                    backend=backend, bitDepth=resolvedBitDepth)
+    if cache is not None:
+        cache.putRow(rowKey, result.asRow())
+    if regionRows is not None:
+        regions = Regions.runRegions(volumeArray, labelArray, cortValue, result.Max, axis=sliceAxis, ILowRule=ILowRule)
+        regionRows.extend([exam.name] + row for row in regions.rows())
+
+    if outputDirectory:
+        with Profiling.profileStage(profile, Profiling.STAGE_BINARIZE) as record:
+            resultArray = FVTOCore.binarizedROI(volumeArray, labelArray, ROIValue, result, backend=backend)
+            if resultArray is not None:
+                record["voxels"] = resultArray.size
+        if resultArray is not None:
+            (kMin, kMax), (jMin, jMax), (iMin, iMax) = result.roiExtent
+            VolumeIO.writeArray(resultArray, image, resultPath(outputDirectory, exam), (iMin, jMin, kMin))
+    return result
+
+def processExamOutOfCore(exam, ROIValue, cortValue, outputDirectory=None, ILowRule=FVTOCore.ILOW_RULE_LEGACY, slabSize=FVTOCore.DEFAULT_SLAB_SIZE, profile=None, bitDepth=None):
+    """
+    Processa um exame maior que a memoria, mapeando volume e label do disco
+    (NRRD sem compressao). O volume ja deve estar corrigido pelo N4.
+    Com bitDepth ou com BitsStored no cabecalho, o volume e lido uma vez so.
+    """
+    volume = OutOfCore.openVolume(exam.volumePath)
+    labelArray = OutOfCore.openVolume(exam.labelPath).array
+    if labelArray.shape != volume.shape:
+        raise ValueError("Volume e label com tamanhos diferentes: %r e %r" % (volume.shape, labelArray.shape))
+    if bitDepth is None:
+        bitDepth = BitDepthDetection.bitsStoredFromMetadata(volume.metadata)
+    result = OutOfCore.run(volume.array, labelArray, ROIValue, cortValue, volume.spacing, slabSize, ILowRule, profile, bitDepth=bitDepth)
+
+    if outputDirectory:
+        OutOfCore.writeBinarizedROI(volume, labelArray, ROIValue, result, resultPath(outputDirectory, exam), slabSize, profile)
+    return result
+
+def writeResults(rows, path, columns=RESULT_COLUMNS):
+    """Grava a tabela em CSV ou, se a extensao for .parquet, em Parquet (requer pandas)."""
+    if path.lower().endswith(".parquet"):
+        import pandas
+        pandas.DataFrame(rows, columns=columns).to_parquet(path, index=False)
+        return
+    with open(path, "w") as resultFile:
+        writer = csv.writer(resultFile, delimiter=";")
+        writer.writerow(columns)
+        for row in rows:
+            writer.writerow([str(value) for value in row])
+
+def openResultStore(tablePath, columns, resume):
+    """
+    ResultStore onde as linhas sao gravadas conforme os exames terminam. Para
+    tabelas .parquet, as linhas vao para um .csv ao lado e a tabela e gravada no fim.
+    """
+    storePath = tablePath
+    if not tablePath.lower().endswith(Persistence.RESULT_STORE_EXTENSIONS):
+        storePath = os.path.splitext(tablePath)[0] + ".csv"
+    return Persistence.ResultStore(storePath, columns, resume)
+
+def closeResultStore(store, tablePath, columns):
+    if store.path != tablePath:
+        writeResults(store.rows(), tablePath, columns)
+    store.close()
+
+def createParser():
+    parser = argparse.ArgumentParser(description="Calcula o FVTO de varios exames sem a interface do Slicer.")
+    parser.add_argument("source", nargs="?", help="Diretorio com os pares volume/label ou manifesto CSV (nao usado com --queue-role work ou collect)")
+    parser.add_argument("-o", "--output", required=True, help="Diretorio de saida")
+    parser.add_argument("--roi-label", type=int, required=True, help="Valor do label da ROI")
+    parser.add_argument("--cort-label", type=int, required=True, help="Valor do label do osso cortical")
+    parser.add_argument("--label-suffix", default="-label", help="Sufixo dos label maps no diretorio (padrao: -label)")
+    parser.add_argument("--table", default="result.csv", help="Nome da tabela de resultados (.csv, .sqlite ou .parquet)")
+    parser.add_argument("--resume", action="store_true", help="Mantem as tabelas existentes e pula os exames ja gravados nelas")
+    parser.add_argument("--ilow-rule", default=FVTOCore.ILOW_RULE_LEGACY, choices=FVTOCore.ILOW_RULES, help="Regra de busca do ILow")
+    parser.add_argument("--skip-n4", action="store_true", help="Nao executar a correcao N4")
+    parser.add_argument("--n4-preset", default=BiasCorrection.N4_PRESET_DEFAULT, choices=BiasCorrection.N4_PRESET_NAMES, help="Parametros do N4 (padrao: default, os mesmos do Slicer)")
+    parser.add_argument("--n4-shrink", type=int, help="Fator de reducao do N4 (substitui o do preset)")
+    parser.add_argument("--n4-iterations", help="Iteracoes do N4 por nivel, por exemplo 50,40,30 (substitui as do preset)")
+    parser.add_argument("--n4-convergence", type=float, help="Limiar de convergencia do N4 (substitui o do preset)")
+    parser.add_argument("--n4-threads", type=int, default=0, help="Threads do N4 (padrao: 0, todos os nucleos)")
+    parser.add_argument("--no-images", action="store_true", help="Nao gravar os volumes binarizados")
+    parser.add_argument("--crop-margin", type=int, help="Recorta nos limites dos labels, com esta margem em voxels, antes do N4")
+    parser.add_argument("--cache", help="Diretorio do cache de resultados (reaproveita exames inalterados)")
+    parser.add_argument("--cache-size", type=float, default=20, help="Tamanho maximo do cache em GB (padrao: 20)")
+    parser.add_argument("--kernels", default=Kernels.KERNEL_BACKEND_NUMPY, choices=Kernels.KERNEL_BACKENDS,
+                        help="Nucleos de calculo: numpy, numba (compilados, em paralelo; requer o pacote numba) ou auto (numba se instalado)")
+    parser.add_argument("--bit-depth", type=int, help="Profundidade de bits da inversao (Max = 2^bits - 1); padrao: BitsStored do arquivo sem N4 ou deteccao pelo maior voxel")
+    parser.add_argument("--out-of-core", action="store_true", help="Volumes maiores que a memoria: le do disco por slabs (NRRD sem compressao, ja corrigido pelo N4)")
+    parser.add_argument("--slab-size", type=int, default=FVTOCore.DEFAULT_SLAB_SIZE, help="Fatias por slab no modo --out-of-core (padrao: %d)" % FVTOCore.DEFAULT_SLAB_SIZE)
+    parser.add_argument("--regions", action="store_true", help="Calcula tambem o FVTO de cada label do mapa (exceto 0 e o cortical) em uma tabela em formato longo")
+    parser.add_argument("--slice-axis", choices=Regions.AXIS_NAMES, help="Inclui na tabela de regioes o FVTO de cada fatia ao longo deste eixo (implica --regions)")
+    parser.add_argument("--regions-table", default="regions.csv", help="Nome da tabela de regioes (.csv, .sqlite ou .parquet)")
+    parser.add_argument("--queue", help="Fila de trabalho compartilhada entre maquinas: diretorio ou URL redis://host:porta/banco (requer o pacote redis)")
+    parser.add_argument("--queue-role", default="all", choices=QUEUE_ROLES,
+                        help="submit acrescenta os exames a fila, work processa ate a fila esvaziar, collect reune os resultados na tabela; all (padrao) faz os tres")
+    parser.add_argument("--max-attempts", type=int, default=WorkQueue.DEFAULT_MAX_ATTEMPTS, help="Tentativas de cada exame na fila (padrao: %d)" % WorkQueue.DEFAULT_MAX_ATTEMPTS)
+    parser.add_argument("--lease", type=float, default=WorkQueue.DEFAULT_LEASE_SECONDS, help="Segundos ate a reserva de um worker interrompido expirar (padrao: %d)" % WorkQueue.DEFAULT_LEASE_SECONDS)
+    parser.add_argument("--poll", type=float, default=10, help="Segundos entre consultas a fila enquanto outros workers terminam (padrao: 10)")
+    parser.add_argument("--profile", help="Arquivo JSON lines com o tempo e a memoria de cada etapa de cada exame")
+    return parser
+
+def n4SettingsFromArgs(args):
+    settings = BiasCorrection.N4Settings.fromPreset(args.n4_preset, args.n4_threads)
+    if args.n4_shrink is not None:
+        settings.shrinkFactor = args.n4_shrink
+    if args.n4_iterations is not None:
+        settings.numberOfIterations = BiasCorrection.N4Settings.parseIterations(args.n4_iterations)
+    if args.n4_convergence is not None:
+        settings.convergenceThreshold = args.n4_convergence
+    return settings
+
+def processExamRows(exam, args, n4Settings, n4Description, cache=None, sliceAxis=None, profile=None):
+    """
+    Processa o exame com as opcoes da linha de comando. Retorna a linha da
+    tabela de resultados e as linhas da tabela de regioes (None sem --regions).
+    """
+    regionRows = [] if args.regions or args.slice_axis else None
+    imageDirectory = None if args.no_images else args.output
+    if args.out_of_core:
+        result = processExamOutOfCore(exam, args.roi_label, args.cort_label, imageDirectory, args.ilow_rule, args.slab_size, profile, args.bit_depth)
+    else:
+        result = processExam(exam, args.roi_label, args.cort_label, imageDirectory, args.skip_n4, args.ilow_rule, cache, args.crop_margin, profile, n4Settings, regionRows, sliceAxis, args.kernels, args.bit_depth)
+    return [exam.name] + result.asRow() + [n4Description], regionRows
+
+def _builtinRow(row):
+    # Tipos NumPy (float64, int64) para JSON
+    return [value.item() if hasattr(value, "item") else value for value in row]
+
+def submitExams(queue, exams):
+    """Acrescenta os exames a fila; os que ja estao nela (em qualquer estado) sao ignorados. Retorna quantos entraram."""
+    submitted = 0
+    for exam in exams:
+        payload = {"name": exam.name, "volumePath": os.path.abspath(exam.volumePath), "labelPath": os.path.abspath(exam.labelPath)}
+        if queue.submit(exam.name, payload):
+            submitted += 1
+    return submitted
+
+def runWorker(queue, process, workerId=None, poll=10):
+    """
+    Reserva e processa exames da fila ate ela esvaziar. process(exam) retorna a
+    linha e as linhas de regioes do exame. Enquanto outros workers tem exames
+    reservados, continua consultando a fila para assumir as novas tentativas.
+    Retorna (processados, falhas).
+    """
+    processed = 0
+    failures = 0
+    while True:
+        task = queue.claim(workerId)
+        if task is None:
+            if not queue.counts()["claimed"]:
+                break
+            time.sleep(poll)
+            continue
+        exam = Exam(task.payload["name"], task.payload["volumePath"], task.payload["labelPath"])
+        logging.info('Processando %s (tentativa %d)' % (exam.name, task.attempts))
+        try:
+            # Renova a reserva enquanto o exame e processado, para que ela nao expire
+            with WorkQueue.renewingLease(queue, task):
+                row, regionRows = process(exam)
+        except Exception as error:
+            logging.exception('Falha ao processar ' + exam.name)
+            queue.fail(task, error)
+            failures += 1
+            continue
+        if regionRows is not None:
+            regionRows = [_builtinRow(regionRow) for regionRow in regionRows]
+        queue.complete(task, {"row": _builtinRow(row), "regionRows": regionRows})
+        processed += 1
+    return processed, failures
+
+def collectResults(queue, store, regionStore=None):
+    """Grava na tabela (e na de regioes) os resultados da fila que ainda nao estao nela. Retorna quantos foram gravados."""
+    collected = 0
+    for taskId, result in queue.results():
+        if store.isCompleted(taskId):
+            continue
+        # As regioes antes da linha principal, como no processamento local
+        if regionStore is not None and result.get("regionRows") is not None and not regionStore.isCompleted(taskId):
+            regionStore.appendRows(result["regionRows"])
+        store.append(result["row"])
+        collected += 1
+    return collected
+
+def main(argv=None):
+    parser = createParser()
+    args = parser.parse_args(argv)
+    if args.out_of_core and (args.cache or args.crop_margin is not None):
+        parser.error("--out-of-core nao pode ser combinado com --cache ou --crop-margin")
+    if args.out_of_core and (args.regions or args.slice_axis):
+        parser.error("--out-of-core nao pode ser combinado com --regions ou --slice-axis")
+    if args.crop_margin is not None and (args.regions or args.slice_axis):
+        # O recorte so cobre a ROI e o cortical: os outros labels ficariam cortados
+        parser.error("--crop-margin nao pode ser combinado com --regions ou --slice-axis")
+    if args.source is None and not (args.queue and args.queue_role in ("work", "collect")):
+        parser.error("informe o diretorio ou o manifesto dos exames")
+    if args.bit_depth is not None and not 1 <= args.bit_depth <= BitDepthDetection.MAX_BIT_DEPTH:
+        parser.error("--bit-depth deve estar entre 1 e %d" % BitDepthDetection.MAX_BIT_DEPTH)
+    try:
+        Kernels.resolveKernelBackend(args.kernels)
+    except ImportError as error:
+        parser.error(str(error))
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+    n4Settings = n4SettingsFromArgs(args)
+    n4Description = "none" if args.skip_n4 or args.out_of_core else n4Settings.describe()
+
+    exams = []
+    if args.source is not None:
+        if os.path.isdir(args.source):
+            exams = findExams(args.source, args.label_suffix)
+        else:
+            exams = readManifest(args.source)
+    if not os.path.isdir(args.output):
+        try:
+            os.makedirs(args.output)
+        except OSError:
+            # Criado ao mesmo tempo por outra maquina da fila
+            if not os.path.isdir(args.output):
+                raise
+
+    cache = None
+    if args.cache:
+        cache = Cache.ResultCache(args.cache, int(args.cache_size * 1024 ** 3))
+
+    tablePath = os.path.join(args.output, args.table)
+    regionsPath = os.path.join(args.output, args.regions_table)
+    withRegions = bool(args.regions or args.slice_axis)
+    sliceAxis = None
+    if args.slice_axis:
+        sliceAxis = Regions.AXIS_NAMES.index(args.slice_axis)
+
+    def process(exam):
+        profile = Profiling.StageProfile(exam.name) if args.profile else None
+        try:
+            return processExamRows(exam, args, n4Settings, n4Description, cache, sliceAxis, profile)
+        finally:
+            if profile is not None:
+                profile.writeJSONLines(args.profile)
+
+    if args.queue:
+        return runQueue(args, exams, process, tablePath, regionsPath if withRegions else None)
+
+    store = openResultStore(tablePath, RESULT_COLUMNS, args.resume)
+    regionStore = None
+    if withRegions:
+        regionStore = openResultStore(regionsPath, REGION_COLUMNS, args.resume)
+
+    processed = 0
+    skipped = 0
+    failures = 0
+    for exam in exams:
+        if store.isCompleted(exam.name):
+            logging.info('Ja gravado na tabela: ' + exam.name)
+            skipped += 1
+            continue
+        logging.info('Processando ' + exam.name)
+        try:
+            row, regionRows = process(exam)
+        except Exception:
+            logging.exception('Falha ao processar ' + exam.name)
+            failures += 1
+            continue
+        # As regioes antes da linha principal: um exame so conta como gravado com as duas
+        if regionStore is not None and not regionStore.isCompleted(exam.name):
+            regionStore.appendRows(regionRows)
+        store.append(row)
+        processed += 1
+
+    closeResultStore(store, tablePath, RESULT_COLUMNS)
+    if regionStore is not None:
+        closeResultStore(regionStore, regionsPath, REGION_COLUMNS)
+    logging.info('%d exames processados, %d ja gravados, %d falhas. Tabela: %s' % (processed, skipped, failures, tablePath))
+    return 1 if failures else 0
+
+def runQueue(args, exams, process, tablePath, regionsPath=None):
+    """Etapas de --queue-role: acrescentar os exames, processar a fila e reunir os resultados."""
+    queue = WorkQueue.openWorkQueue(args.queue, args.lease, args.max_attempts)
+    if args.queue_role in ("all", "submit"):
+        logging.info('%d de %d exames acrescentados a fila %s' % (submitExams(queue, exams), len(exams), args.queue))
+    if args.queue_role in ("all", "work"):
+        processed, failures = runWorker(queue, process, poll=args.poll)
+        logging.info('%d exames processados por este worker, %d tentativas com falha' % (processed, failures))
+    if args.queue_role in ("all", "collect"):
+        # A tabela e sempre mantida: cada coleta acrescenta so os exames novos
+        store = openResultStore(tablePath, RESULT_COLUMNS, True)
+        regionStore = None
+        if regionsPath is not None:
+            regionStore = openResultStore(regionsPath, REGION_COLUMNS, True)
+        collected = collectResults(queue, store, regionStore)
+        closeResultStore(store, tablePath, RESULT_COLUMNS)
+        if regionStore is not None:
+            closeResultStore(regionStore, regionsPath, REGION_COLUMNS)
+        logging.info('%d resultados reunidos. Tabela: %s' % (collected, tablePath))
+
+    counts = queue.counts()
+    logging.info('Fila: %(pending)d pendentes, %(claimed)d reservados, %(done)d concluidos, %(failed)d com falha' % counts)
+    for taskId, error in queue.failures():
+        logging.error('Sem resultado apos %d tentativas: %s (%s)' % (args.max_attempts, taskId, error))
+    return 1 if counts["failed"] else 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,226 @@
+#
+# Benchmark e regressao do pipeline com fantomas sinteticos.
+#
+# Para cada combinacao de tamanho e profundidade de bits gera um fantoma,
+# executa as etapas do pipeline medindo cada uma com StageProfile e registra
+# a vazao (voxels/s), o pico de memoria e o erro do FVTO contra a fracao de
+# osso conhecida. Os registros podem ser gravados em JSON lines e comparados
+# entre versoes. Com --cast, compara tambem o Cast pelo modulo CLI com o Cast
+# e a inversao em NumPy. Dentro do Slicer o Cast Scalar Volume e executado de
+# fato (processo, serializacao MRML e arquivos); fora dele o CLI e simulado
+# pela ida e volta por arquivos NRRD temporarios, um limite inferior do custo
+# real (castCLIMode "simulated").
+#
+# A regra legacy do ILow compara a posicao do bin com a metade da contagem do
+# pico. Em fantomas sem ruido (histograma de dois niveis) de 16 bits, ela so
+# acerta o bin da medula com ROIs de ~100 mil voxels (80^3) ou mais; abaixo
+# disso o ILow cai no bin do osso e o FVTO fica infinito. Com ruido (padrao) o
+# histograma e continuo e o FVTO e finito; --ilow-rule falling nao tem o limite.
+#
+# Uso:
+#   python TrabeculadoOsseoLib/Benchmark.py --sizes 64 128 256 --bit-depths 8 12 16 -o benchmark.jsonl
+#   python TrabeculadoOsseoLib/Benchmark.py --sizes 1024 --bit-depths 12 --n4 fast
+#   python TrabeculadoOsseoLib/Benchmark.py --sizes 256 --bit-depths 12 --cast
+#
+
+import argparse
+import json
+import logging
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+if __name__ == "__main__" and not __package__:
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy
+
+from TrabeculadoOsseoLib import FVTOCore, Phantoms, Profiling, BiasCorrection, OutOfCore
+
+def benchmarkPhantom(phantom, ILowRule=FVTOCore.ILOW_RULE_LEGACY, n4Settings=None, name=None):
+    """
+    Executa o pipeline no fantoma e retorna (FVTOResult, StageProfile, registro de resumo).
+    Com n4Settings (N4Settings) inclui a correcao N4.
+    """
+    profile = Profiling.StageProfile(name or repr(phantom))
+    volumeArray = phantom.volumeArray
+    if n4Settings is not None:
+        from TrabeculadoOsseoLib import VolumeIO
+        with profile.stage(Profiling.STAGE_N4ITK, volumeArray.size):
+            image = VolumeIO.requireSimpleITK().GetImageFromArray(volumeArray.astype(numpy.float32))
+            image.SetSpacing(phantom.spacing)
+            volumeArray = VolumeIO.imageToArray(BiasCorrection.n4WithSettings(image, n4Settings))
+
+    with profile.stage(Profiling.STAGE_CAST, volumeArray.size):
+        volumeArray = volumeArray.astype(numpy.int32)
+    result = FVTOCore.run(volumeArray, phantom.labelArray, phantom.ROIValue, phantom.cortValue, phantom.spacing, copy=False, ILowRule=ILowRule, profile=profile)
+    with profile.stage(Profiling.STAGE_BINARIZE) as record:
+        resultArray = FVTOCore.binarizedROI(volumeArray, phantom.labelArray, phantom.ROIValue, result)
+        if resultArray is not None:
+            record["voxels"] = resultArray.size
+
+    voxels = phantom.volumeArray.size
+    wallSeconds = profile.wallSeconds()
+    summary = {
+        "name": profile.examName,
+        "shape": list(phantom.volumeArray.shape),
+        "bitDepth": phantom.bitDepth,
+        "voxels": voxels,
+        "ILowRule": ILowRule,
+        "n4": None if n4Settings is None else n4Settings.describe(),
+        "wallSeconds": wallSeconds,
+        "voxelsPerSecond": voxels / wallSeconds if wallSeconds > 0 else None,
+        "stageSeconds": dict((stageName, profile.wallSeconds(stageName)) for stageName in Profiling.STAGE_NAMES if profile.wallSeconds(stageName)),
+        "peakRSSBytes": profile.peakRSSBytes(),
+        "FVTO": float(result.FVTO),
+        "truthFVTO": phantom.truth["FVTO"],
+        "FVTOError": float(result.FVTO) - phantom.truth["FVTO"],
+        "ICort": float(result.ICort),
+        "ITrab": float(result.ITrab),
+        "ILow": int(result.ILow),
+    }
+    return result, profile, summary
+
+def _writeReadNrrd(array, path):
+    # Ida e volta de um volume por um NRRD sem compressao, como o Slicer faz com as entradas e saidas de um CLI
+    writer = OutOfCore.NrrdStreamWriter(path, array.shape, array.dtype)
+    try:
+        writer.write(array)
+    finally:
+        writer.close()
+    return numpy.array(OutOfCore.openVolume(path).array)
+
+def _slicerCastModule():
+    # Modulo Cast Scalar Volume quando executado dentro do Slicer, senao None
+    try:
+        import slicer
+        return slicer.modules.castscalarvolume
+    except (ImportError, AttributeError):
+        return None
+
+def _castWithSlicerCLI(n4Array, castModule):
+    # Cast (Int) pelo modulo CLI como no pipeline: o volume do N4 ja esta na cena,
+    # o tempo inclui o processo, a serializacao MRML, a copia e a inversao
+    import slicer
+    n4itkVolume = slicer.util.addVolumeFromArray(n4Array, name="Benchmark N4ITK Volume")
+    castVolume = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode", "Benchmark Cast Volume")
+    cliNode = None
+    try:
+        startTime = time.time()
+        parameters = {"InputVolume": n4itkVolume.GetID(), "OutputVolume": castVolume.GetID(), "Type": "Int"}
+        cliNode = slicer.cli.run(castModule, None, parameters, wait_for_completion=True)
+        if cliNode.GetStatus() != cliNode.Completed:
+            raise RuntimeError("Cast Scalar Volume falhou: " + cliNode.GetStatusString())
+        invertedArray = slicer.util.arrayFromVolume(castVolume).copy()
+        Max = FVTOCore.invertVolumeArray(invertedArray)
+        return invertedArray, Max, time.time() - startTime
+    finally:
+        for node in (n4itkVolume, castVolume, cliNode):
+            if node is not None:
+                slicer.mrmlScene.RemoveNode(node)
+
+def _castWithFiles(n4Array, directory=None):
+    # CLI simulado: ida e volta por NRRDs temporarios, sem processo nem serializacao MRML
+    temporaryDirectory = tempfile.mkdtemp(dir=directory)
+    try:
+        startTime = time.time()
+        castArray = FVTOCore.castArray(_writeReadNrrd(n4Array, os.path.join(temporaryDirectory, "input.nrrd")))
+        castArray = _writeReadNrrd(castArray, os.path.join(temporaryDirectory, "output.nrrd"))
+        invertedArray = castArray.copy()
+        Max = FVTOCore.invertVolumeArray(invertedArray)
+        return invertedArray, Max, time.time() - startTime
+    finally:
+        shutil.rmtree(temporaryDirectory, ignore_errors=True)
+
+def benchmarkCast(n4Array, directory=None):
+    """
+    Compara o Cast (Int) e a inversao de um volume do N4 (float32) feitos como no
+    modulo com o CLI (Cast Scalar Volume, copia para o Inverted Volume e inversao)
+    com castAndInvertArray. Dentro do Slicer o CLI e executado; fora dele e
+    simulado por arquivos temporarios e o tempo e um limite inferior
+    (castCLIMode "simulated"). Retorna um registro com os tempos, a economia por
+    exame e se os resultados sao iguais.
+    """
+    n4Array = numpy.asarray(n4Array, dtype=numpy.float32)
+    castModule = _slicerCastModule()
+    if castModule is not None:
+        invertedArray, Max, cliSeconds = _castWithSlicerCLI(n4Array, castModule)
+        mode = "slicer"
+    else:
+        invertedArray, Max, cliSeconds = _castWithFiles(n4Array, directory)
+        mode = "simulated"
+
+    startTime = time.time()
+    fusedArray, fusedMax = FVTOCore.castAndInvertArray(n4Array)
+    numpySeconds = time.time() - startTime
+    return {
+        "castCLIMode": mode,
+        "castCLISeconds": cliSeconds,
+        "castNumPySeconds": numpySeconds,
+        "castSavedSeconds": cliSeconds - numpySeconds,
+        "castSpeedup": cliSeconds / numpySeconds if numpySeconds > 0 else None,
+        "castEqual": bool(fusedMax == Max and numpy.array_equal(fusedArray, invertedArray)),
+    }
+
+def runBenchmark(sizes=(64, 128), bitDepths=(8, 12, 16), boneFraction=0.3, biasAmplitude=0.2, noiseSigma=0.02,
+                 ILowRule=FVTOCore.ILOW_RULE_LEGACY, n4Settings=None, seed=0, compareCast=False):
+    """
+    Gera e processa um fantoma cubico por combinacao de tamanho e bits. Retorna os registros de resumo.
+    Com compareCast, acrescenta ao registro a comparacao de benchmarkCast.
+    """
+    summaries = []
+    for size in sizes:
+        for bitDepth in bitDepths:
+            name = "phantom-%d-%dbit" % (size, bitDepth)
+            logging.info('Gerando ' + name)
+            generationStart = time.time()
+            phantom = Phantoms.makePhantom((size, size, size), bitDepth, boneFraction, biasAmplitude, noiseSigma, seed=seed)
+            generationSeconds = time.time() - generationStart
+            result, profile, summary = benchmarkPhantom(phantom, ILowRule, n4Settings, name)
+            summary["generationSeconds"] = generationSeconds
+            summary["boneFraction"] = boneFraction
+            summary["biasAmplitude"] = biasAmplitude
+            summary["noiseSigma"] = noiseSigma
+            summary["platform"] = platform.platform()
+            summary["numpy"] = numpy.__version__
+            if compareCast:
+                summary.update(benchmarkCast(phantom.volumeArray))
+                logging.info('%s: Cast pelo CLI (%s) %.3f s, em NumPy %.3f s' % (name, summary["castCLIMode"], summary["castCLISeconds"], summary["castNumPySeconds"]))
+            logging.info('%s: %.3g voxels/s, FVTO %.4f (referencia %.4f)' % (name, summary["voxelsPerSecond"] or 0, summary["FVTO"], summary["truthFVTO"]))
+            summaries.append(summary)
+            del phantom, result
+    return summaries
+
+def createParser():
+    parser = argparse.ArgumentParser(description="Benchmark do calculo do FVTO com fantomas sinteticos.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[64, 128], help="Arestas dos fantomas cubicos (ate 1024)")
+    parser.add_argument("--bit-depths", type=int, nargs="+", default=[8, 12, 16], choices=Phantoms.PHANTOM_BIT_DEPTHS, help="Profundidades de bits")
+    parser.add_argument("--bone-fraction", type=float, default=0.3, help="Fracao de osso do trabeculado (padrao: 0.3)")
+    parser.add_argument("--bias", type=float, default=0.2, help="Amplitude do campo de bias, fracao da intensidade (padrao: 0.2)")
+    parser.add_argument("--noise", type=float, default=0.02, help="Desvio do ruido gaussiano, fracao do valor maximo (padrao: 0.02)")
+    parser.add_argument("--ilow-rule", default=FVTOCore.ILOW_RULE_LEGACY, choices=FVTOCore.ILOW_RULES, help="Regra de busca do ILow")
+    parser.add_argument("--n4", nargs="?", const=BiasCorrection.N4_PRESET_DEFAULT, choices=BiasCorrection.N4_PRESET_NAMES, help="Inclui a correcao N4 com o preset indicado (padrao: default; requer SimpleITK)")
+    parser.add_argument("--n4-threads", type=int, default=0, help="Threads do N4 (padrao: 0, todos os nucleos)")
+    parser.add_argument("--cast", action="store_true", help="Compara o Cast pelo modulo CLI (fora do Slicer, simulado por arquivos temporarios: limite inferior) com o Cast e a inversao em NumPy")
+    parser.add_argument("--seed", type=int, default=0, help="Semente dos fantomas")
+    parser.add_argument("-o", "--output", help="Arquivo JSON lines onde os resultados sao acrescentados")
+    return parser
+
+def main(argv=None):
+    args = createParser().parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+    n4Settings = None
+    if args.n4:
+        n4Settings = BiasCorrection.N4Settings.fromPreset(args.n4, args.n4_threads)
+    summaries = runBenchmark(args.sizes, args.bit_depths, args.bone_fraction, args.bias, args.noise, args.ilow_rule, n4Settings, args.seed, args.cast)
+    if args.output:
+        with open(args.output, "a") as outputFile:
+            for summary in summaries:
+                outputFile.write(json.dumps(summary, sort_keys=True) + "\n")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
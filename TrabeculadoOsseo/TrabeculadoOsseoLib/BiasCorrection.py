@@ -0,0 +1,122 @@
+import contextlib
+import os
+
+from .VolumeIO import requireSimpleITK
+
+#
+# Parametros da correcao de bias field N4 e execucao fora do Slicer (SimpleITK).
+#
+# N4Settings guarda fator de reducao, iteracoes por nivel, limiar de
+# convergencia e numero de threads, usados tanto no modulo CLI
+# N4ITKBiasFieldCorrection do Slicer quanto em n4BiasFieldCorrection.
+# O preset "default" tem os mesmos valores padrao do modulo do Slicer:
+# mascara por Otsu, fator de reducao 4, iteracoes 50,40,30 e limiar 0.0001.
+#
+
+N4_PRESET_FAST = "fast"
+N4_PRESET_DEFAULT = "default"
+N4_PRESET_ACCURATE = "accurate"
+N4_PRESET_NAMES = (N4_PRESET_FAST, N4_PRESET_DEFAULT, N4_PRESET_ACCURATE)
+
+# Variavel lida pelo ITK ao iniciar o processo do modulo CLI
+ITK_THREADS_VARIABLE = "ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS"
+
+class N4Settings(object):
+    """Parametros do N4. numberOfThreads igual a 0 usa o padrao do ITK (todos os nucleos)."""
+
+    def __init__(self, shrinkFactor=4, numberOfIterations=(50, 40, 30), convergenceThreshold=0.0001, numberOfThreads=0):
+        self.shrinkFactor = int(shrinkFactor)
+        self.numberOfIterations = tuple(int(x) for x in numberOfIterations)
+        self.convergenceThreshold = float(convergenceThreshold)
+        self.numberOfThreads = int(numberOfThreads)
+
+    @classmethod
+    def fromPreset(cls, name, numberOfThreads=0):
+        if name not in N4_PRESETS:
+            raise ValueError("Preset de N4 desconhecido: %r" % (name,))
+        settings = N4_PRESETS[name]
+        return cls(settings.shrinkFactor, settings.numberOfIterations, settings.convergenceThreshold, numberOfThreads)
+
+    @staticmethod
+    def parseIterations(text):
+        """Iteracoes por nivel a partir de um texto como "50,40,30"."""
+        iterations = tuple(int(x) for x in text.replace(" ", "").split(",") if x)
+        if not iterations or min(iterations) < 1:
+            raise ValueError("Iteracoes do N4 invalidas: %r" % (text,))
+        return iterations
+
+    def iterationsText(self):
+        return ",".join(str(x) for x in self.numberOfIterations)
+
+    def cliParameters(self):
+        """Parametros do modulo CLI N4ITKBiasFieldCorrection (as threads vao pelo ambiente)."""
+        return {
+            "shrinkFactor": self.shrinkFactor,
+            "numberOfIterations": self.iterationsText(),
+            "convergenceThreshold": self.convergenceThreshold,
+        }
+
+    def asDict(self):
+        """Parametros que alteram o resultado (usados na chave do cache); as threads nao entram."""
+        return {
+            "shrinkFactor": self.shrinkFactor,
+            "numberOfIterations": list(self.numberOfIterations),
+            "convergenceThreshold": self.convergenceThreshold,
+        }
+
+    def describe(self):
+        """Texto curto gravado junto de cada linha de resultado."""
+        threads = self.numberOfThreads if self.numberOfThreads > 0 else "auto"
+        return "shrink=%d iterations=%s convergence=%g threads=%s" % (self.shrinkFactor, self.iterationsText(), self.convergenceThreshold, threads)
+
+    def __repr__(self):
+        return "N4Settings(%s)" % self.describe()
+
+N4_PRESETS = {
+    N4_PRESET_FAST: N4Settings(shrinkFactor=8, numberOfIterations=(20, 20, 10), convergenceThreshold=0.001),
+    N4_PRESET_DEFAULT: N4Settings(),
+    N4_PRESET_ACCURATE: N4Settings(shrinkFactor=2, numberOfIterations=(100, 100, 50, 50), convergenceThreshold=0.00001),
+}
+
+@contextlib.contextmanager
+def itkThreadsEnvironment(numberOfThreads):
+    """
+    Define o numero de threads do ITK para os processos CLI iniciados dentro do
+    bloco. slicer.cli.run sem aguardar so agenda o processo: o bloco deve durar
+    ate o no do CLI deixar de estar ocupado.
+    """
+    previous = os.environ.get(ITK_THREADS_VARIABLE)
+    if numberOfThreads > 0:
+        os.environ[ITK_THREADS_VARIABLE] = str(int(numberOfThreads))
+    try:
+        yield
+    finally:
+        if numberOfThreads > 0:
+            if previous is None:
+                del os.environ[ITK_THREADS_VARIABLE]
+            else:
+                os.environ[ITK_THREADS_VARIABLE] = previous
+
+def n4BiasFieldCorrection(image, shrinkFactor=4, numberOfIterations=(50, 40, 30), convergenceThreshold=0.0001, numberOfThreads=0):
+    sitk = requireSimpleITK()
+    image = sitk.Cast(image, sitk.sitkFloat32)
+    mask = sitk.OtsuThreshold(image, 0, 1, 200)
+
+    corrector = sitk.N4BiasFieldCorrectionImageFilter()
+    corrector.SetMaximumNumberOfIterations([int(x) for x in numberOfIterations])
+    corrector.SetConvergenceThreshold(convergenceThreshold)
+    if numberOfThreads > 0:
+        corrector.SetNumberOfThreads(int(numberOfThreads))
+
+    if shrinkFactor <= 1:
+        return corrector.Execute(image, mask)
+
+    # Estima o campo na imagem reduzida e aplica na resolucao original
+    shrink = [int(shrinkFactor)] * image.GetDimension()
+    corrector.Execute(sitk.Shrink(image, shrink), sitk.Shrink(mask, shrink))
+    logBiasField = corrector.GetLogBiasFieldAsImage(image)
+    return image / sitk.Exp(logBiasField)
+
+def n4WithSettings(image, settings):
+    """n4BiasFieldCorrection com os parametros de um N4Settings."""
+    return n4BiasFieldCorrection(image, settings.shrinkFactor, settings.numberOfIterations, settings.convergenceThreshold, settings.numberOfThreads)
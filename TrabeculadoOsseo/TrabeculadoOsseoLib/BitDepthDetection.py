@@ -0,0 +1,215 @@
+import logging
+from collections import OrderedDict
+
+import numpy
+
+from .LabelStatistics import iterSlabs, DEFAULT_SLAB_SIZE
+from .Background import checkCancelled
+
+#
+# Profundidade de bits usada na inversao dos voxels (Max = 2**bits - 1).
+#
+# resolveBitDepth escolhe a profundidade, nesta ordem:
+#  - override: bits informados pelo usuario;
+#  - BitsStored dos metadados (DICOM 0028|0101 ou campo BitsStored:= do NRRD);
+#  - o tipo escalar, quando ele ja limita os valores a 8 bits;
+#  - uma unica passada pelo volume (minimo e maximo por slab, apos o Cast),
+#    que pode ser guardada em cache pela chave do volume.
+# Pelos dados, as faixas sao as do modulo original (8, 12, 14 e 16 bits); acima
+# de 16 bits usa o menor numero de bits que cobre o maior voxel (antes o Max
+# ficava 0). Valores negativos ficam acima de Max apos a inversao e entram no
+# histograma como overflow: o minimo fica registrado e um aviso vai para o log.
+#
+# Os metadados descrevem o volume gravado: depois do N4 eles nao valem mais,
+# entao so sao consultados quando o volume invertido e o proprio arquivo.
+#
+
+BIT_DEPTHS = (8, 12, 14, 16)
+# Valores maximos (8, 12, 14 e 16 bits) usados na inversao dos voxels
+BIT_DEPTH_MAX_VALUES = tuple(2 ** bits - 1 for bits in BIT_DEPTHS)
+# Depois do Cast (Int) os voxels cabem em int32
+MAX_BIT_DEPTH = 31
+
+BIT_DEPTH_SOURCE_OVERRIDE = "override"
+BIT_DEPTH_SOURCE_METADATA = "metadata"
+BIT_DEPTH_SOURCE_SCALAR_TYPE = "scalar type"
+BIT_DEPTH_SOURCE_DATA = "data"
+
+# Chaves do BitsStored nos metadados do SimpleITK, do NRRD e do banco DICOM do Slicer
+BITS_STORED_KEYS = ("0028|0101", "0028,0101", "BitsStored", "bitsstored", "bits stored")
+
+class BitDepth(object):
+    """Profundidade de bits do volume, de onde ela veio e a faixa de valores, se conhecida."""
+
+    def __init__(self, bits, source, minValue=None, maxValue=None):
+        bits = int(bits)
+        if not 1 <= bits <= MAX_BIT_DEPTH:
+            raise ValueError("Profundidade de bits deve estar entre 1 e %d: %r" % (MAX_BIT_DEPTH, bits))
+        self.bits = bits
+        self.source = source
+        self.minValue = minValue
+        self.maxValue = maxValue
+
+    @property
+    def Max(self):
+        return 2 ** self.bits - 1
+
+    def covers(self, value):
+        return value <= self.Max
+
+    @property
+    def checked(self):
+        """True se o Max ja foi conferido com o maior voxel (ou o tipo escalar o garante)."""
+        return self.maxValue is not None or self.source == BIT_DEPTH_SOURCE_SCALAR_TYPE
+
+    def __repr__(self):
+        return "BitDepth(bits=%d, Max=%d, source=%r)" % (self.bits, self.Max, self.source)
+
+def bitsForValue(maxValue):
+    """Menor profundidade que cobre maxValue: 8, 12, 14 ou 16 bits como no modulo original, ou mais."""
+    for bits in BIT_DEPTHS:
+        if maxValue < 2 ** bits:
+            return bits
+    bits = int(maxValue).bit_length()
+    if bits > MAX_BIT_DEPTH:
+        raise ValueError("Maior voxel (%r) acima de %d bits" % (maxValue, MAX_BIT_DEPTH))
+    return bits
+
+def bitsFromScalarType(dtype):
+    """8 para tipos de 8 bits (o tipo ja fixa Max em 255), None para os demais."""
+    dtype = numpy.dtype(dtype)
+    if dtype.kind in "biu" and dtype.itemsize == 1:
+        return 8
+    return None
+
+def bitsStoredFromMetadata(metadata):
+    """BitsStored de um dicionario de metadados (SimpleITK, NRRD ou DICOM), ou None."""
+    if not metadata:
+        return None
+    for key in BITS_STORED_KEYS:
+        value = metadata.get(key)
+        if value is None:
+            continue
+        try:
+            bits = int(str(value).strip())
+        except ValueError:
+            continue
+        if 1 <= bits <= MAX_BIT_DEPTH:
+            return bits
+    return None
+
+def imageMetadata(image):
+    """Metadados de uma imagem do SimpleITK (inclui os campos DICOM e os pares chave:=valor do NRRD)."""
+    return dict((key, image.GetMetaData(key)) for key in image.GetMetaDataKeys())
+
+class ValueRangeCache(object):
+    """Cache na memoria das faixas (minimo, maximo) ja lidas, com a interface getRow/putRow do ResultCache."""
+
+    def __init__(self, maxEntries=32):
+        self.maxEntries = maxEntries
+        self.entries = OrderedDict()
+
+    def getRow(self, key):
+        row = self.entries.pop(key, None)
+        if row is not None:
+            self.entries[key] = row
+        return row
+
+    def putRow(self, key, row):
+        self.entries.pop(key, None)
+        self.entries[key] = list(row)
+        while len(self.entries) > self.maxEntries:
+            self.entries.popitem(last=False)
+
+def _castValue(value):
+    # Mesmo Cast (Int) do modulo; a truncagem preserva a ordem dos valores
+    return int(numpy.asarray(value).astype(numpy.int32))
+
+def scanValueRange(array, slabSize=DEFAULT_SLAB_SIZE, cancelEvent=None, cache=None, cacheKey=None):
+    """
+    (minimo, maximo) do volume apos o Cast, lendo cada slab uma vez. Com cache
+    (ValueRangeCache ou ResultCache) e cacheKey, reaproveita uma leitura anterior.
+    """
+    if cache is not None and cacheKey is not None:
+        row = cache.getRow(cacheKey)
+        if row is not None:
+            return tuple(row)
+    minValue = maxValue = None
+    for k0, k1 in iterSlabs(array.shape, slabSize):
+        checkCancelled(cancelEvent)
+        slab = numpy.asarray(array[k0:k1])
+        slabMin, slabMax = slab.min(), slab.max()
+        if minValue is None or slabMin < minValue:
+            minValue = slabMin
+        if maxValue is None or slabMax > maxValue:
+            maxValue = slabMax
+    valueRange = (_castValue(minValue), _castValue(maxValue))
+    if cache is not None and cacheKey is not None:
+        cache.putRow(cacheKey, valueRange)
+    return valueRange
+
+def resolveBitDepth(array=None, override=None, metadata=None, valueRange=None, slabSize=DEFAULT_SLAB_SIZE, cancelEvent=None, cache=None, cacheKey=None):
+    """
+    BitDepth do volume (array K, J, I ou memmap), na ordem override, BitsStored
+    dos metadados, tipo escalar e dados. Com valueRange (minimo, maximo) ja
+    conhecido, o volume nao e lido: um BitsStored que nao cobre o maior voxel e
+    ignorado e um override que nao cobre levanta ValueError.
+    """
+    if override is not None:
+        bitDepth = BitDepth(override, BIT_DEPTH_SOURCE_OVERRIDE)
+        if valueRange is not None:
+            if not bitDepth.covers(valueRange[1]):
+                raise ValueError("Maior voxel (%d) acima do Max (%d) da profundidade de %d bits" % (valueRange[1], bitDepth.Max, bitDepth.bits))
+            bitDepth.minValue, bitDepth.maxValue = valueRange
+        return bitDepth
+
+    bits = bitsStoredFromMetadata(metadata)
+    if bits is not None:
+        bitDepth = BitDepth(bits, BIT_DEPTH_SOURCE_METADATA)
+        if valueRange is None:
+            return bitDepth
+        if bitDepth.covers(valueRange[1]):
+            bitDepth.minValue, bitDepth.maxValue = valueRange
+            return bitDepth
+        logging.warning("BitsStored (%d) nao cobre o maior voxel (%d); profundidade detectada pelos dados" % (bits, valueRange[1]))
+
+    if valueRange is None and array is not None:
+        bits = bitsFromScalarType(array.dtype)
+        if bits is not None:
+            return BitDepth(bits, BIT_DEPTH_SOURCE_SCALAR_TYPE)
+
+    if valueRange is None:
+        if array is None:
+            raise ValueError("Sem volume, metadados nem override para definir a profundidade de bits")
+        valueRange = scanValueRange(array, slabSize, cancelEvent, cache, cacheKey)
+    minValue, maxValue = valueRange
+    if minValue < 0:
+        logging.warning("Volume com valores negativos (minimo %d): apos a inversao ficam acima de Max e entram no histograma como overflow" % minValue)
+    return BitDepth(bitsForValue(maxValue), BIT_DEPTH_SOURCE_DATA, minValue, maxValue)
+
+def requiresInvertedCheck(bitDepth):
+    """
+    True se o Max de bitDepth nao foi conferido com os dados (bits informados ou
+    BitsStored sem a faixa lida): a inversao deve entao verificar cada slab.
+    """
+    if bitDepth is None:
+        return False
+    if isinstance(bitDepth, BitDepth):
+        return not bitDepth.checked
+    return True
+
+def checkSlabMax(slab, Max):
+    """ValueError se algum voxel do slab (antes da inversao) estiver acima do Max."""
+    if slab.size and slab.max() > Max:
+        raise ValueError("Voxels acima do Max (%d) da profundidade de bits informada" % Max)
+
+def checkInvertedSlab(slab, Max):
+    """ValueError se algum voxel do slab invertido (int32) ficou negativo, isto e, estava acima do Max."""
+    if slab.size and slab.min() < 0:
+        raise ValueError("Voxels acima do Max (%d) da profundidade de bits informada" % Max)
+
+def resolveMax(array, bitDepth=None, slabSize=DEFAULT_SLAB_SIZE, cancelEvent=None):
+    """Max da inversao: bitDepth pode ser um BitDepth ja resolvido, bits (int) informados ou None (detectado)."""
+    if isinstance(bitDepth, BitDepth):
+        return bitDepth.Max
+    return resolveBitDepth(array, bitDepth, slabSize=slabSize, cancelEvent=cancelEvent).Max
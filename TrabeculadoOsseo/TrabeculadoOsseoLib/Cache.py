@@ -0,0 +1,135 @@
+import hashlib
+import json
+import os
+
+import socket
+
+import numpy
+
+#
+# Cache em disco dos resultados, indexado pelo hash do conteudo dos volumes.
+#
+# Duas entradas por exame:
+#  - volume corrigido pelo N4 (<chave>.npy), cuja chave depende do volume de
+#    entrada, do espacamento e dos parametros do N4;
+#  - linha de resultados (<chave>.json), cuja chave depende tambem do label
+#    map, dos valores dos labels e dos parametros do restante do pipeline.
+# Assim a troca de labels reaproveita o N4 e um exame inalterado e pulado.
+# O tamanho do diretorio e limitado, removendo as entradas usadas ha mais tempo.
+# O diretorio pode ser compartilhado por varios processos e maquinas (fila do
+# BatchRunner): cada gravacao usa um temporario proprio e os.replace, e uma
+# entrada removida por outro processo e tratada como ausente.
+#
+
+# Incrementar quando o calculo mudar e invalidar os resultados gravados
+CACHE_VERSION = 1
+
+DEFAULT_CACHE_MAX_BYTES = 20 * 1024 ** 3
+
+def _updateWithArray(digest, array):
+    array = numpy.ascontiguousarray(array)
+    digest.update(array.dtype.str.encode("ascii"))
+    digest.update(repr(array.shape).encode("ascii"))
+    digest.update(array.data)
+
+def _updateWithParameters(digest, parameters):
+    digest.update(json.dumps(parameters, sort_keys=True).encode("utf-8"))
+
+def n4CacheKey(volumeArray, spacing, n4Parameters=None):
+    """Chave do volume corrigido pelo N4."""
+    digest = hashlib.sha1()
+    _updateWithParameters(digest, {"version": CACHE_VERSION, "spacing": [float(x) for x in spacing]})
+    _updateWithArray(digest, volumeArray)
+    _updateWithParameters(digest, n4Parameters or {})
+    return digest.hexdigest()
+
+def resultCacheKey(n4Key, labelArray, ROIValue, cortValue, parameters=None):
+    """Chave da linha de resultados de um exame."""
+    digest = hashlib.sha1()
+    digest.update(n4Key.encode("ascii"))
+    _updateWithArray(digest, labelArray)
+    _updateWithParameters(digest, {"ROIValue": int(ROIValue), "cortValue": int(cortValue)})
+    _updateWithParameters(digest, parameters or {})
+    return digest.hexdigest()
+
+def _toBuiltin(value):
+    # Tipos NumPy (float64, int64) para JSON
+    if hasattr(value, "item"):
+        return value.item()
+    return value
+
+class ResultCache(object):
+    """Cache LRU em disco de volumes N4 e linhas de resultado."""
+
+    def __init__(self, directory, maxBytes=DEFAULT_CACHE_MAX_BYTES):
+        self.directory = directory
+        self.maxBytes = maxBytes
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def _path(self, key, extension):
+        return os.path.join(self.directory, key + extension)
+
+    def _touch(self, path):
+        # Marca o uso da entrada para a remocao LRU
+        os.utime(path, None)
+
+    def getRow(self, key):
+        path = self._path(key, ".json")
+        try:
+            self._touch(path)
+            with open(path) as rowFile:
+                return json.load(rowFile)
+        except (IOError, OSError):
+            # Ausente, ou removida por outro processo
+            return None
+
+    def putRow(self, key, row):
+        self._write(self._path(key, ".json"), lambda f: json.dump([_toBuiltin(v) for v in row], f), "w")
+
+    def getArray(self, key):
+        path = self._path(key, ".npy")
+        try:
+            self._touch(path)
+            return numpy.load(path)
+        except (IOError, OSError):
+            return None
+
+    def putArray(self, key, array):
+        self._write(self._path(key, ".npy"), lambda f: numpy.save(f, array), "wb")
+
+    def _write(self, path, writer, mode):
+        # Grava em um temporario deste processo e substitui a entrada de uma vez,
+        # para nunca deixar entrada pela metade nem misturar gravacoes simultaneas
+        temporaryPath = "%s.%s.%d.tmp" % (path, socket.gethostname(), os.getpid())
+        with open(temporaryPath, mode) as entryFile:
+            writer(entryFile)
+        os.replace(temporaryPath, path)
+        self.evict()
+
+    def size(self):
+        return sum(os.path.getsize(os.path.join(self.directory, name)) for name in os.listdir(self.directory))
+
+    def evict(self):
+        """Remove as entradas usadas ha mais tempo ate caber em maxBytes."""
+        if not self.maxBytes:
+            return
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith(".tmp"):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                entries.append((os.path.getmtime(path), os.path.getsize(path), path))
+            except OSError:
+                continue
+        total = sum(entry[1] for entry in entries)
+        for mtime, size, path in sorted(entries):
+            if total <= self.maxBytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                # Ja removida por outro processo
+                pass
+            total -= size
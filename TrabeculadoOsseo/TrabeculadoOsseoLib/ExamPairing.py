@@ -0,0 +1,125 @@
+import csv
+
+#
+# Pareamento dos volumes com os label maps de cada exame.
+#
+# O indice e montado uma vez, com dicionarios por nome, a partir das listas
+# de volumes e labels (nos da cena ou arquivos): o label de cada volume e
+# encontrado pelo padrao de nome (por padrao "*-label", em que * e o nome
+# do volume) ou por um manifesto com os pares. Volumes gerados pelo proprio
+# processamento (N4ITK, Cast, Inverted, Result...) sao ignorados, para que
+# uma nova execucao nao os trate como exames. Nomes repetidos e volumes sem
+# label sao listados no relatorio antes do processamento.
+#
+
+LABEL_PATTERN_DEFAULT = "*-label"
+
+# Nomes dos volumes criados pelos modulos (sozinhos ou apos o nome do exame)
+DERIVED_VOLUME_NAMES = ("N4ITK", "N4ITK Volume", "Cast Volume", "Inverted Volume", "ROI Volume", "Cropped Volume",
+                        "Cropped Input Volume", "Cropped Label Map", "Result Volume")
+
+def isDerivedName(name):
+    """Indica se o nome e de um volume gerado pelo processamento."""
+    return any(name == derived or name.endswith(" " + derived) for derived in DERIVED_VOLUME_NAMES)
+
+def _splitPattern(pattern):
+    if pattern.count("*") != 1:
+        raise ValueError("O padrao do label deve ter um unico *: %r" % (pattern,))
+    return pattern.split("*")
+
+def labelNameFor(name, pattern=LABEL_PATTERN_DEFAULT):
+    """Nome do label do volume name pelo padrao."""
+    prefix, suffix = _splitPattern(pattern)
+    return prefix + name + suffix
+
+def volumeNameFromLabel(labelName, pattern=LABEL_PATTERN_DEFAULT):
+    """Nome do volume de um label pelo padrao, ou None se o nome nao segue o padrao."""
+    prefix, suffix = _splitPattern(pattern)
+    if len(labelName) <= len(prefix) + len(suffix) or not (labelName.startswith(prefix) and labelName.endswith(suffix)):
+        return None
+    return labelName[len(prefix):len(labelName) - len(suffix)]
+
+def readExamManifest(path):
+    """Pares (volume, label) de um CSV com as colunas volume e label."""
+    with open(path) as manifestFile:
+        return [(row["volume"], row["label"]) for row in csv.DictReader(manifestFile)]
+
+class ExamIndex(object):
+    """Exames pareados e os problemas encontrados no pareamento."""
+
+    def __init__(self):
+        # (nome, volume, label) na ordem dos volumes (ou do manifesto)
+        self.exams = []
+        self.missingLabels = []
+        self.missingVolumes = []
+        self.duplicates = []
+        self.unusedLabels = []
+        self.derived = []
+
+    def isComplete(self):
+        """Todos os volumes tem label e nenhum nome e ambiguo."""
+        return not (self.missingLabels or self.missingVolumes or self.duplicates)
+
+    def report(self):
+        """Texto com os exames encontrados e cada problema do pareamento."""
+        lines = ["%d exames pareados" % len(self.exams)]
+        for title, names in (("Volumes sem label", self.missingLabels),
+                             ("Volumes do manifesto nao encontrados", self.missingVolumes),
+                             ("Nomes repetidos (usado o primeiro)", self.duplicates),
+                             ("Labels sem volume", self.unusedLabels),
+                             ("Volumes gerados ignorados", self.derived)):
+            if names:
+                lines.append("%s (%d): %s" % (title, len(names), ", ".join(names)))
+        return "\n".join(lines)
+
+    def __repr__(self):
+        return "ExamIndex(%d exames)" % len(self.exams)
+
+def _indexByName(items, index):
+    byName = {}
+    for name, item in items:
+        if isDerivedName(name):
+            index.derived.append(name)
+        elif name in byName:
+            if name not in index.duplicates:
+                index.duplicates.append(name)
+        else:
+            byName[name] = item
+    return byName
+
+def buildExamIndex(volumes, labels=(), pattern=LABEL_PATTERN_DEFAULT, manifest=None):
+    """
+    Pareia volumes e labels, listas de (nome, item). Volumes cujo nome segue o
+    padrao do label sao tratados como labels. Com manifest (pares de nomes
+    volume, label), o padrao nao e usado. Retorna um ExamIndex.
+    """
+    index = ExamIndex()
+    volumes = list(volumes)
+    labels = list(labels)
+    if manifest is None:
+        labels.extend((name, item) for name, item in volumes if volumeNameFromLabel(name, pattern) is not None)
+        volumes = [(name, item) for name, item in volumes if volumeNameFromLabel(name, pattern) is None]
+    volumesByName = _indexByName(volumes, index)
+    labelsByName = _indexByName(labels, index)
+
+    if manifest is None:
+        pairs = [(name, labelNameFor(name, pattern)) for name, item in volumes if name in volumesByName]
+    else:
+        pairs = list(manifest)
+
+    seen = set()
+    usedLabels = set()
+    for volumeName, labelName in pairs:
+        if volumeName in seen:
+            continue
+        seen.add(volumeName)
+        if volumeName not in volumesByName:
+            index.missingVolumes.append(volumeName)
+        elif labelName not in labelsByName:
+            index.missingLabels.append(volumeName)
+        else:
+            index.exams.append((volumeName, volumesByName[volumeName], labelsByName[labelName]))
+            usedLabels.add(labelName)
+    index.unusedLabels = [name for name in labelsByName if name not in usedLabels]
+    index.unusedLabels.sort()
+    return index
@@ -0,0 +1,392 @@
+import numpy
+
+from .LabelStatistics import LabelStatistics, iterSlabs, labelExtent, DEFAULT_SLAB_SIZE
+from .Profiling import profileStage, STAGE_CAST, STAGE_STATISTICS, STAGE_ILOW
+from .Background import checkCancelled
+from .BitDepthDetection import resolveMax, bitsForValue, requiresInvertedCheck, checkSlabMax, checkInvertedSlab
+from .Kernels import resolveKernelBackend, castAndInvertNumba, accumulateStatisticsNumba, binarizeNumba, KERNEL_BACKEND_NUMPY, KERNEL_BACKEND_NUMBA
+
+#
+# Nucleo de calculo do FVTO independente do Slicer.
+#
+# Recebe arrays NumPy (volume ja convertido para inteiro e label map, na
+# ordem K, J, I de slicer.util.array), o espacamento do volume e os valores
+# dos labels, e devolve um FVTOResult. Nao depende de Qt, MRML nem de
+# slicer.app, podendo ser usado em nos de cluster ou em benchmarks.
+#
+# As funcoes com backend aceitam KERNEL_BACKEND_NUMBA (ou "auto") para usar
+# os nucleos compilados de Kernels, com os mesmos resultados.
+#
+
+class FVTOResult(object):
+    """Resultado do calculo do FVTO para um exame."""
+
+    columnNames = ["ICort", "ITrab", "Ilow", "FVTO"]
+
+    def __init__(self, ICort, ITrab, ILow, FVTO, Max, histogram=None, roiExtent=None, roiCenterIJK=None, roiRadius=None):
+        self.ICort = ICort
+        self.ITrab = ITrab
+        self.ILow = ILow
+        self.FVTO = FVTO
+        self.Max = Max
+        self.histogram = histogram
+        # ((kMin, kMax), (jMin, jMax), (iMin, iMax)) da ROI mascarada
+        self.roiExtent = roiExtent
+        self.roiCenterIJK = roiCenterIJK
+        self.roiRadius = roiRadius
+
+    @classmethod
+    def fromRow(cls, row, Max=None):
+        """Recria o resultado a partir de uma linha [ICort, ITrab, ILow, FVTO]."""
+        ICort, ITrab, ILow, FVTO = row
+        return cls(ICort, ITrab, ILow, FVTO, Max)
+
+    def asRow(self):
+        return [self.ICort, self.ITrab, self.ILow, self.FVTO]
+
+    def asDict(self):
+        return dict(zip(self.columnNames, self.asRow()))
+
+    def __repr__(self):
+        return "FVTOResult(ICort=%r, ITrab=%r, ILow=%r, FVTO=%r)" % (self.ICort, self.ITrab, self.ILow, self.FVTO)
+
+def detectMaxValue(array):
+    """
+    Retorna o valor maximo (255/4095/16383/65535) conforme o maior voxel; acima
+    de 16 bits, 2**bits - 1 com o menor numero de bits que cobre o maior voxel.
+    """
+    return 2 ** bitsForValue(array.max()) - 1
+
+def invertArray(array, Max):
+    """Inverte os valores dos voxels no proprio array."""
+    array[:] = Max - array
+    return array
+
+def castArray(array):
+    """Mesmo Cast (Int) do Cast Scalar Volume: copia o array como int32, truncando valores reais."""
+    return numpy.asarray(array).astype(numpy.int32)
+
+def castAndInvertArray(array, slabSize=DEFAULT_SLAB_SIZE, cancelEvent=None, backend=KERNEL_BACKEND_NUMPY, bitDepth=None):
+    """
+    Cast (Int) e inversao do volume do N4 sem o modulo CLI: o resultado e o
+    mesmo de castArray seguido de invertVolumeArray, mas o array de entrada so
+    e lido duas vezes (faixa de valores e conversao) e nenhum array temporario
+    do volume inteiro e criado. bitDepth (bits ou BitDepth) evita a leitura da
+    faixa; sem ele o Max e detectado (resolveBitDepth). Um voxel acima do Max de
+    bitDepth levanta ValueError. Retorna (array int32 invertido, Max).
+    """
+    Max = resolveMax(array, bitDepth, slabSize, cancelEvent)
+    check = requiresInvertedCheck(bitDepth)
+    if resolveKernelBackend(backend) == KERNEL_BACKEND_NUMBA:
+        volumeArray = castAndInvertNumba(array, Max, slabSize, cancelEvent)
+        if check:
+            _checkInvertedArray(volumeArray, Max, slabSize, cancelEvent)
+        return volumeArray, Max
+    volumeArray = numpy.empty(array.shape, dtype=numpy.int32)
+    for k0, k1 in iterSlabs(array.shape, slabSize):
+        checkCancelled(cancelEvent)
+        slab = volumeArray[k0:k1]
+        slab[...] = array[k0:k1]
+        numpy.subtract(Max, slab, out=slab)
+        if check:
+            checkInvertedSlab(slab, Max)
+    return volumeArray, Max
+
+def _checkInvertedArray(volumeArray, Max, slabSize=DEFAULT_SLAB_SIZE, cancelEvent=None):
+    for k0, k1 in iterSlabs(volumeArray.shape, slabSize):
+        checkCancelled(cancelEvent)
+        checkInvertedSlab(volumeArray[k0:k1], Max)
+
+# Regras de busca do ILow
+ILOW_RULE_LEGACY = "legacy"      # regra original do modulo (contagem mais proxima da metade do pico)
+ILOW_RULE_FALLING = "falling"    # bin mais proximo da metade do pico, apos o pico
+ILOW_RULE_RISING = "rising"      # bin mais proximo da metade do pico, antes do pico
+ILOW_RULES = (ILOW_RULE_LEGACY, ILOW_RULE_FALLING, ILOW_RULE_RISING)
+
+def findILow(ocorrencias, rule=ILOW_RULE_LEGACY, leadingBins=0):
+    """
+    Procura o ILow (posicao no histograma) pela metade do pico, em O(bins).
+    leadingBins e o numero de bins vazios antes de ocorrencias[0] (histograma
+    com offset, IntegerHistogram.leadingBins): a posicao e a mesma do
+    histograma a partir de 0, sem alocar esses bins.
+    """
+    ocorrencias = numpy.asarray(ocorrencias)
+    halfMax = ocorrencias.max() / 2.0
+
+    if rule == ILOW_RULE_LEGACY:
+        return _findILowLegacy(ocorrencias, halfMax, leadingBins)
+    if rule == ILOW_RULE_FALLING:
+        return leadingBins + _findILowFalling(ocorrencias, halfMax)
+    if rule == ILOW_RULE_RISING:
+        return _findILowRising(ocorrencias, halfMax, leadingBins)
+    raise ValueError("Regra de ILow desconhecida: %r" % (rule,))
+
+def _firstIndexOf(ocorrencias, count, leadingBins=0):
+    # Os bins vazios antes de ocorrencias[0] sao os primeiros com contagem 0
+    if leadingBins and count == 0:
+        return 0
+    return leadingBins + int(numpy.argmax(ocorrencias == count))
+
+def _findILowLegacy(ocorrencias, halfMax, leadingBins=0):
+    # Contagem exatamente igual a metade do pico
+    if (ocorrencias == halfMax).any() or (leadingBins and halfMax == 0):
+        return _firstIndexOf(ocorrencias, halfMax, leadingBins)
+
+    # Menor contagem acima e maior contagem abaixo da metade (primeira ocorrencia de cada)
+    above = ocorrencias > halfMax
+    posterior = _firstIndexOf(ocorrencias, ocorrencias[above].min(), leadingBins)
+    if above.all() and not leadingBins:
+        return posterior
+    below = ocorrencias[~above]
+    anterior = _firstIndexOf(ocorrencias, below.max() if below.size else 0, leadingBins)
+
+    # Mantem a comparacao original (posicao contra contagem)
+    if (posterior - halfMax) <= (halfMax - anterior):
+        return posterior
+    return anterior
+
+def _nearestToHalf(ocorrencias, halfMax, inside, outside):
+    # Entre o ultimo bin acima e o primeiro bin abaixo da metade, escolhe o mais proximo (empate: abaixo)
+    if abs(ocorrencias[inside] - halfMax) < abs(ocorrencias[outside] - halfMax):
+        return int(inside)
+    return int(outside)
+
+def _findILowFalling(ocorrencias, halfMax):
+    peak = int(numpy.argmax(ocorrencias))
+    below = numpy.flatnonzero(ocorrencias[peak:] <= halfMax)
+    if below.size == 0:
+        return ocorrencias.size - 1
+    outside = peak + int(below[0])
+    return _nearestToHalf(ocorrencias, halfMax, outside - 1, outside)
+
+def _findILowRising(ocorrencias, halfMax, leadingBins=0):
+    peak = int(numpy.argmax(ocorrencias))
+    below = numpy.flatnonzero(ocorrencias[:peak + 1] <= halfMax)
+    if below.size == 0:
+        if not leadingBins:
+            return 0
+        # O ultimo bin vazio antes do histograma fica abaixo da metade
+        if abs(ocorrencias[0] - halfMax) < halfMax:
+            return leadingBins
+        return leadingBins - 1
+    outside = int(below[-1])
+    return leadingBins + _nearestToHalf(ocorrencias, halfMax, outside + 1, outside)
+
+def computeFVTO(ITrab, ILow, ICort):
+    return (ITrab - ILow) / (ICort - ILow)
+
+def roiCenterAndRadius(extent, spacing):
+    """
+    Centro (I, J, K) e raios da ROI, com a mesma conta do modulo original (que
+    mistura os espacamentos dos eixos). Mantido em FVTOResult por compatibilidade;
+    o corte usa roiCropExtent.
+    """
+    (kMin, kMax), (jMin, jMax), (iMin, iMax) = extent
+    i = iMax - (iMax - iMin) / 2.0
+    j = jMax - (jMax - jMin) / 2.0
+    k = kMax - (kMax - kMin) / 2.0
+    L = ((kMax - kMin) / 2.0 * spacing[0]) + spacing[0]
+    P = ((iMax - iMin) / 2.0 * spacing[2]) + spacing[1]
+    A = ((jMax - jMin) / 2.0 * spacing[1]) + spacing[1]
+    return [i, j, k], [L, P, A]
+
+def padExtent(extent, margin, shape):
+    """Aumenta os limites em margin voxels em cada direcao, sem sair do volume (shape K, J, I)."""
+    return tuple((max(0, low - margin), min(size - 1, high + margin)) for (low, high), size in zip(extent, shape))
+
+def extentSlices(extent):
+    """Fatias (K, J, I) que recortam o array nos limites (inclusivos)."""
+    return tuple(slice(low, high + 1) for low, high in extent)
+
+def compareResults(reference, result):
+    """Diferenca (result - reference) de cada coluna do resultado."""
+    return dict((name, value - referenceValue) for name, value, referenceValue in zip(FVTOResult.columnNames, result.asRow(), reference.asRow()))
+
+def binarizeArray(array, threshold, Max):
+    """Binariza o array no proprio lugar: abaixo do limiar vira 0, o resto vira Max."""
+    array[array < threshold] = 0
+    array[array >= threshold] = Max
+    return array
+
+def roiCropExtent(result, shape, padding=0):
+    """
+    Limites (K, J, I) do corte da ROI: os limites dos voxels do label, com padding
+    voxels de margem sem sair do volume (shape K, J, I), ou None se a ROI estiver vazia.
+    """
+    if result.roiExtent is None:
+        return None
+    return padExtent(result.roiExtent, padding, shape)
+
+def binarizedROI(volumeArray, labelArray, ROIValue, result, padding=0, backend=KERNEL_BACKEND_NUMPY):
+    """
+    Recorta o volume invertido nos limites da ROI (direto no espaco de indices,
+    sem copiar o volume), zera o que esta fora do label e binariza pelo ITrab.
+    Retorna um novo array (0/Max) ou None se a ROI estiver vazia.
+    """
+    extent = roiCropExtent(result, volumeArray.shape, padding)
+    if extent is None:
+        return None
+    box = extentSlices(extent)
+    if resolveKernelBackend(backend) == KERNEL_BACKEND_NUMBA:
+        roiArray = numpy.empty(volumeArray[box].shape, dtype=volumeArray.dtype)
+        return binarizeNumba(volumeArray[box], labelArray[box], ROIValue, result.ITrab, result.Max, roiArray)
+    roiArray = numpy.where(labelArray[box] == ROIValue, volumeArray[box], 0)
+    return binarizeArray(roiArray, result.ITrab, result.Max)
+
+def binarizedROIMask(volumeArray, labelArray, ROIValue, result, slabSize=DEFAULT_SLAB_SIZE, cancelEvent=None, padding=0, backend=KERNEL_BACKEND_NUMPY):
+    """
+    Versao de pouca memoria de binarizedROI: uma passada por slab, sem copia do
+    volume, gravando direto uma mascara uint8 (1 = trabeculado, 0 = fundo).
+    """
+    extent = roiCropExtent(result, volumeArray.shape, padding)
+    if extent is None:
+        return None
+    box = extentSlices(extent)
+    volumeBox = volumeArray[box]
+    labelBox = labelArray[box]
+    mask = numpy.empty(volumeBox.shape, dtype=numpy.uint8)
+    compiled = resolveKernelBackend(backend) == KERNEL_BACKEND_NUMBA
+    for k0, k1 in iterSlabs(volumeBox.shape, slabSize):
+        checkCancelled(cancelEvent)
+        if compiled:
+            binarizeNumba(volumeBox[k0:k1], labelBox[k0:k1], ROIValue, result.ITrab, 1, mask[k0:k1], outsideLabel=False)
+            continue
+        numpy.greater_equal(volumeBox[k0:k1], result.ITrab, out=mask[k0:k1])
+        mask[k0:k1] &= (labelBox[k0:k1] == ROIValue)
+    return mask
+
+def createStatistics(ROIValue, cortValue, Max=None, histogramBinWidth=1):
+    """
+    Acumulador das estatisticas do osso cortical e da ROI. O histograma da ROI
+    cobre a faixa dos valores da ROI ate Max (valores acima, vindos de voxels
+    negativos antes da inversao, sao contados como overflow); as medias usam
+    todos os voxels.
+    """
+    histogramMaxValue = Max if Max else None
+    return LabelStatistics([cortValue, ROIValue], histogramLabels=[ROIValue], extentLabels=[ROIValue],
+                           histogramBinWidth=histogramBinWidth, histogramMaxValue=histogramMaxValue, histogramOffset=None)
+
+def computeStatistics(volumeArray, labelArray, ROIValue, cortValue, Max=None, slabSize=DEFAULT_SLAB_SIZE, cancelEvent=None, histogramBinWidth=1, invert=True, backend=KERNEL_BACKEND_NUMPY):
+    """
+    Percorre o volume uma unica vez acumulando as estatisticas do osso cortical e da ROI.
+    Se Max for informado, cada slab e invertido no proprio lugar antes de ser acumulado
+    (com invert=False o volume ja deve estar invertido e Max so limita o histograma).
+    Com cancelEvent (threading.Event) levanta PipelineCancelled entre os slabs quando o evento e ativado.
+    """
+    statistics = createStatistics(ROIValue, cortValue, Max, histogramBinWidth)
+    if Max and resolveKernelBackend(backend) == KERNEL_BACKEND_NUMBA:
+        target = volumeArray if invert else None
+        if accumulateStatisticsNumba(statistics, volumeArray, labelArray, ROIValue, cortValue, Max, invert=invert, target=target, slabSize=slabSize, cancelEvent=cancelEvent):
+            return statistics
+        # Voxels negativos na ROI: o volume, ja invertido, e acumulado pelo NumPy
+        statistics = createStatistics(ROIValue, cortValue, Max, histogramBinWidth)
+        invert = False
+    for k0, k1 in iterSlabs(volumeArray.shape, slabSize):
+        checkCancelled(cancelEvent)
+        volumeSlab = volumeArray[k0:k1]
+        if Max is not None and invert:
+            invertArray(volumeSlab, Max)
+        statistics.update(volumeSlab, labelArray[k0:k1], k0)
+    return statistics
+
+def run(volumeArray, labelArray, ROIValue, cortValue, spacing=(1.0, 1.0, 1.0), copy=True, slabSize=DEFAULT_SLAB_SIZE, ILowRule=ILOW_RULE_LEGACY, profile=None, cancelEvent=None, histogramBinWidth=1, backend=KERNEL_BACKEND_NUMPY, bitDepth=None):
+    """
+    Calcula ICort, ITrab, ILow e FVTO.
+    volumeArray deve ser o volume convertido para inteiro (antes da inversao);
+    com copy=False ele e invertido no proprio lugar.
+    Com profile (StageProfile), registra as etapas Statistics e ILow.
+    Com cancelEvent, pode ser interrompido (PipelineCancelled) entre os slabs.
+    histogramBinWidth agrupa as intensidades no histograma do ILow; com 1 (padrao)
+    o resultado e o mesmo do modulo original. backend escolhe os nucleos (Kernels).
+    bitDepth (bits ou BitDepth) define o Max da inversao; None detecta pelos dados.
+    Um voxel acima do Max de bitDepth levanta ValueError.
+    """
+    if copy:
+        volumeArray = volumeArray.copy()
+
+    # Inverter voxels do Volume e acumular ICort, ITrab, histograma e limites da ROI
+    with profileStage(profile, STAGE_STATISTICS, volumeArray.size):
+        Max = resolveMax(volumeArray, bitDepth, slabSize, cancelEvent)
+        invert = True
+        if requiresInvertedCheck(bitDepth):
+            # Max nao conferido com os dados: inverte e verifica antes das estatisticas
+            _invertSlabs(volumeArray, Max, slabSize, cancelEvent, check=True)
+            invert = False
+        statistics = computeStatistics(volumeArray, labelArray, ROIValue, cortValue, Max, slabSize, cancelEvent, histogramBinWidth, invert=invert, backend=backend)
+
+    return resultFromStatistics(statistics, ROIValue, cortValue, Max, spacing, ILowRule, profile)
+
+def invertVolumeArray(volumeArray, slabSize=DEFAULT_SLAB_SIZE, cancelEvent=None, bitDepth=None):
+    """
+    Inverte o volume no proprio lugar, slab por slab, pelo Max de bitDepth ou
+    detectado. Um voxel acima do Max de bitDepth levanta ValueError. Retorna o Max.
+    """
+    Max = resolveMax(volumeArray, bitDepth, slabSize, cancelEvent)
+    _invertSlabs(volumeArray, Max, slabSize, cancelEvent, requiresInvertedCheck(bitDepth))
+    return Max
+
+def _invertSlabs(volumeArray, Max, slabSize=DEFAULT_SLAB_SIZE, cancelEvent=None, check=False):
+    for k0, k1 in iterSlabs(volumeArray.shape, slabSize):
+        checkCancelled(cancelEvent)
+        slab = volumeArray[k0:k1]
+        if check:
+            # Antes da inversao, que nos tipos sem sinal daria a volta em vez de ficar negativa
+            checkSlabMax(slab, Max)
+        invertArray(slab, Max)
+
+def runInverted(volumeArray, labelArray, ROIValue, cortValue, Max, spacing=(1.0, 1.0, 1.0), slabSize=DEFAULT_SLAB_SIZE, ILowRule=ILOW_RULE_LEGACY, profile=None, cancelEvent=None, histogramBinWidth=1, backend=KERNEL_BACKEND_NUMPY):
+    """
+    Mesmo calculo de run para um volume ja invertido por invertVolumeArray, que
+    nao e alterado: permite recalcular com outros labels sem refazer a inversao.
+    """
+    with profileStage(profile, STAGE_STATISTICS, volumeArray.size):
+        statistics = computeStatistics(volumeArray, labelArray, ROIValue, cortValue, Max, slabSize, cancelEvent, histogramBinWidth, invert=False, backend=backend)
+
+    return resultFromStatistics(statistics, ROIValue, cortValue, Max, spacing, ILowRule, profile)
+
+def castInvertAndRun(array, labelArray, ROIValue, cortValue, spacing=(1.0, 1.0, 1.0), slabSize=DEFAULT_SLAB_SIZE, ILowRule=ILOW_RULE_LEGACY, profile=None, cancelEvent=None, histogramBinWidth=1, backend=KERNEL_BACKEND_NUMPY, bitDepth=None):
+    """
+    castAndInvertArray seguido de runInverted para o volume do N4. Com o backend
+    numba, o Cast, a inversao e as estatisticas sao feitos em uma unica passada
+    pelos voxels (registrada na etapa Statistics). Retorna (array int32 invertido, FVTOResult).
+    """
+    if resolveKernelBackend(backend) != KERNEL_BACKEND_NUMBA:
+        with profileStage(profile, STAGE_CAST, array.size):
+            volumeArray, Max = castAndInvertArray(array, slabSize, cancelEvent, bitDepth=bitDepth)
+        result = runInverted(volumeArray, labelArray, ROIValue, cortValue, Max, spacing, slabSize, ILowRule, profile, cancelEvent, histogramBinWidth)
+        return volumeArray, result
+
+    with profileStage(profile, STAGE_STATISTICS, array.size):
+        Max = resolveMax(array, bitDepth, slabSize, cancelEvent)
+        volumeArray = numpy.empty(array.shape, dtype=numpy.int32)
+        statistics = createStatistics(ROIValue, cortValue, Max, histogramBinWidth)
+        if not Max or not accumulateStatisticsNumba(statistics, array, labelArray, ROIValue, cortValue, Max, cast=True, target=volumeArray, slabSize=slabSize, cancelEvent=cancelEvent):
+            # Histograma sem limite ou voxels negativos na ROI: estatisticas pelo NumPy
+            if not Max:
+                volumeArray = castAndInvertNumba(array, Max, slabSize, cancelEvent)
+            statistics = computeStatistics(volumeArray, labelArray, ROIValue, cortValue, Max, slabSize, cancelEvent, histogramBinWidth, invert=False)
+        if requiresInvertedCheck(bitDepth):
+            _checkInvertedArray(volumeArray, Max, slabSize, cancelEvent)
+
+    return volumeArray, resultFromStatistics(statistics, ROIValue, cortValue, Max, spacing, ILowRule, profile)
+
+def resultFromStatistics(statistics, ROIValue, cortValue, Max, spacing=(1.0, 1.0, 1.0), ILowRule=ILOW_RULE_LEGACY, profile=None):
+    """FVTOResult a partir das estatisticas acumuladas do volume ja invertido."""
+    ICort = statistics.mean(cortValue)
+    ITrab = statistics.mean(ROIValue)
+    histogram = statistics.histogram(ROIValue)
+    ocorrencias = histogram.counts                         #contar ocorrencias a partir do offset do histograma
+
+    # Encontrar ILow e FVTO (posicao contada a partir de 0, como no histograma original)
+    with profileStage(profile, STAGE_ILOW, statistics.count(ROIValue)):
+        leadingBins = histogram.leadingBins()
+        ILow = histogram.binValue(findILow(ocorrencias, ILowRule, leadingBins) - leadingBins)
+        FVTO = computeFVTO(ITrab, ILow, ICort)
+
+    # Limites da ROI para o corte
+    extent = statistics.extent(ROIValue)
+    center, radius = (None, None)
+    if extent is not None:
+        center, radius = roiCenterAndRadius(extent, spacing)
+
+    return FVTOResult(ICort, ITrab, ILow, FVTO, Max, ocorrencias, extent, center, radius)
@@ -0,0 +1,119 @@
+import numpy
+
+#
+# Histograma de inteiros usado no ITrab/ILow.
+#
+# Os bins tem largura fixa e comecam em offset (por padrao 0, de modo que a
+# posicao do bin e o proprio valor, como no modulo original). Com offset
+# None, o offset e escolhido pelo menor valor acumulado (alinhado a grade
+# de binWidth), e os bins cobrem so a faixa dos dados: acima de 16 bits o
+# histograma a partir de 0 teria ate 2**31 bins. Valores
+# negativos (possiveis apos o N4) deslocam o offset para baixo em vez de
+# falhar, e valores acima de maxValue (o maximo da profundidade de bits)
+# sao contados em overflow em vez de alocar bins ate o voxel mais alto.
+# Histogramas parciais de slabs ou threads sao somados com merge.
+#
+# Os valores sao contados no dtype em que chegam: numpy.bincount converte
+# a entrada para intp, entao reduzir para uint8/uint16 antes so acrescenta
+# uma copia. A profundidade de bits entra como limite (maxValue) dos bins.
+#
+
+class IntegerHistogram(object):
+    """Contagens de valores inteiros em bins [offset + n*binWidth, offset + (n+1)*binWidth)."""
+
+    def __init__(self, binWidth=1, maxValue=None, offset=0):
+        if binWidth < 1:
+            raise ValueError("binWidth deve ser pelo menos 1")
+        self.binWidth = int(binWidth)
+        self.maxValue = maxValue
+        self.offset = int(offset) if offset is not None else None
+        self.counts = numpy.zeros(0, dtype=numpy.int64)
+        self.overflow = 0
+
+    @classmethod
+    def fromCounts(cls, counts, binWidth=1, maxValue=None, offset=0, overflow=0):
+        """Histograma com contagens ja calculadas (bin 0 comecando em offset)."""
+        histogram = cls(binWidth, maxValue, offset)
+        histogram.counts = numpy.asarray(counts, dtype=numpy.int64)
+        histogram.overflow = int(overflow)
+        return histogram
+
+    def _fitOffset(self, minValue):
+        # Primeiro valor de um histograma com offset None: bin do menor valor na grade a partir de 0
+        if self.offset is None:
+            self.offset = (int(minValue) // self.binWidth) * self.binWidth
+
+    def _growLeft(self, newOffset):
+        extraBins = (self.offset - newOffset) // self.binWidth
+        self.counts = numpy.concatenate([numpy.zeros(extraBins, dtype=numpy.int64), self.counts])
+        self.offset = newOffset
+
+    def _addCounts(self, partial, firstBin=0, owned=False):
+        # owned: partial e um array novo, que pode virar as contagens de um histograma vazio
+        if owned and self.counts.size == 0 and firstBin == 0:
+            self.counts = partial.astype(numpy.int64, copy=False)
+            return
+        end = firstBin + partial.size
+        if end > self.counts.size:
+            counts = numpy.zeros(end, dtype=numpy.int64)
+            counts[:self.counts.size] = self.counts
+            self.counts = counts
+        self.counts[firstBin:end] += partial
+
+    def add(self, values):
+        """Acumula um array de inteiros."""
+        values = numpy.asarray(values).ravel()
+        if values.size == 0:
+            return
+        if self.maxValue is not None:
+            above = values > self.maxValue
+            overflow = int(numpy.count_nonzero(above))
+            if overflow:
+                self.overflow += overflow
+                values = values[~above]
+                if values.size == 0:
+                    return
+
+        # Caminho direto: bins unitarios a partir de 0 e nenhum valor negativo
+        minValue = int(values.min())
+        self._fitOffset(minValue)
+        if self.binWidth == 1 and self.offset == 0 and minValue >= 0:
+            self._addCounts(numpy.bincount(values), owned=True)
+            return
+
+        if minValue < self.offset:
+            # Alinha o novo offset a grade de bins atual
+            self._growLeft(self.offset - ((self.offset - minValue + self.binWidth - 1) // self.binWidth) * self.binWidth)
+        shifted = values.astype(numpy.int64) - self.offset
+        if self.binWidth > 1:
+            shifted //= self.binWidth
+        self._addCounts(numpy.bincount(shifted), owned=True)
+
+    def merge(self, other):
+        """Soma outro histograma com a mesma largura de bin e grade alinhada."""
+        if other.offset is None:
+            # Histograma vazio com offset ainda nao escolhido
+            self.overflow += other.overflow
+            return self
+        self._fitOffset(other.offset)
+        if other.binWidth != self.binWidth or (other.offset - self.offset) % self.binWidth:
+            raise ValueError("Histogramas com bins incompativeis")
+        if other.offset < self.offset:
+            self._growLeft(other.offset)
+        self._addCounts(other.counts, (other.offset - self.offset) // self.binWidth)
+        self.overflow += other.overflow
+        return self
+
+    def binValue(self, index):
+        """Valor inicial do bin na posicao index."""
+        return (self.offset or 0) + int(index) * self.binWidth
+
+    def leadingBins(self):
+        """Bins vazios entre o valor 0 e o offset (0 com offset negativo)."""
+        return max(self.offset or 0, 0) // self.binWidth
+
+    def total(self):
+        return int(self.counts.sum()) + self.overflow
+
+    def __repr__(self):
+        return "IntegerHistogram(offset=%r, binWidth=%d, bins=%d, overflow=%d)" % (self.offset, self.binWidth, self.counts.size, self.overflow)
@@ -0,0 +1,38 @@
+#
+# Estado do pipeline mantido entre execucoes do modulo.
+#
+# Cada etapa guarda a chave dos parametros de que depende e as saidas que
+# produziu. A chave de uma etapa inclui a chave da etapa anterior, de modo
+# que a mudanca de um parametro invalida a propria etapa e todas as
+# seguintes, enquanto as anteriores sao reaproveitadas. As chaves devem ser
+# comparaveis por igualdade (tuplas, numeros, textos, dicts).
+#
+
+class PipelineState(object):
+    """Saidas da ultima execucao de cada etapa, indexadas pela chave dos parametros."""
+
+    def __init__(self):
+        self.entries = {}
+
+    def lookup(self, stageName, key, isValid=None):
+        """
+        Saidas guardadas da etapa se a chave for a mesma, ou None.
+        isValid(saidas) confere se as saidas ainda podem ser usadas (por exemplo,
+        se os nos ainda estao na cena); se nao puderem, a etapa e descartada.
+        """
+        entry = self.entries.get(stageName)
+        if entry is None or entry[0] != key:
+            return None
+        if isValid is not None and not isValid(entry[1]):
+            del self.entries[stageName]
+            return None
+        return entry[1]
+
+    def store(self, stageName, key, outputs):
+        self.entries[stageName] = (key, outputs)
+
+    def discard(self, stageName):
+        self.entries.pop(stageName, None)
+
+    def clear(self):
+        self.entries.clear()
@@ -0,0 +1,256 @@
+import numpy
+
+from .Histogram import IntegerHistogram
+from .LabelStatistics import iterSlabs, DEFAULT_SLAB_SIZE
+from .Background import checkCancelled
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+#
+# Nucleos compilados (Numba) das etapas por voxel do FVTO.
+#
+# Com o backend "numba", o Cast, a inversao, as somas e contagens do
+# cortical e da ROI, o histograma e os limites da ROI sao feitos em uma
+# unica passada paralela pelos voxels (sem as mascaras e copias de
+# volumeSlab[mask]), e a binarizacao pelo ITrab em outra, ja que o ITrab
+# so e conhecido no fim da primeira. Cada thread acumula em sua propria
+# linha dos contadores, somados no final. Os resultados sao os mesmos do
+# backend "numpy", usado quando o Numba nao esta instalado ("auto") ou
+# quando o histograma nao tem limite (Max 0). Acima de 16 bits, uma passada
+# previa acha a faixa dos valores da ROI e o histograma de cada thread cobre
+# so essa faixa, e nao de 0 a Max.
+#
+
+# Acima deste numero de bins, o histograma e limitado a faixa dos valores da ROI
+RANGE_SCAN_BINS = 2 ** 16
+# Limite de bins somados de todas as threads (128 MB em int64); acima dele, menos
+# threads acumulam o histograma, que no pior caso e um so, como no backend numpy
+MAX_HISTOGRAM_CELLS = 2 ** 24
+
+KERNEL_BACKEND_AUTO = "auto"
+KERNEL_BACKEND_NUMPY = "numpy"
+KERNEL_BACKEND_NUMBA = "numba"
+KERNEL_BACKENDS = (KERNEL_BACKEND_AUTO, KERNEL_BACKEND_NUMPY, KERNEL_BACKEND_NUMBA)
+
+def numbaAvailable():
+    return numba is not None
+
+def requireNumba():
+    if numba is None:
+        raise ImportError("Numba nao encontrado: instale com 'pip install numba' ou use o backend numpy")
+    return numba
+
+def resolveKernelBackend(backend):
+    """Backend efetivo: "auto" vira "numba" se o Numba estiver instalado, senao "numpy"."""
+    if backend == KERNEL_BACKEND_AUTO:
+        return KERNEL_BACKEND_NUMBA if numbaAvailable() else KERNEL_BACKEND_NUMPY
+    if backend == KERNEL_BACKEND_NUMBA:
+        requireNumba()
+    elif backend != KERNEL_BACKEND_NUMPY:
+        raise ValueError("Backend de calculo desconhecido: %r" % (backend,))
+    return backend
+
+if numba is not None:
+    @numba.njit(parallel=True)
+    def _castInvertKernel(source, target, Max):
+        K, J, I = source.shape
+        for row in numba.prange(K * J):
+            k = row // J
+            j = row % J
+            for i in range(I):
+                target[k, j, i] = Max - numpy.int32(source[k, j, i])
+
+    @numba.njit
+    def _voxelValue(voxel, cast, invert, Max):
+        # Valor do voxel apos o Cast (Int) e a inversao, como nos backends NumPy
+        if cast:
+            value = numpy.int64(numpy.int32(voxel))
+        else:
+            value = numpy.int64(voxel)
+        if invert:
+            value = numpy.int64(numpy.int32(Max - value))
+        return value
+
+    @numba.njit(parallel=True)
+    def _convertKernel(source, target, cast, invert, Max):
+        K, J, I = source.shape
+        for row in numba.prange(K * J):
+            k = row // J
+            j = row % J
+            for i in range(I):
+                target[k, j, i] = _voxelValue(source[k, j, i], cast, invert, Max)
+
+    @numba.njit(parallel=True)
+    def _roiRangeKernel(source, label, cast, invert, Max, ROIValue, ranges):
+        # Menor e maior valor (apos Cast e inversao) dos voxels da ROI, por thread
+        K, J, I = source.shape
+        chunks = ranges.shape[0]
+        rows = K * J
+        for c in numba.prange(chunks):
+            for row in range(c * rows // chunks, (c + 1) * rows // chunks):
+                k = row // J
+                j = row % J
+                for i in range(I):
+                    if label[k, j, i] == ROIValue:
+                        value = _voxelValue(source[k, j, i], cast, invert, Max)
+                        if value < ranges[c, 0]:
+                            ranges[c, 0] = value
+                        if value > ranges[c, 1]:
+                            ranges[c, 1] = value
+
+    @numba.njit(parallel=True)
+    def _statisticsKernel(source, label, target, cast, invert, write, Max, cortValue, ROIValue, binWidth, histogramOffset, kOffset,
+                          counts, sums, histogram, overflow, negative, extents):
+        # Linha c dos contadores: voxels do bloco de linhas (k, j) da thread c
+        K, J, I = source.shape
+        chunks = counts.shape[0]
+        rows = K * J
+        for c in numba.prange(chunks):
+            for row in range(c * rows // chunks, (c + 1) * rows // chunks):
+                k = row // J
+                j = row % J
+                for i in range(I):
+                    value = _voxelValue(source[k, j, i], cast, invert, Max)
+                    if write:
+                        target[k, j, i] = value
+                    labelValue = label[k, j, i]
+                    if labelValue == cortValue:
+                        counts[c, 0] += 1
+                        sums[c, 0] += value
+                    if labelValue == ROIValue:
+                        counts[c, 1] += 1
+                        sums[c, 1] += value
+                        if value > Max:
+                            overflow[c] += 1
+                        elif value < 0:
+                            negative[c] += 1
+                        else:
+                            histogram[c, (value - histogramOffset) // binWidth] += 1
+                        if value > 0:
+                            extent = extents[c]
+                            if k + kOffset < extent[0]:
+                                extent[0] = k + kOffset
+                            if k + kOffset > extent[1]:
+                                extent[1] = k + kOffset
+                            if j < extent[2]:
+                                extent[2] = j
+                            if j > extent[3]:
+                                extent[3] = j
+                            if i < extent[4]:
+                                extent[4] = i
+                            if i > extent[5]:
+                                extent[5] = i
+
+    @numba.njit(parallel=True)
+    def _binarizeKernel(volume, label, ROIValue, ITrab, onValue, outsideLabel, out):
+        # Mesmo criterio de binarizedROI (fora do label o voxel vale 0) ou de binarizedROIMask
+        K, J, I = volume.shape
+        for row in numba.prange(K * J):
+            k = row // J
+            j = row % J
+            for i in range(I):
+                inside = label[k, j, i] == ROIValue and volume[k, j, i] >= ITrab
+                if outsideLabel and 0 >= ITrab:
+                    # binarizeArray leva a Max tambem os voxels zerados
+                    inside = True
+                out[k, j, i] = onValue if inside else 0
+
+def castAndInvertNumba(array, Max, slabSize=DEFAULT_SLAB_SIZE, cancelEvent=None):
+    """Cast (Int) e inversao pelo Max em uma passada paralela. Retorna o array int32."""
+    requireNumba()
+    volumeArray = numpy.empty(array.shape, dtype=numpy.int32)
+    for k0, k1 in iterSlabs(array.shape, slabSize):
+        checkCancelled(cancelEvent)
+        _castInvertKernel(array[k0:k1], volumeArray[k0:k1], numpy.int32(Max))
+    return volumeArray
+
+def accumulateStatisticsNumba(statistics, source, labelArray, ROIValue, cortValue, Max, cast=False, invert=True, target=None, slabSize=DEFAULT_SLAB_SIZE, cancelEvent=None):
+    """
+    Acumula em statistics (de createStatistics, com o histograma limitado a Max)
+    o volume source, em uma passada por slab. Com cast, os voxels sao
+    convertidos para int32 como no Cast (Int); com invert, invertidos pelo Max.
+    Com target (int32, mesmo shape), os valores convertidos sao gravados nele
+    (pode ser o proprio source). Retorna False, sem alterar statistics, se algum
+    voxel da ROI ficar negativo (o histograma do backend numpy muda o offset).
+    Com mais de RANGE_SCAN_BINS bins ate o Max, o histograma de cada thread
+    cobre so a faixa dos valores da ROI, lida antes em outra passada, e o
+    numero de threads e reduzido se os histogramas passarem de MAX_HISTOGRAM_CELLS.
+    """
+    requireNumba()
+    binWidth = statistics.histogram(ROIValue).binWidth
+    chunks = numba.get_num_threads()
+    histogramOffset = 0
+    bins = Max // binWidth + 1
+    if bins > RANGE_SCAN_BINS:
+        ranges = numpy.empty((chunks, 2), dtype=numpy.int64)
+        ranges[:, 0] = numpy.iinfo(numpy.int64).max
+        ranges[:, 1] = numpy.iinfo(numpy.int64).min
+        for k0, k1 in iterSlabs(source.shape, slabSize):
+            checkCancelled(cancelEvent)
+            _roiRangeKernel(source[k0:k1], labelArray[k0:k1], cast, invert, Max, ROIValue, ranges)
+        lowest, highest = int(ranges[:, 0].min()), int(ranges[:, 1].max())
+        if lowest < 0:
+            # Mesmo resultado da passada completa: target convertido e statistics inalterado
+            if target is not None:
+                for k0, k1 in iterSlabs(source.shape, slabSize):
+                    checkCancelled(cancelEvent)
+                    _convertKernel(source[k0:k1], target[k0:k1], cast, invert, Max)
+            return False
+        if lowest <= highest:
+            # Bins de lowest ate o maior valor da ROI que nao passa do Max, na grade a partir de 0
+            histogramOffset = (lowest // binWidth) * binWidth
+            bins = max((min(highest, Max) - histogramOffset) // binWidth + 1, 1)
+        else:
+            bins = 1
+        chunks = max(1, min(chunks, MAX_HISTOGRAM_CELLS // bins))
+    counts = numpy.zeros((chunks, 2), dtype=numpy.int64)
+    sums = numpy.zeros((chunks, 2), dtype=numpy.int64)
+    histogram = numpy.zeros((chunks, bins), dtype=numpy.int64)
+    overflow = numpy.zeros(chunks, dtype=numpy.int64)
+    negative = numpy.zeros(chunks, dtype=numpy.int64)
+    extents = numpy.empty((chunks, 6), dtype=numpy.int64)
+    extents[:, 0::2] = numpy.iinfo(numpy.int64).max
+    extents[:, 1::2] = -1
+    write = target is not None
+    if not write:
+        target = numpy.empty((1, 1, 1), dtype=numpy.int32)
+
+    for k0, k1 in iterSlabs(source.shape, slabSize):
+        checkCancelled(cancelEvent)
+        _statisticsKernel(source[k0:k1], labelArray[k0:k1], target[k0:k1] if write else target, cast, invert, write,
+                          Max, cortValue, ROIValue, binWidth, histogramOffset, k0, counts, sums, histogram, overflow, negative, extents)
+    if negative.any():
+        return False
+
+    # Com cortValue igual a ROIValue as duas colunas tem os mesmos voxels e o label so e somado uma vez
+    totals = dict((value, (int(counts[:, column].sum()), int(sums[:, column].sum()))) for column, value in ((0, cortValue), (1, ROIValue)))
+    for value, (count, total) in totals.items():
+        statistics.counts[value] += count
+        statistics.sums[value] += total
+    ocorrencias = histogram[0] if chunks == 1 else histogram.sum(axis=0)
+    # Como no backend numpy, o histograma vai do menor ao maior bin ocupado
+    occupied = numpy.flatnonzero(ocorrencias)
+    if occupied.size:
+        histogramOffset += int(occupied[0]) * binWidth
+        ocorrencias = ocorrencias[occupied[0]:occupied[-1] + 1]
+    else:
+        ocorrencias = ocorrencias[:0]
+    statistics.histogram(ROIValue).merge(IntegerHistogram.fromCounts(ocorrencias, binWidth, Max, histogramOffset, int(overflow.sum())))
+    if extents[:, 1].max() >= 0:
+        statistics._mergeExtent(ROIValue, ((int(extents[:, 0].min()), int(extents[:, 1].max())),
+                                           (int(extents[:, 2].min()), int(extents[:, 3].max())),
+                                           (int(extents[:, 4].min()), int(extents[:, 5].max()))))
+    return True
+
+def binarizeNumba(volumeBox, labelBox, ROIValue, ITrab, onValue, out, outsideLabel=True):
+    """
+    Grava em out a binarizacao pelo ITrab dos voxels do label: onValue onde o voxel
+    >= ITrab, 0 no resto. Com outsideLabel, os voxels fora do label valem 0 antes do
+    limiar, como em binarizedROI; sem ele, como em binarizedROIMask.
+    """
+    requireNumba()
+    _binarizeKernel(volumeBox, labelBox, ROIValue, float(ITrab), onValue, outsideLabel, out)
+    return out
@@ -0,0 +1,101 @@
+import numpy
+
+from .Histogram import IntegerHistogram
+
+#
+# Estatisticas por label acumuladas em uma unica varredura do volume.
+#
+# O volume e percorrido em fatias (slabs) ao longo de K. Para cada label
+# acompanhado sao acumulados contagem, soma, histograma e limites (bounding
+# box), sem criar os arrays de coordenadas de numpy.where. A memoria
+# temporaria fica limitada ao tamanho de um slab. Acumuladores de slabs
+# diferentes (por exemplo, de threads) podem ser somados com merge.
+#
+
+DEFAULT_SLAB_SIZE = 16
+
+class LabelStatistics(object):
+    """Acumulador de contagem, soma, histograma e limites por label."""
+
+    def __init__(self, labelValues, histogramLabels=(), extentLabels=(), histogramBinWidth=1, histogramMaxValue=None, histogramOffset=0):
+        self.labelValues = []
+        for value in labelValues:
+            if value not in self.labelValues:
+                self.labelValues.append(value)
+        self.histogramLabels = set(histogramLabels)
+        self.extentLabels = set(extentLabels)
+        self.counts = dict((value, 0) for value in self.labelValues)
+        self.sums = dict((value, 0) for value in self.labelValues)
+        self.histograms = dict((value, IntegerHistogram(histogramBinWidth, histogramMaxValue, histogramOffset)) for value in self.histogramLabels)
+        self.extents = dict((value, None) for value in self.extentLabels)
+
+    def update(self, volumeSlab, labelSlab, kOffset=0):
+        """Acumula um slab (K, J, I) cuja primeira fatia e kOffset."""
+        for value in self.labelValues:
+            mask = (labelSlab == value)
+            values = volumeSlab[mask]
+            if values.size == 0:
+                continue
+            self.counts[value] += values.size
+            self.sums[value] += int(values.sum(dtype=numpy.int64))
+            if value in self.histogramLabels:
+                self.histograms[value].add(values)
+            if value in self.extentLabels:
+                mask &= (volumeSlab > 0)
+                self._addExtent(value, mask, kOffset)
+
+    def _addExtent(self, value, mask, kOffset):
+        ks = numpy.flatnonzero(mask.any(axis=(1, 2)))
+        if ks.size == 0:
+            return
+        js = numpy.flatnonzero(mask.any(axis=(0, 2)))
+        iz = numpy.flatnonzero(mask.any(axis=(0, 1)))
+        slabExtent = ((int(ks[0]) + kOffset, int(ks[-1]) + kOffset), (int(js[0]), int(js[-1])), (int(iz[0]), int(iz[-1])))
+        self._mergeExtent(value, slabExtent)
+
+    def _mergeExtent(self, value, otherExtent):
+        extent = self.extents[value]
+        if extent is None:
+            self.extents[value] = otherExtent
+        elif otherExtent is not None:
+            self.extents[value] = tuple((min(a[0], b[0]), max(a[1], b[1])) for a, b in zip(extent, otherExtent))
+
+    def merge(self, other):
+        """Soma as estatisticas de outro acumulador com os mesmos labels (por exemplo, de outros slabs)."""
+        for value in self.labelValues:
+            self.counts[value] += other.counts[value]
+            self.sums[value] += other.sums[value]
+        for value in self.histogramLabels:
+            self.histograms[value].merge(other.histograms[value])
+        for value in self.extentLabels:
+            self._mergeExtent(value, other.extents[value])
+        return self
+
+    def count(self, value):
+        return self.counts[value]
+
+    def mean(self, value):
+        if self.counts[value] == 0:
+            return float('nan')
+        return numpy.float64(self.sums[value]) / self.counts[value]
+
+    def histogram(self, value):
+        """IntegerHistogram dos valores do label."""
+        return self.histograms[value]
+
+    def extent(self, value):
+        """((kMin, kMax), (jMin, jMax), (iMin, iMax)) dos voxels nao nulos do label, ou None."""
+        return self.extents[value]
+
+def labelExtent(labelArray, labelValues, slabSize=DEFAULT_SLAB_SIZE):
+    """((kMin, kMax), (jMin, jMax), (iMin, iMax)) dos voxels com qualquer um dos labels, ou None."""
+    statistics = LabelStatistics([], extentLabels=[0])
+    labelValues = list(labelValues)
+    for k0, k1 in iterSlabs(labelArray.shape, slabSize):
+        statistics._addExtent(0, numpy.isin(labelArray[k0:k1], labelValues), k0)
+    return statistics.extent(0)
+
+def iterSlabs(shape, slabSize=DEFAULT_SLAB_SIZE):
+    """Gera (kInicial, kFinal) cobrindo o eixo K em blocos de slabSize fatias."""
+    for k0 in range(0, shape[0], slabSize):
+        yield k0, min(k0 + slabSize, shape[0])
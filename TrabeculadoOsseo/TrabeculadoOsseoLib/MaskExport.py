@@ -0,0 +1,139 @@
+import csv
+import os
+import zlib
+from multiprocessing.pool import ThreadPool
+
+import numpy
+
+from .LabelStatistics import iterSlabs, DEFAULT_SLAB_SIZE
+from .OutOfCore import MappedVolume, NrrdStreamWriter, NRRD_TYPES, readNrrdHeader, volumeFromNrrdFields
+from .FVTOCore import FVTOResult
+from .BatchPool import defaultWorkerCount
+
+#
+# Exportacao compacta das mascaras binarizadas.
+#
+# O Result Volume guarda 0/Max em int32 (4 bytes por voxel); aqui cada
+# mascara e gravada como 0/1 em um de dois formatos:
+#  - "nrrd": uint8 com compressao gzip rapida (nivel 1 por padrao), aberto
+#    diretamente pelo Slicer;
+#  - "packed": 1 bit por voxel (numpy.packbits) em um .npz comprimido, com a
+#    geometria; lido de volta por readMask.
+# Varias mascaras sao gravadas ao mesmo tempo em threads (zlib libera o GIL)
+# e um manifesto CSV liga cada arquivo a linha de resultados do exame.
+#
+
+MASK_FORMAT_NRRD = "nrrd"
+MASK_FORMAT_PACKED = "packed"
+MASK_FORMATS = (MASK_FORMAT_NRRD, MASK_FORMAT_PACKED)
+MASK_EXTENSIONS = {MASK_FORMAT_NRRD: ".nrrd", MASK_FORMAT_PACKED: ".npz"}
+
+MANIFEST_NAME = "manifest.csv"
+MANIFEST_COLUMNS = ["Volume", "Arquivo", "Formato", "Dimensoes", "Voxels", "Voxels trabeculado"] + FVTOResult.columnNames
+
+# Espaco do NRRD gravado a partir de nos do Slicer (RAS com os eixos X e Y invertidos)
+LPS_SPACE = "left-posterior-superior"
+
+class MaskExportItem(object):
+    """Mascara de um exame a exportar: array (K, J, I), geometria (MappedVolume) e linha de resultados."""
+
+    def __init__(self, name, array, geometry, resultRow=None):
+        self.name = name
+        self.array = array
+        self.geometry = geometry
+        # [ICort, ITrab, Ilow, FVTO], ou None se o exame nao estiver na tabela
+        self.resultRow = resultRow
+
+    def __repr__(self):
+        return "MaskExportItem(%r)" % self.name
+
+def binaryMask(array):
+    """Mascara uint8 (1 onde o array nao e zero), aceitando 0/Max ou 0/1."""
+    return (numpy.asarray(array) != 0).astype(numpy.uint8)
+
+def geometryFromIJKToRAS(matrix):
+    """Geometria em LPS (como o Slicer grava NRRD) a partir da matriz IJKToRAS 4x4 (lista de linhas)."""
+    flip = (-1.0, -1.0, 1.0)
+    directions = [[flip[row] * matrix[row][axis] for row in range(3)] for axis in range(3)]
+    origin = [flip[row] * matrix[row][3] for row in range(3)]
+    spacing = [float(numpy.linalg.norm(direction)) for direction in directions]
+    return MappedVolume(None, spacing, origin, directions, LPS_SPACE)
+
+def maskFileName(name, fileFormat):
+    return name + MASK_EXTENSIONS[fileFormat]
+
+def writeMask(mask, geometry, path, fileFormat=MASK_FORMAT_NRRD, compressionLevel=1, slabSize=DEFAULT_SLAB_SIZE):
+    """Grava a mascara uint8 (K, J, I) no formato indicado."""
+    if fileFormat == MASK_FORMAT_NRRD:
+        writer = NrrdStreamWriter(path, mask.shape, numpy.uint8, geometry, compressionLevel=compressionLevel)
+        try:
+            for k0, k1 in iterSlabs(mask.shape, slabSize):
+                writer.write(mask[k0:k1])
+        finally:
+            writer.close()
+    elif fileFormat == MASK_FORMAT_PACKED:
+        with open(path, "wb") as maskFile:
+            numpy.savez_compressed(maskFile, bits=numpy.packbits(mask, axis=None), shape=numpy.array(mask.shape),
+                                   spacing=numpy.array(geometry.spacing), origin=numpy.array(geometry.origin),
+                                   directions=numpy.array(geometry.directions), space=numpy.array(geometry.space or ""))
+    else:
+        raise ValueError("Formato de mascara desconhecido: %r" % (fileFormat,))
+
+def readMask(path):
+    """Le uma mascara gravada por writeMask. Retorna um MappedVolume com o array uint8 (K, J, I)."""
+    if path.lower().endswith(MASK_EXTENSIONS[MASK_FORMAT_PACKED]):
+        with numpy.load(path) as data:
+            shape = tuple(int(size) for size in data["shape"])
+            count = shape[0] * shape[1] * shape[2]
+            array = numpy.unpackbits(data["bits"], count=count).reshape(shape)
+            return MappedVolume(array, data["spacing"].tolist(), data["origin"].tolist(), data["directions"].tolist(), str(data["space"]) or None)
+
+    fields, dataOffset, dataPath = readNrrdHeader(path)
+    with open(dataPath, "rb") as nrrdFile:
+        nrrdFile.seek(dataOffset)
+        data = nrrdFile.read()
+    if fields.get("encoding", "raw") == "gzip":
+        data = zlib.decompress(data, 47)
+    sizes = [int(size) for size in fields["sizes"].split()]
+    array = numpy.frombuffer(data, dtype=NRRD_TYPES[fields["type"]]).reshape(sizes[2], sizes[1], sizes[0])
+    return volumeFromNrrdFields(fields, array)
+
+def _exportItem(item, directory, fileFormat, compressionLevel):
+    mask = binaryMask(item.array)
+    fileName = maskFileName(item.name, fileFormat)
+    writeMask(mask, item.geometry, os.path.join(directory, fileName), fileFormat, compressionLevel)
+    row = [item.name, fileName, fileFormat, "%d %d %d" % (mask.shape[2], mask.shape[1], mask.shape[0]), mask.size, int(numpy.count_nonzero(mask))]
+    return row + list(item.resultRow or [""] * len(FVTOResult.columnNames))
+
+def exportMasks(items, directory, fileFormat=MASK_FORMAT_NRRD, threads=0, compressionLevel=1, manifestName=MANIFEST_NAME):
+    """
+    Grava as mascaras dos itens (MaskExportItem) em directory usando threads
+    (0 = um por nucleo) e acrescenta uma linha por mascara ao manifesto.
+    Retorna as linhas do manifesto.
+    """
+    items = list(items)
+    if not items:
+        return []
+    threads = min(threads or defaultWorkerCount(), len(items))
+    if threads > 1:
+        pool = ThreadPool(threads)
+        try:
+            rows = pool.map(lambda item: _exportItem(item, directory, fileFormat, compressionLevel), items)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        rows = [_exportItem(item, directory, fileFormat, compressionLevel) for item in items]
+    if manifestName:
+        appendManifest(rows, os.path.join(directory, manifestName))
+    return rows
+
+def appendManifest(rows, path):
+    """Acrescenta linhas ao manifesto CSV, criando o cabecalho se o arquivo for novo."""
+    newFile = not os.path.exists(path)
+    with open(path, "a") as manifestFile:
+        writer = csv.writer(manifestFile, delimiter=";")
+        if newFile:
+            writer.writerow(MANIFEST_COLUMNS)
+        for row in rows:
+            writer.writerow([str(value) for value in row])
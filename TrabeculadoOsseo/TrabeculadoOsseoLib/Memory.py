@@ -0,0 +1,53 @@
+import sys
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+#
+# Pico de memoria residente (RSS) do processo.
+#
+# No Linux o pico vem de VmHWM em /proc/self/status, que pode ser zerado
+# por resetPeakRSS() para medir cada execucao separadamente. Nos demais
+# sistemas usa resource ou psutil e o valor e o pico desde o inicio do processo.
+#
+
+def _procStatusPeak():
+    try:
+        with open("/proc/self/status") as statusFile:
+            for line in statusFile:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError):
+        pass
+    return None
+
+def peakRSSBytes():
+    """Pico de memoria residente do processo em bytes, ou None se nao disponivel."""
+    peak = _procStatusPeak()
+    if peak is not None:
+        return peak
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if sys.platform == "darwin":
+            return peak
+        return peak * 1024
+    if psutil is not None:
+        info = psutil.Process().memory_info()
+        return getattr(info, "peak_wset", info.rss)
+    return None
+
+def resetPeakRSS():
+    """Zera o pico de memoria (somente Linux). Retorna False se nao for possivel."""
+    try:
+        with open("/proc/self/clear_refs", "w") as clearRefsFile:
+            clearRefsFile.write("5")
+        return True
+    except (IOError, OSError):
+        return False
@@ -0,0 +1,247 @@
+import os
+import zlib
+
+import numpy
+
+from .LabelStatistics import iterSlabs, DEFAULT_SLAB_SIZE
+from .BitDepthDetection import resolveMax, requiresInvertedCheck, checkInvertedSlab
+from .FVTOCore import invertArray, createStatistics, resultFromStatistics, extentSlices, ILOW_RULE_LEGACY
+from .Background import checkCancelled
+from .Profiling import profileStage, STAGE_CAST, STAGE_STATISTICS, STAGE_BINARIZE
+
+#
+# Processamento de volumes maiores que a memoria.
+#
+# O volume e o label map sao mapeados do disco (numpy.memmap) a partir de
+# arquivos NRRD sem compressao (.nrrd ou .nhdr + dados) ou .npy, e
+# percorridos em slabs ao longo de K: cada slab e convertido para inteiro
+# (o mesmo Cast Int do modulo), invertido e acumulado, de modo que so um
+# slab fica na memoria por vez. O resultado binarizado (uint8, 1 =
+# trabeculado) e gravado em NRRD slab por slab.
+#
+# A correcao N4 nao e feita aqui: o volume de entrada deve estar corrigido.
+#
+
+NRRD_TYPES = {
+    "signed char": numpy.int8, "int8": numpy.int8, "int8_t": numpy.int8,
+    "uchar": numpy.uint8, "unsigned char": numpy.uint8, "uint8": numpy.uint8, "uint8_t": numpy.uint8,
+    "short": numpy.int16, "short int": numpy.int16, "signed short": numpy.int16, "signed short int": numpy.int16, "int16": numpy.int16, "int16_t": numpy.int16,
+    "ushort": numpy.uint16, "unsigned short": numpy.uint16, "unsigned short int": numpy.uint16, "uint16": numpy.uint16, "uint16_t": numpy.uint16,
+    "int": numpy.int32, "signed int": numpy.int32, "int32": numpy.int32, "int32_t": numpy.int32,
+    "uint": numpy.uint32, "unsigned int": numpy.uint32, "uint32": numpy.uint32, "uint32_t": numpy.uint32,
+    "longlong": numpy.int64, "long long": numpy.int64, "int64": numpy.int64, "int64_t": numpy.int64,
+    "ulonglong": numpy.uint64, "unsigned long long": numpy.uint64, "uint64": numpy.uint64, "uint64_t": numpy.uint64,
+    "float": numpy.float32, "double": numpy.float64,
+}
+
+NRRD_TYPE_NAMES = {
+    numpy.dtype(numpy.uint8): "uchar",
+    numpy.dtype(numpy.int16): "short",
+    numpy.dtype(numpy.uint16): "ushort",
+    numpy.dtype(numpy.int32): "int",
+    numpy.dtype(numpy.float32): "float",
+}
+
+class MappedVolume(object):
+    """Array (K, J, I) mapeado do disco e a geometria do arquivo."""
+
+    def __init__(self, array, spacing=(1.0, 1.0, 1.0), origin=(0.0, 0.0, 0.0), directions=None, space=None, metadata=None):
+        self.array = array
+        # Espacamento e origem na ordem I, J, K; directions sao os vetores (com espacamento) de cada eixo
+        self.spacing = tuple(spacing)
+        self.origin = tuple(origin)
+        if directions is None:
+            directions = [[spacing[axis] if row == axis else 0.0 for row in range(3)] for axis in range(3)]
+        self.directions = [list(direction) for direction in directions]
+        self.space = space
+        # Pares chave:=valor do NRRD (por exemplo BitsStored)
+        self.metadata = metadata or {}
+
+    @property
+    def shape(self):
+        return self.array.shape
+
+    def originAt(self, ijk):
+        """Posicao do voxel (I, J, K) no espaco do arquivo."""
+        return tuple(self.origin[row] + sum(ijk[axis] * self.directions[axis][row] for axis in range(3)) for row in range(3))
+
+def _parseVector(text):
+    return [float(value) for value in text.strip().strip("()").split(",")]
+
+def readNrrdKeyValues(path):
+    """Pares chave:=valor do cabecalho NRRD."""
+    keyValues = {}
+    with open(path, "rb") as nrrdFile:
+        nrrdFile.readline()
+        while True:
+            line = nrrdFile.readline()
+            if not line or not line.strip():
+                break
+            line = line.decode("latin-1").rstrip("\r\n")
+            if ":=" in line and not line.startswith("#"):
+                key, value = line.split(":=", 1)
+                keyValues[key] = value
+    return keyValues
+
+def readNrrdHeader(path):
+    """Campos do cabecalho NRRD, deslocamento dos dados e arquivo dos dados."""
+    with open(path, "rb") as nrrdFile:
+        magic = nrrdFile.readline()
+        if not magic.startswith(b"NRRD"):
+            raise ValueError("Arquivo NRRD invalido: " + path)
+        fields = {}
+        while True:
+            line = nrrdFile.readline()
+            if not line or not line.strip():
+                break
+            line = line.decode("latin-1").rstrip("\r\n")
+            if line.startswith("#") or ":=" in line:
+                continue
+            key, value = line.split(":", 1)
+            fields[key.strip().lower()] = value.strip()
+        dataOffset = nrrdFile.tell()
+
+    dataPath = path
+    dataFile = fields.get("data file", fields.get("datafile"))
+    if dataFile is not None:
+        if dataFile.startswith("LIST") or " " in dataFile:
+            raise ValueError("NRRD com varios arquivos de dados nao suportado: " + path)
+        dataPath = os.path.join(os.path.dirname(os.path.abspath(path)), dataFile)
+        dataOffset = 0
+    dataOffset += int(fields.get("byte skip", fields.get("byteskip", 0)))
+    return fields, dataOffset, dataPath
+
+def openNrrd(path):
+    fields, dataOffset, dataPath = readNrrdHeader(path)
+    if fields.get("encoding", "raw") != "raw":
+        raise ValueError("O modo fora da memoria requer NRRD sem compressao (encoding raw): " + path)
+    if int(fields["dimension"]) != 3:
+        raise ValueError("Somente volumes 3D sao suportados: " + path)
+    if int(fields.get("line skip", fields.get("lineskip", 0))) != 0 or int(fields.get("byte skip", 0)) < 0:
+        raise ValueError("NRRD com line skip ou byte skip -1 nao suportado: " + path)
+    dtype = numpy.dtype(NRRD_TYPES[fields["type"]])
+    if dtype.itemsize > 1:
+        dtype = dtype.newbyteorder("<" if fields.get("endian", "little") == "little" else ">")
+    sizes = [int(size) for size in fields["sizes"].split()]
+    array = numpy.memmap(dataPath, dtype=dtype, mode="r", offset=dataOffset, shape=(sizes[2], sizes[1], sizes[0]))
+    volume = volumeFromNrrdFields(fields, array)
+    volume.metadata = readNrrdKeyValues(path)
+    return volume
+
+def volumeFromNrrdFields(fields, array):
+    """MappedVolume com o array e a geometria descrita nos campos do cabecalho NRRD."""
+    directions = None
+    if "space directions" in fields:
+        directions = [_parseVector(vector) for vector in fields["space directions"].split(")") if vector.strip()]
+        spacing = [float(numpy.linalg.norm(direction)) for direction in directions]
+    elif "spacings" in fields:
+        spacing = [float(value) for value in fields["spacings"].split()]
+    else:
+        spacing = [1.0, 1.0, 1.0]
+    origin = _parseVector(fields["space origin"]) if "space origin" in fields else [0.0, 0.0, 0.0]
+    return MappedVolume(array, spacing, origin, directions, fields.get("space"))
+
+def openVolume(path):
+    """Mapeia um .nrrd/.nhdr sem compressao ou um .npy (K, J, I) sem carregar os dados."""
+    if path.lower().endswith(".npy"):
+        return MappedVolume(numpy.load(path, mmap_mode="r"))
+    if path.lower().endswith((".nrrd", ".nhdr")):
+        return openNrrd(path)
+    raise ValueError("Formato nao suportado no modo fora da memoria (use .nrrd sem compressao, .nhdr ou .npy): " + path)
+
+class NrrdStreamWriter(object):
+    """
+    Grava um NRRD (K, J, I) slab por slab, sem manter o volume na memoria.
+    Com compressionLevel (1 a 9) os dados sao gravados com encoding gzip.
+    """
+
+    def __init__(self, path, shape, dtype, referenceVolume=None, ijkOffset=(0, 0, 0), compressionLevel=None):
+        self.path = path
+        self.shape = tuple(shape)
+        self.dtype = numpy.dtype(dtype)
+        self.writtenSlices = 0
+        self.compressor = None
+        if compressionLevel is not None:
+            # wbits 31: stream gzip, como o encoding gzip do NRRD espera
+            self.compressor = zlib.compressobj(int(compressionLevel), zlib.DEFLATED, 31)
+        header = ["NRRD0004", "type: " + NRRD_TYPE_NAMES[self.dtype], "dimension: 3"]
+        if referenceVolume is not None:
+            if referenceVolume.space:
+                header.append("space: " + referenceVolume.space)
+            else:
+                header.append("space dimension: 3")
+            header.append("sizes: %d %d %d" % (self.shape[2], self.shape[1], self.shape[0]))
+            header.append("space directions: " + " ".join("(%s)" % ",".join(repr(float(x)) for x in direction) for direction in referenceVolume.directions))
+            header.append("kinds: domain domain domain")
+            header.append("space origin: (%s)" % ",".join(repr(float(x)) for x in referenceVolume.originAt(ijkOffset)))
+        else:
+            header.append("sizes: %d %d %d" % (self.shape[2], self.shape[1], self.shape[0]))
+        header.append("endian: little")
+        header.append("encoding: " + ("raw" if self.compressor is None else "gzip"))
+        self.file = open(path, "wb")
+        self.file.write(("\n".join(header) + "\n\n").encode("ascii"))
+
+    def write(self, slab):
+        slab = numpy.ascontiguousarray(slab, dtype=self.dtype.newbyteorder("<"))
+        data = slab.tobytes()
+        if self.compressor is not None:
+            data = self.compressor.compress(data)
+        self.file.write(data)
+        self.writtenSlices += slab.shape[0]
+
+    def close(self):
+        if self.compressor is not None:
+            self.file.write(self.compressor.flush())
+            self.compressor = None
+        self.file.close()
+
+def castSlab(slab):
+    """Mesmo Cast (Int) do modulo: copia o slab do disco como int32 (truncando valores reais)."""
+    return numpy.asarray(slab).astype(numpy.int32)
+
+def run(volumeArray, labelArray, ROIValue, cortValue, spacing=(1.0, 1.0, 1.0), slabSize=DEFAULT_SLAB_SIZE, ILowRule=ILOW_RULE_LEGACY, profile=None, cancelEvent=None, histogramBinWidth=1, bitDepth=None):
+    """
+    FVTOCore.run para arrays mapeados do disco: nao altera o arquivo e usa
+    memoria proporcional a um slab. Le o volume duas vezes (faixa de valores e
+    estatisticas), ou uma so com bitDepth (bits ou BitDepth, por exemplo do
+    BitsStored do arquivo); nesse caso um voxel acima do Max levanta ValueError.
+    """
+    with profileStage(profile, STAGE_CAST, volumeArray.size):
+        Max = resolveMax(volumeArray, bitDepth, slabSize, cancelEvent)
+    checkMax = requiresInvertedCheck(bitDepth)
+
+    with profileStage(profile, STAGE_STATISTICS, volumeArray.size):
+        statistics = createStatistics(ROIValue, cortValue, Max, histogramBinWidth)
+        for k0, k1 in iterSlabs(volumeArray.shape, slabSize):
+            checkCancelled(cancelEvent)
+            volumeSlab = invertArray(castSlab(volumeArray[k0:k1]), Max)
+            if checkMax:
+                # Voxel acima do Max: a profundidade informada nao cobre o volume
+                checkInvertedSlab(volumeSlab, Max)
+            statistics.update(volumeSlab, numpy.asarray(labelArray[k0:k1]), k0)
+
+    return resultFromStatistics(statistics, ROIValue, cortValue, Max, spacing, ILowRule, profile)
+
+def writeBinarizedROI(volume, labelArray, ROIValue, result, path, slabSize=DEFAULT_SLAB_SIZE, profile=None, cancelEvent=None):
+    """
+    Grava em NRRD a mascara uint8 (1 = trabeculado) do recorte da ROI, como
+    binarizedROIMask, lendo e gravando um slab por vez. volume e um MappedVolume.
+    Retorna False se a ROI estiver vazia.
+    """
+    if result.roiExtent is None:
+        return False
+    (kMin, kMax), (jMin, jMax), (iMin, iMax) = result.roiExtent
+    box = extentSlices(result.roiExtent)
+    shape = (kMax - kMin + 1, jMax - jMin + 1, iMax - iMin + 1)
+    with profileStage(profile, STAGE_BINARIZE, shape[0] * shape[1] * shape[2]):
+        writer = NrrdStreamWriter(path, shape, numpy.uint8, volume, (iMin, jMin, kMin))
+        try:
+            for k0, k1 in iterSlabs(shape, slabSize):
+                checkCancelled(cancelEvent)
+                slabBox = (slice(kMin + k0, kMin + k1),) + box[1:]
+                volumeSlab = invertArray(castSlab(volume.array[slabBox]), result.Max)
+                mask = (volumeSlab >= result.ITrab) & (numpy.asarray(labelArray[slabBox]) == ROIValue)
+                writer.write(mask.view(numpy.uint8))
+        finally:
+            writer.close()
+    return True
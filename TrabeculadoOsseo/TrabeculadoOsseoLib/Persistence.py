@@ -0,0 +1,123 @@
+import csv
+import os
+import sqlite3
+
+#
+# Tabela de resultados gravada linha a linha.
+#
+# Cada exame concluido e acrescentado ao arquivo assim que termina (CSV com
+# flush e fsync, ou SQLite com commit por linha), de modo que uma falha no
+# meio do lote nao perde os exames anteriores. Com resume, as linhas ja
+# gravadas sao mantidas e os exames listados nelas podem ser pulados; sem
+# resume, o arquivo e recriado. A primeira coluna e o nome do exame.
+#
+
+SQLITE_EXTENSIONS = (".sqlite", ".sqlite3", ".db")
+RESULT_STORE_EXTENSIONS = (".csv",) + SQLITE_EXTENSIONS
+SQLITE_TABLE = "results"
+
+def _fromText(value):
+    # Valores lidos do CSV voltam como numeros quando possivel
+    for conversion in (int, float):
+        try:
+            return conversion(value)
+        except ValueError:
+            pass
+    return value
+
+def _quote(name):
+    return '"' + name.replace('"', '""') + '"'
+
+class ResultStore(object):
+    """Tabela de resultados (CSV ou SQLite, pela extensao) aberta para acrescentar linhas."""
+
+    def __init__(self, path, columns, resume=False):
+        self.path = path
+        self.columns = list(columns)
+        self.sqlite = path.lower().endswith(SQLITE_EXTENSIONS)
+        if not self.sqlite and not path.lower().endswith(".csv"):
+            raise ValueError("Tabela de resultados deve ser .csv ou SQLite (%s): %s" % (", ".join(SQLITE_EXTENSIONS), path))
+        if not resume and os.path.exists(path):
+            os.remove(path)
+        if self.sqlite:
+            self._openSQLite()
+        else:
+            self._openCSV()
+        self.completed = set(str(row[0]) for row in self.rows())
+
+    def _openCSV(self):
+        if os.path.exists(self.path) and os.path.getsize(self.path) > 0:
+            with open(self.path) as tableFile:
+                header = next(csv.reader(tableFile, delimiter=";"))
+            if header != self.columns:
+                raise ValueError("Colunas de %s diferentes das esperadas: %r" % (self.path, header))
+            with open(self.path, "rb") as tableFile:
+                tableFile.seek(-1, os.SEEK_END)
+                completeLine = tableFile.read(1) in (b"\n", b"\r")
+            self.file = open(self.path, "a")
+            self.writer = csv.writer(self.file, delimiter=";")
+            if not completeLine:
+                # Linha interrompida por uma falha: descartada na leitura, a proxima comeca em nova linha
+                self.file.write("\n")
+        else:
+            self.file = open(self.path, "w")
+            self.writer = csv.writer(self.file, delimiter=";")
+            self._writeCSVRow(self.columns)
+
+    def _openSQLite(self):
+        self.connection = sqlite3.connect(self.path)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS %s (%s)" % (SQLITE_TABLE, ", ".join(_quote(column) for column in self.columns)))
+        self.connection.commit()
+        header = [row[1] for row in self.connection.execute("PRAGMA table_info(%s)" % SQLITE_TABLE)]
+        if header != self.columns:
+            self.connection.close()
+            raise ValueError("Colunas de %s diferentes das esperadas: %r" % (self.path, header))
+
+    def _writeCSVRow(self, row):
+        self._writeCSVRows([row])
+
+    def _writeCSVRows(self, rows):
+        for row in rows:
+            self.writer.writerow([str(value) for value in row])
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def isCompleted(self, name):
+        return str(name) in self.completed
+
+    def append(self, row):
+        """Grava uma linha (nome do exame e valores, na ordem das colunas) no disco."""
+        self.appendRows([row])
+
+    def appendRows(self, rows):
+        """Grava varias linhas de uma vez (uma transacao no SQLite, um fsync no CSV)."""
+        rows = [list(row) for row in rows]
+        for row in rows:
+            if len(row) != len(self.columns):
+                raise ValueError("Linha com %d valores para %d colunas" % (len(row), len(self.columns)))
+        if self.sqlite:
+            # Tipos NumPy (float64, int64) para SQLite
+            values = [[value.item() if hasattr(value, "item") else value for value in row] for row in rows]
+            self.connection.executemany("INSERT INTO %s VALUES (%s)" % (SQLITE_TABLE, ", ".join("?" * len(self.columns))), values)
+            self.connection.commit()
+        else:
+            self._writeCSVRows(rows)
+        self.completed.update(str(row[0]) for row in rows)
+
+    def rows(self):
+        """Linhas ja gravadas, na ordem em que foram acrescentadas."""
+        if self.sqlite:
+            return [list(row) for row in self.connection.execute("SELECT * FROM %s ORDER BY rowid" % SQLITE_TABLE)]
+        with open(self.path) as tableFile:
+            reader = csv.reader(tableFile, delimiter=";")
+            next(reader, None)
+            return [[row[0]] + [_fromText(value) for value in row[1:]] for row in reader if len(row) == len(self.columns)]
+
+    def close(self):
+        if self.sqlite:
+            self.connection.close()
+        else:
+            self.file.close()
+
+    def __repr__(self):
+        return "ResultStore(%r, %d linhas)" % (self.path, len(self.completed))
@@ -0,0 +1,153 @@
+import math
+
+import numpy
+
+from .LabelStatistics import iterSlabs, DEFAULT_SLAB_SIZE
+
+#
+# Fantomas sinteticos de osso trabecular com label map e valores conhecidos.
+#
+# O volume imita a imagem de entrada do modulo (osso escuro, medula clara):
+# um cilindro ao longo de K com parede de osso cortical e, por dentro, uma
+# rede trabecular obtida de uma faixa em torno de zero de uma soma de ondas
+# separaveis. A fracao de osso da faixa e escolhida pela distribuicao normal
+# e a fracao real na ROI e contada durante a geracao, servindo de referencia
+# para o FVTO. Um campo de bias multiplicativo suave e ruido gaussiano podem
+# ser adicionados. O volume e gerado em slabs, permitindo fantomas de 1024^3.
+#
+
+PHANTOM_ROI_VALUE = 1
+PHANTOM_CORT_VALUE = 2
+PHANTOM_BIT_DEPTHS = (8, 12, 14, 16)
+
+# Intensidades relativas (fracao do valor maximo) antes do bias e do ruido
+BONE_INTENSITY = 0.15
+MARROW_INTENSITY = 0.75
+BACKGROUND_INTENSITY = 0.05
+
+class Phantom(object):
+    """Volume, label map e valores de referencia de um fantoma."""
+
+    def __init__(self, volumeArray, labelArray, spacing, bitDepth, ROIValue, cortValue, boneFraction, truth):
+        self.volumeArray = volumeArray
+        self.labelArray = labelArray
+        self.spacing = spacing
+        self.bitDepth = bitDepth
+        self.ROIValue = ROIValue
+        self.cortValue = cortValue
+        # Fracao de osso pedida e valores obtidos na geracao (FVTO, contagens)
+        self.boneFraction = boneFraction
+        self.truth = truth
+
+    def __repr__(self):
+        return "Phantom(shape=%r, bitDepth=%r, FVTO=%.4f)" % (self.volumeArray.shape, self.bitDepth, self.truth["FVTO"])
+
+def maxValueForBitDepth(bitDepth):
+    if bitDepth not in PHANTOM_BIT_DEPTHS:
+        raise ValueError("Profundidade de bits nao suportada: %r" % (bitDepth,))
+    return 2 ** bitDepth - 1
+
+def _normalQuantile(probability):
+    # Inversa da normal padrao por bisseccao (sem depender do scipy)
+    low, high = -10.0, 10.0
+    for iteration in range(100):
+        middle = (low + high) / 2.0
+        if 0.5 * (1.0 + math.erf(middle / math.sqrt(2.0))) < probability:
+            low = middle
+        else:
+            high = middle
+    return (low + high) / 2.0
+
+class _TrabecularField(object):
+    # Soma de ondas cos(kx x) cos(ky y) cos(kz z) com fases aleatorias, calculada por slab
+    def __init__(self, shape, rng, waveCount, wavelength):
+        self.waves = []
+        for wave in range(waveCount):
+            frequencies = rng.uniform(0.5, 1.5, size=3) * (2.0 * math.pi / wavelength)
+            phases = rng.uniform(0.0, 2.0 * math.pi, size=3)
+            profiles = [numpy.cos(frequencies[axis] * numpy.arange(shape[axis]) + phases[axis]).astype(numpy.float32) for axis in range(3)]
+            self.waves.append(profiles)
+        # Cada termo tem variancia 1/8
+        self.sigma = math.sqrt(waveCount / 8.0)
+
+    def slab(self, k0, k1):
+        field = None
+        for kProfile, jProfile, iProfile in self.waves:
+            term = kProfile[k0:k1, None, None] * (jProfile[:, None] * iProfile[None, :])[None]
+            if field is None:
+                field = term
+            else:
+                field += term
+        return field
+
+def _biasField(shape, k0, k1, amplitude):
+    # Bias suave: 1 + amplitude * gradiente diagonal normalizado em [-1, 1]
+    k = numpy.linspace(-1.0, 1.0, shape[0]).astype(numpy.float32)[k0:k1, None, None]
+    j = numpy.linspace(-1.0, 1.0, shape[1]).astype(numpy.float32)[None, :, None]
+    i = numpy.linspace(-1.0, 1.0, shape[2]).astype(numpy.float32)[None, None, :]
+    return 1.0 + amplitude * (k + j + i) / 3.0
+
+def makePhantom(shape=(64, 64, 64), bitDepth=12, boneFraction=0.3, biasAmplitude=0.0, noiseSigma=0.0,
+                spacing=(1.0, 1.0, 1.0), wavelength=12.0, waveCount=12, seed=0, slabSize=DEFAULT_SLAB_SIZE,
+                ROIValue=PHANTOM_ROI_VALUE, cortValue=PHANTOM_CORT_VALUE):
+    """
+    Gera um fantoma (K, J, I). boneFraction e a fracao de osso pedida para o
+    trabeculado; biasAmplitude e noiseSigma sao fracoes do valor maximo.
+    """
+    if not 0.0 < boneFraction < 1.0:
+        raise ValueError("boneFraction deve estar entre 0 e 1")
+    Max = maxValueForBitDepth(bitDepth)
+    shape = tuple(int(size) for size in shape)
+    rng = numpy.random.RandomState(seed)
+
+    field = _TrabecularField(shape, rng, waveCount, wavelength)
+    threshold = field.sigma * _normalQuantile((1.0 + boneFraction) / 2.0)
+
+    # Cilindro ao longo de K: parede cortical entre innerRadius e outerRadius, ROI dentro de roiRadius
+    j = numpy.arange(shape[1]) - (shape[1] - 1) / 2.0
+    i = numpy.arange(shape[2]) - (shape[2] - 1) / 2.0
+    radius = numpy.sqrt(j[:, None] ** 2 + i[None, :] ** 2)
+    outerRadius = 0.45 * min(shape[1], shape[2])
+    innerRadius = 0.8 * outerRadius
+    roiRadius = 0.9 * innerRadius
+    cortical = (radius >= innerRadius) & (radius < outerRadius)
+    inside = radius < innerRadius
+    roiDisk = radius < roiRadius
+    kMargin = max(1, shape[0] // 8)
+
+    dtype = numpy.uint8 if bitDepth == 8 else numpy.uint16
+    volumeArray = numpy.empty(shape, dtype=dtype)
+    labelArray = numpy.zeros(shape, dtype=numpy.uint8)
+    roiCount = 0
+    roiBoneCount = 0
+    for k0, k1 in iterSlabs(shape, slabSize):
+        bone = numpy.abs(field.slab(k0, k1)) < threshold
+        bone |= cortical[None]
+        intensity = numpy.where(bone, numpy.float32(BONE_INTENSITY), numpy.float32(MARROW_INTENSITY))
+        intensity[:, ~(inside | cortical)] = BACKGROUND_INTENSITY
+        if biasAmplitude:
+            intensity *= _biasField(shape, k0, k1, biasAmplitude)
+        if noiseSigma:
+            intensity += rng.normal(0.0, noiseSigma, size=intensity.shape).astype(numpy.float32)
+        numpy.clip(intensity * Max, 0, Max, out=intensity)
+        volumeArray[k0:k1] = numpy.rint(intensity)
+
+        labelSlab = labelArray[k0:k1]
+        labelSlab[:, cortical] = cortValue
+        roiK0 = max(k0, kMargin) - k0
+        roiK1 = min(k1, shape[0] - kMargin) - k0
+        if roiK1 > roiK0:
+            labelSlab[roiK0:roiK1, roiDisk] = ROIValue
+            roiBone = bone[roiK0:roiK1][:, roiDisk]
+            roiCount += roiBone.size
+            roiBoneCount += int(numpy.count_nonzero(roiBone))
+
+    truth = {
+        "FVTO": float(roiBoneCount) / roiCount if roiCount else float('nan'),
+        "roiVoxels": roiCount,
+        "roiBoneVoxels": roiBoneCount,
+        "Max": Max,
+        "boneValue": int(round(BONE_INTENSITY * Max)),
+        "marrowValue": int(round(MARROW_INTENSITY * Max)),
+    }
+    return Phantom(volumeArray, labelArray, tuple(spacing), bitDepth, ROIValue, cortValue, boneFraction, truth)
@@ -0,0 +1,107 @@
+import contextlib
+import json
+import time
+
+from .Memory import peakRSSBytes, resetPeakRSS
+
+#
+# Medicao por etapa do pipeline (tempo de parede, tempo de CPU, pico de
+# memoria e numero de voxels), para saber onde o tempo de cada exame e gasto.
+#
+# Cada exame tem um StageProfile; cada etapa vira um registro que pode ser
+# gravado como uma linha JSON ou resumido em colunas da tabela de resultados.
+# O tempo de CPU e o pico de memoria sao do processo atual: o que roda em
+# processos filhos (modulos CLI fora do processo) nao entra nessas medidas.
+#
+
+# Etapas do pipeline, na ordem em que sao executadas
+STAGE_N4ITK = "N4ITK"
+STAGE_CAST = "Cast"
+STAGE_INVERT = "Invert"
+STAGE_STATISTICS = "Statistics"   # inversao, ICort, ITrab e histograma em uma passada
+STAGE_ILOW = "ILow"               # ILow e FVTO
+STAGE_MASK = "Mask"
+STAGE_ROI = "ROI"
+STAGE_CROP = "Crop"
+STAGE_BINARIZE = "Binarize"
+STAGE_NAMES = (STAGE_N4ITK, STAGE_CAST, STAGE_INVERT, STAGE_STATISTICS, STAGE_ILOW, STAGE_MASK, STAGE_ROI, STAGE_CROP, STAGE_BINARIZE)
+
+def cpuTime():
+    """Tempo de CPU do processo em segundos."""
+    try:
+        return time.process_time()
+    except AttributeError:
+        return time.clock()
+
+class StageProfile(object):
+    """Registros das etapas de um exame."""
+
+    def __init__(self, examName):
+        self.examName = examName
+        self.records = []
+
+    @contextlib.contextmanager
+    def stage(self, stageName, voxels=None):
+        """
+        Mede o bloco como uma etapa. O registro e entregue ao bloco, que pode
+        preencher "voxels" quando a contagem so e conhecida no final.
+        """
+        record = {"exam": self.examName, "stage": stageName, "voxels": voxels}
+        resetPeakRSS()
+        wallStart = time.time()
+        cpuStart = cpuTime()
+        try:
+            yield record
+        finally:
+            record["wallSeconds"] = time.time() - wallStart
+            record["cpuSeconds"] = cpuTime() - cpuStart
+            record["peakRSSBytes"] = peakRSSBytes()
+            self.records.append(record)
+
+    def addStage(self, stageName, wallSeconds, cpuSeconds=None, voxels=None, peakRSS=None):
+        """Registra uma etapa medida fora do processo (por exemplo o N4ITK em paralelo)."""
+        record = {"exam": self.examName, "stage": stageName, "voxels": voxels,
+                  "wallSeconds": wallSeconds, "cpuSeconds": cpuSeconds, "peakRSSBytes": peakRSS}
+        self.records.append(record)
+        return record
+
+    def wallSeconds(self, stageName=None):
+        """Soma do tempo de parede de uma etapa (ou de todas, com stageName None)."""
+        return sum(record["wallSeconds"] for record in self.records if stageName is None or record["stage"] == stageName)
+
+    def peakRSSBytes(self):
+        """Maior pico de memoria entre as etapas, ou None se nao medido."""
+        peaks = [record["peakRSSBytes"] for record in self.records if record["peakRSSBytes"] is not None]
+        if not peaks:
+            return None
+        return max(peaks)
+
+    def asJSONLines(self):
+        return "".join(json.dumps(record, sort_keys=True) + "\n" for record in self.records)
+
+    def writeJSONLines(self, path):
+        """Acrescenta os registros ao arquivo, uma linha JSON por etapa."""
+        with open(path, "a") as profileFile:
+            profileFile.write(self.asJSONLines())
+
+    @staticmethod
+    def columnNames():
+        """Colunas de resumo para a tabela: tempo de cada etapa, total e pico de memoria."""
+        return ["%s (s)" % stageName for stageName in STAGE_NAMES] + ["Total (s)", "Pico RSS (MB)"]
+
+    def asRow(self):
+        row = ["%.3f" % self.wallSeconds(stageName) for stageName in STAGE_NAMES]
+        row.append("%.3f" % self.wallSeconds())
+        peak = self.peakRSSBytes()
+        row.append("" if peak is None else "%.0f" % (peak / 1024.0 ** 2))
+        return row
+
+def profileStage(profile, stageName, voxels=None):
+    """profile.stage(...) ou, sem profile, um bloco que nao mede nada."""
+    if profile is None:
+        return _noProfile(stageName, voxels)
+    return profile.stage(stageName, voxels)
+
+@contextlib.contextmanager
+def _noProfile(stageName, voxels):
+    yield {"stage": stageName, "voxels": voxels}
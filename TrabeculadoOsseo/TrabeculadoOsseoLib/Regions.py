@@ -0,0 +1,139 @@
+import numpy
+
+from .LabelStatistics import iterSlabs, DEFAULT_SLAB_SIZE
+from .Histogram import IntegerHistogram
+from .FVTOCore import FVTOResult, findILow, computeFVTO, ILOW_RULE_LEGACY
+from .Background import checkCancelled
+
+#
+# FVTO de varias regioes e perfis por fatia em uma unica varredura.
+#
+# Cada label do mapa (exceto o fundo e o osso cortical) e tratado como uma
+# ROI. Em cada slab os voxels sao indexados pelo label (e pela fatia ao
+# longo do eixo escolhido) e contagens, somas e histogramas de todos os
+# labels saem de poucos numpy.bincount sobre esse indice combinado.
+#
+# O ICort (media do osso cortical) e o ILow de cada label sao calculados
+# sobre o label inteiro; no perfil por fatia so o ITrab varia, de modo que a
+# media dos FVTO das fatias ponderada pelos voxels e o FVTO do label.
+#
+
+# Eixos do array (K, J, I), na ordem de slicer.util.array
+AXIS_NAMES = ("K", "J", "I")
+
+class RegionResults(object):
+    """FVTOResult de cada label e, opcionalmente, o perfil por fatia ao longo de um eixo."""
+
+    columnNames = ["Label", "Eixo", "Fatia", "Voxels"] + FVTOResult.columnNames
+
+    def __init__(self, axis=None):
+        self.axis = axis
+        self.results = {}
+        self.voxels = {}
+        # label -> lista de (fatia, voxels, ITrab, FVTO)
+        self.slices = {}
+
+    def rows(self):
+        """Tabela em formato longo: uma linha por label e, abaixo dela, uma por fatia."""
+        rows = []
+        for label in sorted(self.results):
+            result = self.results[label]
+            rows.append([label, "", "", self.voxels[label]] + result.asRow())
+            for sliceIndex, voxels, ITrab, FVTO in self.slices.get(label, ()):
+                rows.append([label, AXIS_NAMES[self.axis], sliceIndex, voxels, result.ICort, ITrab, result.ILow, FVTO])
+        return rows
+
+    def __repr__(self):
+        return "RegionResults(labels=%r, axis=%r)" % (sorted(self.results), self.axis)
+
+def findLabelValues(labelArray, slabSize=DEFAULT_SLAB_SIZE):
+    """Valores presentes no label map, em ordem crescente."""
+    values = set()
+    for k0, k1 in iterSlabs(labelArray.shape, slabSize):
+        values.update(int(value) for value in numpy.unique(labelArray[k0:k1]))
+    return sorted(values)
+
+def _sliceCoordinates(shape, axis, k0):
+    # Indice da fatia de cada voxel do slab, sem alocar o array inteiro
+    coordinates = numpy.arange(shape[axis]) + (k0 if axis == 0 else 0)
+    newShape = [1, 1, 1]
+    newShape[axis] = shape[axis]
+    return numpy.broadcast_to(coordinates.reshape(newShape), shape)
+
+def runRegions(volumeArray, labelArray, cortValue, Max, ROIValues=None, axis=None, slabSize=DEFAULT_SLAB_SIZE, ILowRule=ILOW_RULE_LEGACY, cancelEvent=None, histogramBinWidth=1):
+    """
+    Calcula ICort, ITrab, ILow e FVTO de cada label de ROIValues (por padrao todos
+    os labels menos 0 e cortValue) em um volume ja invertido (invertVolumeArray),
+    que nao e alterado. Com axis (0, 1 ou 2 para K, J, I), inclui o perfil por fatia.
+    Labels sem voxels sao omitidos. Para um unico label, o resultado e o mesmo de run.
+    """
+    if Max <= 0:
+        raise ValueError("Max invalido (%r): o FVTO por regiao requer o Max da profundidade de bits" % (Max,))
+    if ROIValues is None:
+        ROIValues = [value for value in findLabelValues(labelArray, slabSize) if value not in (0, cortValue)]
+    labels = numpy.array(sorted(set(int(value) for value in ROIValues) | set([int(cortValue)])))
+    labelCount = labels.size
+    sliceCount = volumeArray.shape[axis] if axis is not None else 1
+    binCount = Max // histogramBinWidth + 1
+
+    counts = numpy.zeros(labelCount * sliceCount, dtype=numpy.int64)
+    sums = numpy.zeros(labelCount * sliceCount, dtype=numpy.int64)
+    histograms = numpy.zeros(labelCount * binCount, dtype=numpy.int64)
+    overflow = numpy.zeros(labelCount, dtype=numpy.int64)
+
+    for k0, k1 in iterSlabs(volumeArray.shape, slabSize):
+        checkCancelled(cancelEvent)
+        labelSlab = numpy.asarray(labelArray[k0:k1])
+        volumeSlab = volumeArray[k0:k1]
+        position = numpy.minimum(numpy.searchsorted(labels, labelSlab), labelCount - 1)
+        mask = (labels[position] == labelSlab)
+        labelIndex = position[mask]
+        if labelIndex.size == 0:
+            continue
+        values = volumeSlab[mask]
+
+        key = labelIndex * sliceCount
+        if axis is not None:
+            key += _sliceCoordinates(volumeSlab.shape, axis, k0)[mask]
+        counts += numpy.bincount(key, minlength=counts.size)
+        # Somas inteiras de um slab cabem exatamente em float64
+        sums += numpy.rint(numpy.bincount(key, weights=values, minlength=sums.size)).astype(numpy.int64)
+
+        # Valores acima de Max vem de voxels negativos antes da inversao
+        inRange = (values >= 0) & (values <= Max)
+        overflow += numpy.bincount(labelIndex[~inRange], minlength=labelCount)
+        histogramKey = labelIndex[inRange] * binCount + values[inRange] // histogramBinWidth
+        histograms += numpy.bincount(histogramKey, minlength=histograms.size)
+
+    counts = counts.reshape(labelCount, sliceCount)
+    sums = sums.reshape(labelCount, sliceCount)
+    histograms = histograms.reshape(labelCount, binCount)
+    labelCounts = counts.sum(axis=1)
+    labelSums = sums.sum(axis=1)
+
+    regions = RegionResults(axis)
+    cortIndex = int(numpy.searchsorted(labels, cortValue))
+    ICort = float('nan')
+    if labelCounts[cortIndex]:
+        ICort = numpy.float64(labelSums[cortIndex]) / labelCounts[cortIndex]
+    for index, label in enumerate(labels):
+        label = int(label)
+        if label == cortValue and label not in ROIValues or labelCounts[index] == 0:
+            continue
+        ITrab = numpy.float64(labelSums[index]) / labelCounts[index]
+        # Sem os bins vazios do fim, como o histograma de run
+        nonzero = numpy.flatnonzero(histograms[index])
+        ocorrencias = histograms[index][:nonzero[-1] + 1] if nonzero.size else histograms[index][:1]
+        histogram = IntegerHistogram.fromCounts(ocorrencias, histogramBinWidth, Max, overflow=overflow[index])
+        ILow = histogram.binValue(findILow(ocorrencias, ILowRule))
+        FVTO = computeFVTO(ITrab, ILow, ICort)
+        regions.results[label] = FVTOResult(ICort, ITrab, ILow, FVTO, Max, ocorrencias)
+        regions.voxels[label] = int(labelCounts[index])
+
+        if axis is not None:
+            sliceRows = []
+            for sliceIndex in numpy.flatnonzero(counts[index]):
+                sliceITrab = numpy.float64(sums[index, sliceIndex]) / counts[index, sliceIndex]
+                sliceRows.append((int(sliceIndex), int(counts[index, sliceIndex]), sliceITrab, computeFVTO(sliceITrab, ILow, ICort)))
+            regions.slices[label] = sliceRows
+    return regions
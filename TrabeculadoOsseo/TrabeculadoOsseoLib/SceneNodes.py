@@ -0,0 +1,40 @@
+import vtk
+import slicer
+
+#
+# Nos da cena criados a partir de arrays NumPy, usados pelos dois modulos.
+#
+# Diferente do restante da biblioteca, depende do Slicer (MRML e VTK): nao
+# entra no __init__ e e importado pelos widgets com
+# "from TrabeculadoOsseoLib import SceneNodes".
+#
+
+def createVolumeFromArray(array, referenceVolume, extent, name):
+    """
+    Novo no com o array (K, J, I), posicionado no inicio do trecho extent do
+    volume de referencia (extent None: array do mesmo tamanho do volume de referencia).
+    """
+    volumeLogic = slicer.modules.volumes.logic()
+    volumeNode = volumeLogic.CloneVolumeWithoutImageData(slicer.mrmlScene, referenceVolume, name)
+    if extent is not None:
+        (kMin, kMax), (jMin, jMax), (iMin, iMax) = extent
+        IJKtoRASMatrix = vtk.vtkMatrix4x4()
+        referenceVolume.GetIJKToRASMatrix(IJKtoRASMatrix)
+        volumeNode.SetOrigin(IJKtoRASMatrix.MultiplyPoint([iMin, jMin, kMin, 1])[:3])
+    slicer.util.updateVolumeFromArray(volumeNode, array)
+    return volumeNode
+
+def createROINode(referenceVolume, extent, name):
+    """ROI (so para exibicao) cobrindo os voxels do trecho (K, J, I) do volume de referencia."""
+    (kMin, kMax), (jMin, jMax), (iMin, iMax) = extent
+    IJKtoRASMatrix = vtk.vtkMatrix4x4()
+    referenceVolume.GetIJKToRASMatrix(IJKtoRASMatrix)
+    first = IJKtoRASMatrix.MultiplyPoint([iMin - 0.5, jMin - 0.5, kMin - 0.5, 1])[:3]
+    last = IJKtoRASMatrix.MultiplyPoint([iMax + 0.5, jMax + 0.5, kMax + 0.5, 1])[:3]
+    ROI = slicer.vtkMRMLAnnotationROINode()
+    ROI.SetName(name)
+    slicer.mrmlScene.AddNode(ROI)
+    ROI.SetXYZ([(first[axis] + last[axis]) / 2.0 for axis in range(3)])
+    ROI.SetRadiusXYZ(*[abs(last[axis] - first[axis]) / 2.0 for axis in range(3)])
+    ROI.SetDisplayVisibility(True)
+    return ROI
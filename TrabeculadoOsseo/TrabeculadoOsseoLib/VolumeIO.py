@@ -0,0 +1,44 @@
+import os
+
+try:
+    import SimpleITK as sitk
+except ImportError:
+    sitk = None
+
+#
+# Leitura e escrita de volumes fora da cena MRML (SimpleITK, distribuido com o Slicer).
+#
+
+VOLUME_EXTENSIONS = ('.nii.gz', '.nii', '.nrrd', '.nhdr')
+
+def requireSimpleITK():
+    if sitk is None:
+        raise ImportError("SimpleITK nao encontrado: instale com 'pip install SimpleITK' ou rode pelo Slicer")
+    return sitk
+
+def splitVolumeExtension(path):
+    """Separa o nome do arquivo da extensao de volume (inclusive .nii.gz)."""
+    fileName = os.path.basename(path)
+    for extension in VOLUME_EXTENSIONS:
+        if fileName.lower().endswith(extension):
+            return fileName[:-len(extension)], extension
+    return os.path.splitext(fileName)
+
+def isVolumeFile(path):
+    return splitVolumeExtension(path)[1].lower() in VOLUME_EXTENSIONS
+
+def readImage(path):
+    return requireSimpleITK().ReadImage(path)
+
+def imageToArray(image):
+    """Array NumPy na ordem K, J, I (a mesma de slicer.util.array)."""
+    return requireSimpleITK().GetArrayFromImage(image)
+
+def writeArray(array, referenceImage, path, ijkOffset=(0, 0, 0), compress=True):
+    """Grava o array com a geometria da imagem de referencia, deslocada por ijkOffset (I, J, K)."""
+    sitk = requireSimpleITK()
+    image = sitk.GetImageFromArray(array)
+    image.SetSpacing(referenceImage.GetSpacing())
+    image.SetDirection(referenceImage.GetDirection())
+    image.SetOrigin(referenceImage.TransformIndexToPhysicalPoint([int(x) for x in ijkOffset]))
+    sitk.WriteImage(image, path, compress)
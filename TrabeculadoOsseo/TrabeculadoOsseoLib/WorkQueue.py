@@ -0,0 +1,485 @@
+import contextlib
+import json
+import logging
+import os
+import socket
+import threading
+import time
+
+try:
+    from urllib.parse import quote, unquote
+except ImportError:
+    from urllib import quote, unquote
+
+#
+# Fila de trabalho para distribuir exames entre varias maquinas.
+#
+# Cada tarefa (um exame) tem um identificador unico e um payload JSON. Um
+# worker reserva a tarefa (claim), processa e grava o resultado (complete)
+# ou a falha (fail). A reserva e exclusiva: dois workers nunca recebem a
+# mesma tarefa. Falhas voltam para a fila ate maxAttempts; reservas de um
+# worker que morreu expiram apos leaseSeconds e tambem voltam para a fila.
+# Enquanto processa, o worker renova a reserva (renew, ou renewingLease em
+# uma thread), para que um exame demorado nao seja entregue a outro worker.
+# Os resultados ficam na fila ate serem reunidos em uma unica tabela.
+#
+# Duas implementacoes com a mesma interface:
+#  - FileWorkQueue: um diretorio compartilhado (NFS, SMB), usando rename
+#    atomico para reservar;
+#  - RedisWorkQueue: um servidor Redis (pacote redis), ou LocalRedis, um
+#    substituto em memoria com os mesmos comandos, para testes.
+#
+
+DEFAULT_LEASE_SECONDS = 3600
+DEFAULT_MAX_ATTEMPTS = 3
+
+TASK_STATES = ("pending", "claimed", "done", "failed")
+
+def defaultWorkerId():
+    return "%s:%d" % (socket.gethostname(), os.getpid())
+
+class WorkTask(object):
+    """Tarefa reservada por um worker."""
+
+    def __init__(self, taskId, payload, attempts=0, workerId=None):
+        self.taskId = taskId
+        self.payload = payload
+        # Reservas ja feitas, incluindo a atual
+        self.attempts = attempts
+        self.workerId = workerId
+
+    def __repr__(self):
+        return "WorkTask(%r, tentativa %d)" % (self.taskId, self.attempts)
+
+class FileWorkQueue(object):
+    """
+    Fila em um diretorio, com um arquivo JSON por tarefa em pending/,
+    claimed/, done/ ou failed/. Reservar e mover de pending/ para claimed/
+    com os.rename, que so tem sucesso para um worker.
+    """
+
+    def __init__(self, directory, leaseSeconds=DEFAULT_LEASE_SECONDS, maxAttempts=DEFAULT_MAX_ATTEMPTS):
+        self.directory = directory
+        self.leaseSeconds = leaseSeconds
+        self.maxAttempts = maxAttempts
+        for state in TASK_STATES:
+            path = os.path.join(directory, state)
+            if not os.path.isdir(path):
+                try:
+                    os.makedirs(path)
+                except OSError:
+                    # Criado ao mesmo tempo por outro worker
+                    if not os.path.isdir(path):
+                        raise
+
+    def _path(self, state, taskId):
+        return os.path.join(self.directory, state, quote(taskId, safe="") + ".json")
+
+    def _taskIds(self, state):
+        names = [name for name in os.listdir(os.path.join(self.directory, state)) if name.endswith(".json")]
+        return [unquote(name[:-len(".json")]) for name in sorted(names)]
+
+    def _read(self, path):
+        with open(path) as taskFile:
+            return json.load(taskFile)
+
+    def _temporaryPath(self, path):
+        return "%s.%s.%d.tmp" % (path, socket.gethostname(), os.getpid())
+
+    def _write(self, path, entry):
+        # Grava em arquivo temporario e renomeia, para nunca deixar tarefa pela metade
+        temporaryPath = self._temporaryPath(path)
+        with open(temporaryPath, "w") as taskFile:
+            json.dump(entry, taskFile)
+        os.rename(temporaryPath, path)
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+            return True
+        except OSError:
+            return False
+
+    def submit(self, taskId, payload):
+        """Acrescenta a tarefa. Retorna False se ela ja existe (em qualquer estado)."""
+        if any(os.path.exists(self._path(state, taskId)) for state in TASK_STATES):
+            return False
+        path = self._path("pending", taskId)
+        temporaryPath = self._temporaryPath(path)
+        with open(temporaryPath, "w") as taskFile:
+            json.dump({"taskId": taskId, "payload": payload, "attempts": 0}, taskFile)
+        try:
+            # link falha se a tarefa foi criada ao mesmo tempo por outro processo
+            os.link(temporaryPath, path)
+            return True
+        except OSError:
+            return False
+        finally:
+            os.remove(temporaryPath)
+
+    def claim(self, workerId=None):
+        """Reserva a proxima tarefa pendente, ou retorna None se nao houver."""
+        self.requeueExpired()
+        for taskId in self._taskIds("pending"):
+            pendingPath = self._path("pending", taskId)
+            if os.path.exists(self._path("done", taskId)):
+                # Concluida por um worker cuja reserva ja tinha expirado
+                self._remove(pendingPath)
+                continue
+            claimedPath = self._path("claimed", taskId)
+            try:
+                # rename mantem a data do arquivo, usada na expiracao: renovada antes, para
+                # que a tarefa nunca apareca em claimed/ com a data de quando foi submetida
+                os.utime(pendingPath, None)
+                os.rename(pendingPath, claimedPath)
+            except OSError:
+                continue
+            try:
+                entry = self._read(claimedPath)
+            except (OSError, ValueError):
+                continue
+            entry["attempts"] += 1
+            entry["workerId"] = workerId or defaultWorkerId()
+            entry["claimedAt"] = time.time()
+            self._write(claimedPath, entry)
+            return WorkTask(taskId, entry["payload"], entry["attempts"], entry["workerId"])
+        return None
+
+    def complete(self, task, result):
+        """Grava o resultado (JSON) da tarefa e a retira da fila."""
+        self._write(self._path("done", task.taskId), {"taskId": task.taskId, "payload": task.payload, "attempts": task.attempts,
+                                                      "workerId": task.workerId, "result": result})
+        self._remove(self._path("claimed", task.taskId))
+        self._remove(self._path("pending", task.taskId))
+        # A reserva pode ter expirado ate esgotar as tentativas enquanto o exame era processado
+        self._remove(self._path("failed", task.taskId))
+
+    def renew(self, task):
+        """Renova a reserva da tarefa. Retorna False se ela ja nao pertence a este worker."""
+        claimedPath = self._path("claimed", task.taskId)
+        try:
+            entry = self._read(claimedPath)
+            if entry.get("workerId") != task.workerId or entry["attempts"] != task.attempts:
+                return False
+            # A expiracao usa a data do arquivo
+            os.utime(claimedPath, None)
+        except (OSError, ValueError):
+            # Retirada da reserva por expiracao ou concluida nesse meio tempo
+            return False
+        return True
+
+    def fail(self, task, error):
+        """Devolve a tarefa para a fila, ou a marca como falha apos maxAttempts."""
+        claimedPath = self._path("claimed", task.taskId)
+        if not os.path.exists(claimedPath):
+            return
+        entry = self._read(claimedPath)
+        if entry.get("workerId") != task.workerId or entry["attempts"] != task.attempts:
+            # A reserva expirou e a tarefa ja foi entregue a outro worker
+            return
+        entry["error"] = str(error)
+        self._finishAttempt(claimedPath, entry)
+
+    def _finishAttempt(self, claimedPath, entry):
+        # Retira a reserva com rename: se outro worker ja a retirou, nao faz nada
+        movingPath = self._temporaryPath(claimedPath)
+        try:
+            os.rename(claimedPath, movingPath)
+        except OSError:
+            return
+        with open(movingPath, "w") as taskFile:
+            json.dump(entry, taskFile)
+        state = "failed" if entry["attempts"] >= self.maxAttempts else "pending"
+        os.rename(movingPath, self._path(state, entry["taskId"]))
+
+    def requeueExpired(self):
+        """Devolve para a fila as reservas mais antigas que leaseSeconds (worker interrompido)."""
+        now = time.time()
+        for taskId in self._taskIds("claimed"):
+            claimedPath = self._path("claimed", taskId)
+            try:
+                if now - os.path.getmtime(claimedPath) < self.leaseSeconds:
+                    continue
+                entry = self._read(claimedPath)
+            except (OSError, ValueError):
+                # Concluida ou reescrita por outro worker nesse meio tempo
+                continue
+            entry["error"] = "Reserva de %s expirou" % entry.get("workerId")
+            self._finishAttempt(claimedPath, entry)
+
+    def results(self):
+        """Resultados das tarefas concluidas: lista de (taskId, resultado)."""
+        results = []
+        for taskId in self._taskIds("done"):
+            results.append((taskId, self._read(self._path("done", taskId))["result"]))
+        return results
+
+    def failures(self):
+        """Tarefas que esgotaram as tentativas: lista de (taskId, ultimo erro)."""
+        return [(taskId, self._read(self._path("failed", taskId)).get("error")) for taskId in self._taskIds("failed")]
+
+    def counts(self):
+        return dict((state, len(self._taskIds(state))) for state in TASK_STATES)
+
+    def __repr__(self):
+        return "FileWorkQueue(%r)" % self.directory
+
+def _text(value):
+    # O cliente redis retorna bytes
+    if isinstance(value, bytes):
+        return value.decode("utf-8")
+    return value
+
+class RedisWorkQueue(object):
+    """
+    Fila em um servidor Redis: uma lista de tarefas pendentes, uma lista das
+    tarefas em processamento (RPOPLPUSH entrega cada tarefa a um so worker e a
+    move de uma lista para a outra de uma vez) e hashes com os payloads, as
+    reservas, os resultados e as falhas, todos com o prefixo name. Uma tarefa
+    em processamento sem reserva (worker interrompido logo apos o RPOPLPUSH)
+    volta para a fila apos leaseSeconds. As renovacoes ficam em um hash
+    proprio, para que uma renovacao atrasada nunca recrie uma reserva ja retirada.
+    """
+
+    def __init__(self, client, name="trabeculado", leaseSeconds=DEFAULT_LEASE_SECONDS, maxAttempts=DEFAULT_MAX_ATTEMPTS):
+        self.client = client
+        self.name = name
+        self.leaseSeconds = leaseSeconds
+        self.maxAttempts = maxAttempts
+
+    def _key(self, suffix):
+        return self.name + ":" + suffix
+
+    def submit(self, taskId, payload):
+        if not self.client.hsetnx(self._key("tasks"), taskId, json.dumps(payload)):
+            return False
+        self.client.lpush(self._key("pending"), taskId)
+        return True
+
+    def claim(self, workerId=None):
+        self.requeueExpired()
+        while True:
+            taskId = _text(self.client.rpoplpush(self._key("pending"), self._key("processing")))
+            if taskId is None:
+                return None
+            if self.client.hexists(self._key("done"), taskId):
+                self.client.lrem(self._key("processing"), 1, taskId)
+                continue
+            attempts = self.client.hincrby(self._key("attempts"), taskId, 1)
+            workerId = workerId or defaultWorkerId()
+            self.client.hset(self._key("claims"), taskId, json.dumps({"workerId": workerId, "attempts": int(attempts), "claimedAt": time.time()}))
+            self.client.hdel(self._key("leases"), taskId)
+            self.client.hdel(self._key("unclaimed"), taskId)
+            payload = json.loads(_text(self.client.hget(self._key("tasks"), taskId)))
+            return WorkTask(taskId, payload, int(attempts), workerId)
+
+    def complete(self, task, result):
+        self.client.hset(self._key("done"), task.taskId, json.dumps(result))
+        self.client.hdel(self._key("failed"), task.taskId)
+        self.client.hdel(self._key("leases"), task.taskId)
+        if self.client.hdel(self._key("claims"), task.taskId):
+            self.client.lrem(self._key("processing"), 1, task.taskId)
+
+    def renew(self, task):
+        claim = self.client.hget(self._key("claims"), task.taskId)
+        if claim is None or json.loads(_text(claim))["attempts"] != task.attempts:
+            return False
+        self.client.hset(self._key("leases"), task.taskId, json.dumps(time.time()))
+        return True
+
+    def fail(self, task, error):
+        claim = self.client.hget(self._key("claims"), task.taskId)
+        if claim is None or json.loads(_text(claim))["attempts"] != task.attempts:
+            # A reserva expirou e a tarefa ja foi entregue a outro worker
+            return
+        # HDEL so retorna 1 para quem retirou a reserva: a tarefa volta uma unica vez
+        if self.client.hdel(self._key("claims"), task.taskId):
+            self.client.lrem(self._key("processing"), 1, task.taskId)
+            self._finishAttempt(task.taskId, str(error))
+
+    def _finishAttempt(self, taskId, error):
+        self.client.hdel(self._key("leases"), taskId)
+        self.client.hset(self._key("errors"), taskId, error)
+        if int(self.client.hget(self._key("attempts"), taskId) or 0) >= self.maxAttempts:
+            self.client.hset(self._key("failed"), taskId, error)
+        else:
+            self.client.lpush(self._key("pending"), taskId)
+
+    def requeueExpired(self):
+        now = time.time()
+        leases = self.client.hgetall(self._key("leases"))
+        for taskId, claim in self.client.hgetall(self._key("claims")).items():
+            claim = json.loads(_text(claim))
+            renewedAt = max(claim["claimedAt"], json.loads(_text(leases.get(taskId, "0"))))
+            if now - renewedAt < self.leaseSeconds:
+                continue
+            taskId = _text(taskId)
+            if self.client.hdel(self._key("claims"), taskId):
+                self.client.lrem(self._key("processing"), 1, taskId)
+                self._finishAttempt(taskId, "Reserva de %s expirou" % claim["workerId"])
+
+        # Em processamento sem reserva: a primeira vez em que e vista fica registrada
+        claims = self.client.hgetall(self._key("claims"))
+        for taskId in self.client.lrange(self._key("processing"), 0, -1):
+            if taskId in claims:
+                continue
+            self.client.hsetnx(self._key("unclaimed"), taskId, json.dumps(now))
+            seenAt = self.client.hget(self._key("unclaimed"), taskId)
+            if seenAt is None or now - json.loads(_text(seenAt)) < self.leaseSeconds:
+                continue
+            # LREM so retorna 1 para quem retirou a tarefa: ela volta uma unica vez
+            if self.client.hexists(self._key("claims"), taskId) or not self.client.lrem(self._key("processing"), 1, taskId):
+                continue
+            self.client.hdel(self._key("unclaimed"), taskId)
+            if self.client.hexists(self._key("done"), taskId):
+                continue
+            self._finishAttempt(_text(taskId), "Reserva interrompida antes de ser registrada")
+
+    def results(self):
+        done = self.client.hgetall(self._key("done"))
+        return sorted((_text(taskId), json.loads(_text(result))) for taskId, result in done.items())
+
+    def failures(self):
+        return sorted((_text(taskId), _text(error)) for taskId, error in self.client.hgetall(self._key("failed")).items())
+
+    def counts(self):
+        return {
+            "pending": int(self.client.llen(self._key("pending"))),
+            # Inclui as tarefas retiradas da fila cuja reserva ainda nao foi registrada
+            "claimed": int(self.client.llen(self._key("processing"))),
+            "done": int(self.client.hlen(self._key("done"))),
+            "failed": int(self.client.hlen(self._key("failed"))),
+        }
+
+    def __repr__(self):
+        return "RedisWorkQueue(%r)" % self.name
+
+class LocalRedis(object):
+    """
+    Substituto em memoria (com lock, para varias threads) dos comandos do
+    Redis usados por RedisWorkQueue, para testes sem servidor.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.lists = {}
+        self.hashes = {}
+
+    def lpush(self, key, value):
+        with self.lock:
+            values = self.lists.setdefault(key, [])
+            values.insert(0, value)
+            return len(values)
+
+    def rpop(self, key):
+        with self.lock:
+            values = self.lists.get(key)
+            return values.pop() if values else None
+
+    def rpoplpush(self, source, destination):
+        with self.lock:
+            values = self.lists.get(source)
+            if not values:
+                return None
+            value = values.pop()
+            self.lists.setdefault(destination, []).insert(0, value)
+            return value
+
+    def lrem(self, key, count, value):
+        # So count > 0 (a partir do inicio), o unico uso de RedisWorkQueue
+        with self.lock:
+            values = self.lists.get(key, [])
+            removed = 0
+            while removed < count and value in values:
+                values.remove(value)
+                removed += 1
+            return removed
+
+    def lrange(self, key, start, end):
+        with self.lock:
+            values = self.lists.get(key, [])
+            return list(values[start:] if end == -1 else values[start:end + 1])
+
+    def llen(self, key):
+        with self.lock:
+            return len(self.lists.get(key, []))
+
+    def hsetnx(self, key, field, value):
+        with self.lock:
+            fields = self.hashes.setdefault(key, {})
+            if field in fields:
+                return 0
+            fields[field] = value
+            return 1
+
+    def hset(self, key, field, value):
+        with self.lock:
+            fields = self.hashes.setdefault(key, {})
+            created = field not in fields
+            fields[field] = value
+            return int(created)
+
+    def hget(self, key, field):
+        with self.lock:
+            return self.hashes.get(key, {}).get(field)
+
+    def hexists(self, key, field):
+        with self.lock:
+            return field in self.hashes.get(key, {})
+
+    def hdel(self, key, field):
+        with self.lock:
+            return int(self.hashes.get(key, {}).pop(field, None) is not None)
+
+    def hincrby(self, key, field, amount=1):
+        with self.lock:
+            fields = self.hashes.setdefault(key, {})
+            fields[field] = int(fields.get(field, 0)) + amount
+            return fields[field]
+
+    def hgetall(self, key):
+        with self.lock:
+            return dict(self.hashes.get(key, {}))
+
+    def hlen(self, key):
+        with self.lock:
+            return len(self.hashes.get(key, {}))
+
+@contextlib.contextmanager
+def renewingLease(queue, task, interval=None):
+    """
+    Renova a reserva de task em uma thread, a cada interval segundos (por padrao
+    um terco de leaseSeconds), enquanto o bloco roda.
+    """
+    if interval is None:
+        interval = queue.leaseSeconds / 3.0
+    stopped = threading.Event()
+
+    def renewLease():
+        while not stopped.wait(interval):
+            try:
+                if not queue.renew(task):
+                    # Reserva perdida: complete ainda grava o resultado
+                    logging.warning('Reserva de %s perdida' % task.taskId)
+                    return
+            except Exception:
+                logging.exception('Falha ao renovar a reserva de ' + task.taskId)
+
+    thread = threading.Thread(target=renewLease)
+    thread.daemon = True
+    thread.start()
+    try:
+        yield
+    finally:
+        stopped.set()
+        thread.join()
+
+def openWorkQueue(location, leaseSeconds=DEFAULT_LEASE_SECONDS, maxAttempts=DEFAULT_MAX_ATTEMPTS):
+    """Fila a partir de um diretorio ou de uma URL redis://host:porta/banco (requer o pacote redis)."""
+    if location.startswith(("redis://", "rediss://", "unix://")):
+        try:
+            import redis
+        except ImportError:
+            raise ImportError("Pacote redis nao encontrado: instale com 'pip install redis' ou use um diretorio compartilhado")
+        return RedisWorkQueue(redis.Redis.from_url(location), leaseSeconds=leaseSeconds, maxAttempts=maxAttempts)
+    return FileWorkQueue(location, leaseSeconds, maxAttempts)
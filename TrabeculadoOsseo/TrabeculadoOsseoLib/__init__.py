@@ -0,0 +1,17 @@
+from .LabelStatistics import *
+from .BitDepthDetection import *
+from .FVTOCore import *
+from .BatchPool import *
+from .Cache import *
+from .Histogram import *
+from .Kernels import *
+from .Incremental import *
+from .Memory import *
+from .Background import *
+from .Profiling import *
+from .Phantoms import *
+from .Regions import *
+from .MaskExport import *
+from .Persistence import *
+from .BiasCorrection import *
+from .ExamPairing import *